@@ -13,8 +13,11 @@ const state = {
         storySummary: '',
         npcList: '',
         npcGoals: '',
-        chatHistory: []
+        chatHistory: [],
+        sessionId: null,      // 代理服务器上的对话会话
+        sessionContext: ''    // 最近一次发送给会话的上下文，变化时才重新发送
     },
+    playerId: '',       // 玩家 ID，记忆按 ID 保存在代理服务器上
     playerMemory: null  // 将在初始化时加载
 };
 
@@ -41,14 +44,42 @@ function createEmptyMemory() {
     };
 }
 
-// 从 localStorage 加载玩家记忆
-function loadPlayerMemory() {
+// 获取（首次使用时生成）玩家 ID
+function getPlayerId() {
+    let playerId = localStorage.getItem('ai_rpg_player_id');
+    if (!playerId) {
+        playerId = Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+        localStorage.setItem('ai_rpg_player_id', playerId);
+    }
+    return playerId;
+}
+
+// 从代理服务器加载玩家记忆
+async function loadPlayerMemory() {
     try {
+        const response = await fetch(`/api/memory/${state.playerId}`);
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        let memory = await response.json();
+
+        // 旧版本保存在 localStorage 中的记忆，迁移到服务器后删除
         const saved = localStorage.getItem('ai_rpg_player_memory');
         if (saved) {
-            console.log('✅ 从 localStorage 加载玩家记忆');
-            return JSON.parse(saved);
+            const imported = await fetch(`/api/memory/${state.playerId}/import`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: saved
+            });
+            if (imported.ok) {
+                memory = await imported.json();
+                localStorage.removeItem('ai_rpg_player_memory');
+                console.log('📦 已把 localStorage 中的玩家记忆迁移到服务器');
+            }
         }
+
+        console.log('✅ 从服务器加载玩家记忆');
+        return memory;
     } catch (error) {
         console.error('加载玩家记忆失败:', error);
     }
@@ -56,23 +87,19 @@ function loadPlayerMemory() {
     return createEmptyMemory();
 }
 
-// 保存玩家记忆到 localStorage
-function savePlayerMemory(memory) {
-    try {
-        localStorage.setItem('ai_rpg_player_memory', JSON.stringify(memory));
-        console.log('💾 玩家记忆已保存');
-        return true;
-    } catch (error) {
-        console.error('保存玩家记忆失败:', error);
-        alert('保存记忆失败，可能是因为存储空间不足');
-        return false;
-    }
-}
-
 // 清空玩家记忆
-function clearPlayerMemory() {
+async function clearPlayerMemory() {
     if (confirm('确定要清空所有玩家记忆吗？此操作不可撤销！')) {
-        localStorage.removeItem('ai_rpg_player_memory');
+        try {
+            const response = await fetch(`/api/memory/${state.playerId}/clear`, { method: 'POST' });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+        } catch (error) {
+            console.error('清空玩家记忆失败:', error);
+            alert('清空记忆失败，请确保使用 proxy_server.py 启动服务器');
+            return false;
+        }
         state.playerMemory = createEmptyMemory();
         console.log('🗑️ 玩家记忆已清空');
         alert('玩家记忆已清空');
@@ -81,292 +108,14 @@ function clearPlayerMemory() {
     return false;
 }
 
-// 导出玩家记忆为JSON文件
+// 导出玩家记忆为JSON文件（由服务器生成下载）
 function exportPlayerMemory() {
-    const dataStr = JSON.stringify(state.playerMemory, null, 2);
-    const dataBlob = new Blob([dataStr], { type: 'application/json' });
-    const url = URL.createObjectURL(dataBlob);
     const link = document.createElement('a');
-    link.href = url;
-    link.download = `player_memory_${new Date().toISOString().slice(0, 10)}.json`;
+    link.href = `/api/memory/${state.playerId}/export`;
     link.click();
-    URL.revokeObjectURL(url);
     console.log('📥 玩家记忆已导出');
 }
 
-// 生成记忆上下文（用于对话模块）
-function generateMemoryContext(memory) {
-    if (!memory || !state.modules.memory.enabled) {
-        return '';
-    }
-
-    let context = '\n【玩家记忆档案】\n';
-
-    // 玩家信息
-    if (memory.player_info.name || memory.player_info.description) {
-        context += '玩家信息：';
-        if (memory.player_info.name) context += `${memory.player_info.name} - `;
-        context += `${memory.player_info.description || '无'}\n`;
-        if (memory.player_info.personality) {
-            context += `性格：${memory.player_info.personality}\n`;
-        }
-    }
-
-    // NPC关系
-    const relationships = Object.entries(memory.relationships);
-    if (relationships.length > 0) {
-        context += '\n与NPC的关系：\n';
-        relationships.slice(0, 5).forEach(([npc, rel]) => {
-            context += `- ${npc}：${rel.relationship || '未知'}（信任度${rel.trust_level || 5}/10）\n`;
-        });
-    }
-
-    // 当前目标和承诺
-    const activeGoals = memory.goals_and_promises.filter(g => g.status === 'active');
-    if (activeGoals.length > 0) {
-        context += '\n当前目标和承诺：\n';
-        activeGoals.slice(0, 3).forEach(g => {
-            context += `- ${g.type === 'goal' ? '目标' : '承诺'}：${g.content}\n`;
-        });
-    }
-
-    // 已发现的线索
-    if (memory.secrets_discovered.length > 0) {
-        context += '\n已发现的线索：\n';
-        context += memory.secrets_discovered.slice(0, 3).join('、') + '\n';
-    }
-
-    return context;
-}
-
-// 更新玩家记忆（调用Memory Module）
-async function updatePlayerMemory(recentDialogue) {
-    if (!state.modules.memory.enabled) {
-        console.log('⚠️ 记忆系统未启用');
-        return;
-    }
-
-    console.log('🧠 开始更新玩家记忆...');
-
-    try {
-        // 构建输入数据
-        const input = {
-            current_scene: state.scene.storySummary.substring(0, 100),
-            recent_conversation: recentDialogue.map(msg => {
-                if (msg.role === 'player') {
-                    return { role: 'player', content: msg.content };
-                } else {
-                    // 尝试解析NPC响应
-                    try {
-                        const parsed = JSON.parse(msg.content);
-                        if (parsed.responses) {
-                            // 多个NPC响应
-                            return parsed.responses.map(r => ({
-                                role: 'npc',
-                                npc_name: r.npc_name,
-                                content: r.content
-                            }));
-                        } else {
-                            // 单个NPC响应
-                            return {
-                                role: 'npc',
-                                npc_name: parsed.npc_name || 'NPC',
-                                content: parsed.content
-                            };
-                        }
-                    } catch {
-                        // 文本格式
-                        return { role: 'npc', content: msg.content };
-                    }
-                }
-            }).flat(),
-            current_memory: state.playerMemory
-        };
-
-        // 构建提示词
-        const userPrompt = `
-请分析以下对话，提取关键信息并更新玩家记忆。
-
-当前场景：${input.current_scene}
-
-对话内容：
-${input.recent_conversation.map(msg => {
-    if (msg.role === 'player') {
-        return `玩家：${msg.content}`;
-    } else {
-        return `${msg.npc_name || 'NPC'}：${msg.content}`;
-    }
-}).join('\n')}
-
-当前记忆状态：
-${JSON.stringify(input.current_memory, null, 2)}
-
-请返回JSON格式的更新指令。格式如下：
-{
-  "player_info": {
-    "name": "玩家名字（如果提到）",
-    "description": "更新的描述（如果提到）",
-    "personality": "更新的性格（如果提到）",
-    "background": "更新的背景（如果提到）"
-  },
-  "new_key_facts": [
-    { "fact": "关键事实", "scene": "${input.current_scene}" }
-  ],
-  "relationship_updates": {
-    "NPC名字": {
-      "relationship": "关系类型",
-      "trust_level": 7,
-      "new_interactions": ["新的互动记录"]
-    }
-  },
-  "new_goals_and_promises": [
-    {
-      "type": "goal 或 promise",
-      "content": "内容",
-      "related_npc": "相关NPC",
-      "status": "active",
-      "scene": "${input.current_scene}"
-    }
-  ],
-  "new_important_events": [
-    { "event": "重要事件", "scene": "${input.current_scene}", "impact": "影响" }
-  ],
-  "new_inventory": ["新物品"],
-  "new_skills": ["新技能"],
-  "new_secrets": ["新发现的秘密"]
-}
-
-注意：
-1. 只返回需要更新的字段，没有更新的字段可以省略或设为null
-2. 不要杜撰信息，只记录明确提到的内容
-3. 保持客观，不添加主观解释
-`;
-
-        // 调用AI
-        const response = await callOpenAI(
-            state.modules.memory.prompt,
-            userPrompt,
-            true  // 使用JSON模式
-        );
-
-        console.log('🤖 Memory Module响应:', response);
-
-        // 解析更新指令
-        const updates = JSON.parse(response);
-
-        // 应用更新
-        applyMemoryUpdates(state.playerMemory, updates);
-
-        // 保存到localStorage
-        savePlayerMemory(state.playerMemory);
-
-        console.log('✅ 玩家记忆更新完成');
-
-    } catch (error) {
-        console.error('❌ 更新玩家记忆失败:', error);
-        // 不影响对话继续，只是记录错误
-    }
-}
-
-// 应用记忆更新
-function applyMemoryUpdates(memory, updates) {
-    // 更新玩家信息
-    if (updates.player_info) {
-        for (const [key, value] of Object.entries(updates.player_info)) {
-            if (value && value !== 'null' && value !== '无') {
-                memory.player_info[key] = value;
-            }
-        }
-    }
-
-    // 添加新的关键事实
-    if (updates.new_key_facts && Array.isArray(updates.new_key_facts)) {
-        updates.new_key_facts.forEach(fact => {
-            if (fact.fact) {
-                fact.timestamp = new Date().toISOString();
-                memory.key_facts.push(fact);
-            }
-        });
-    }
-
-    // 更新NPC关系
-    if (updates.relationship_updates) {
-        for (const [npcName, relUpdate] of Object.entries(updates.relationship_updates)) {
-            if (!memory.relationships[npcName]) {
-                memory.relationships[npcName] = {
-                    relationship: relUpdate.relationship || '中立',
-                    trust_level: relUpdate.trust_level || 5,
-                    key_interactions: []
-                };
-            } else {
-                if (relUpdate.relationship) {
-                    memory.relationships[npcName].relationship = relUpdate.relationship;
-                }
-                if (relUpdate.trust_level !== undefined) {
-                    memory.relationships[npcName].trust_level = relUpdate.trust_level;
-                }
-            }
-            
-            // 添加新的互动记录
-            if (relUpdate.new_interactions && Array.isArray(relUpdate.new_interactions)) {
-                memory.relationships[npcName].key_interactions.push(...relUpdate.new_interactions);
-                // 限制互动记录数量
-                if (memory.relationships[npcName].key_interactions.length > 10) {
-                    memory.relationships[npcName].key_interactions = 
-                        memory.relationships[npcName].key_interactions.slice(-10);
-                }
-            }
-        }
-    }
-
-    // 添加新的目标和承诺
-    if (updates.new_goals_and_promises && Array.isArray(updates.new_goals_and_promises)) {
-        updates.new_goals_and_promises.forEach(goal => {
-            if (goal.content) {
-                memory.goals_and_promises.push(goal);
-            }
-        });
-    }
-
-    // 添加重要事件
-    if (updates.new_important_events && Array.isArray(updates.new_important_events)) {
-        updates.new_important_events.forEach(event => {
-            if (event.event) {
-                memory.important_events.push(event);
-            }
-        });
-    }
-
-    // 添加物品
-    if (updates.new_inventory && Array.isArray(updates.new_inventory)) {
-        updates.new_inventory.forEach(item => {
-            if (item && !memory.inventory_mentions.includes(item)) {
-                memory.inventory_mentions.push(item);
-            }
-        });
-    }
-
-    // 添加技能
-    if (updates.new_skills && Array.isArray(updates.new_skills)) {
-        updates.new_skills.forEach(skill => {
-            if (skill && !memory.skills_and_abilities.includes(skill)) {
-                memory.skills_and_abilities.push(skill);
-            }
-        });
-    }
-
-    // 添加秘密
-    if (updates.new_secrets && Array.isArray(updates.new_secrets)) {
-        updates.new_secrets.forEach(secret => {
-            if (secret && !memory.secrets_discovered.includes(secret)) {
-                memory.secrets_discovered.push(secret);
-            }
-        });
-    }
-
-    console.log('📝 记忆更新已应用:', updates);
-}
-
 // 页面元素
 const pages = {
     config: document.getElementById('config-page'),
@@ -396,7 +145,11 @@ function showLoading(show = true) {
 // 支持两种调用方式：
 // 1. callOpenAI(systemPrompt, userPrompt, useJsonMode) - 简单调用
 // 2. callOpenAI(systemPrompt, messagesArray, useJsonMode) - 带历史记录
-async function callOpenAI(systemPrompt, userPromptOrMessages, useJsonMode = false) {
+// 可选的第四个参数 options：
+// - onDelta(text): 流式接收，每收到一段内容就以当前累计文本回调一次
+// - priority: 请求类别（dialogue / summary / story / memory / letter），代理按类别排队，
+//   玩家正在等待的对话优先于后台的记忆更新和信件
+async function callOpenAI(systemPrompt, userPromptOrMessages, useJsonMode = false, options = {}) {
     let messages;
     
     // 调试：显示使用的 System Prompt
@@ -421,24 +174,23 @@ async function callOpenAI(systemPrompt, userPromptOrMessages, useJsonMode = fals
         throw new Error('第二个参数必须是字符串或消息数组');
     }
 
-    const requestBody = {
-        model: state.model,
-        messages: messages,
-        temperature: 0.7,
-        api_key: state.apiKey  // 将 API Key 放在请求体中，由代理服务器处理
-    };
+    const requestBody = buildChatRequest(messages, useJsonMode);
+    requestBody.api_key = state.apiKey;  // 将 API Key 放在请求体中，由代理服务器处理
 
-    if (useJsonMode) {
-        requestBody.response_format = { type: 'json_object' };
+    const streaming = typeof options.onDelta === 'function';
+    if (streaming) {
+        requestBody.stream = true;
     }
 
     try {
         // 使用本地代理服务器，避免 CORS 问题
+        const headers = { 'Content-Type': 'application/json' };
+        if (options.priority) {
+            headers['X-Request-Priority'] = options.priority;
+        }
         const response = await fetch('/api/openai', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: headers,
             body: JSON.stringify(requestBody)
         });
 
@@ -447,6 +199,10 @@ async function callOpenAI(systemPrompt, userPromptOrMessages, useJsonMode = fals
             throw new Error(`API Error: ${errorData.error?.message || response.statusText}`);
         }
 
+        if (streaming) {
+            return await readEventStream(response, options.onDelta);
+        }
+
         const data = await response.json();
         return data.choices[0].message.content;
     } catch (error) {
@@ -456,6 +212,101 @@ async function callOpenAI(systemPrompt, userPromptOrMessages, useJsonMode = fals
     }
 }
 
+// 工具函数：Chat Completions 请求体（不含 API Key），预取与正常调用共用，保证代理能匹配到预取的请求
+function buildChatRequest(messages, useJsonMode = false) {
+    const requestBody = {
+        model: state.model,
+        messages: messages,
+        temperature: 0.7
+    };
+    if (useJsonMode) {
+        requestBody.response_format = { type: 'json_object' };
+    }
+    return requestBody;
+}
+
+// 工具函数：场景结束流水线（通过代理的 /api/scene/end，总结完成后并发生成下一幕和信件）
+// sections: { summary, story, letter? }，每项为 { system_prompt, prompt, json_mode }
+// onEvent(event): 每收到一行事件回调一次，总结的增量文本为 { section: 'summary', delta }，
+// 各部分完成时为 { section, status, content | error }，结束会话时还有 { section: 'memory', memory }
+async function callScenePipeline(sections, sessionId, onEvent) {
+    console.log('🤖 场景结束流水线：', Object.keys(sections).join(' → '));
+
+    const requestBody = { api_key: state.apiKey, model: state.model, ...sections };
+    if (sessionId) {
+        requestBody.session_id = sessionId;
+    }
+
+    const response = await fetch('/api/scene/end', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(requestBody)
+    });
+
+    if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(`API Error: ${errorData.error?.message || response.statusText}`);
+    }
+
+    // 每行一个 JSON 事件
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let newline;
+        while ((newline = buffer.indexOf('\n')) !== -1) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) {
+                onEvent(JSON.parse(line));
+            }
+        }
+    }
+}
+
+
+// 工具函数：读取代理转发的 SSE 流，返回完整文本
+async function readEventStream(response, onDelta) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let text = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // 每个事件以空行结束
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const event = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            for (const line of event.split('\n')) {
+                if (!line.startsWith('data:')) continue;
+                const data = line.slice(5).trim();
+                if (data === '[DONE]') return text;
+
+                const delta = JSON.parse(data).choices?.[0]?.delta?.content;
+                if (delta) {
+                    text += delta;
+                    onDelta(text);
+                }
+            }
+        }
+    }
+
+    return text;
+}
+
 // ============================================
 // JSON Mode自动提示功能
 // ============================================
@@ -568,6 +419,7 @@ document.getElementById('start-btn').addEventListener('click', () => {
 
     // 跳转到场景初始化页面
     showPage('sceneInit');
+    scheduleGreetingPrefetch();
 });
 
 // 场景初始化页面逻辑
@@ -586,6 +438,8 @@ document.getElementById('begin-dialogue-btn').addEventListener('click', () => {
     state.scene.npcList = npcList;
     state.scene.npcGoals = npcGoals;
     state.scene.chatHistory = [];
+    state.scene.sessionId = null;
+    state.scene.sessionContext = '';
 
     // 显示场景信息
     document.getElementById('display-story-summary').textContent = storySummary;
@@ -602,6 +456,7 @@ document.getElementById('begin-dialogue-btn').addEventListener('click', () => {
     // 如果有故事模块生成的初始对话（第二幕及以后），显示它
     // 否则生成新的初始问候（第一幕）
     if (state.scene.nextNPCDialogue) {
+        cancelGreetingPrefetch();
         displayStoredNPCDialogue();
     } else {
         generateInitialGreeting();
@@ -641,18 +496,14 @@ function displayStoredNPCDialogue() {
     state.scene.nextNPCDialogue = null;
 }
 
-// 生成初始问候函数
-async function generateInitialGreeting() {
-    showLoading(true);
-    
-    try {
-        // 构建提示词
-        const greetingPrompt = `
-故事背景：${state.scene.storySummary}
+// 构造初始问候的请求内容
+function buildGreetingPrompt(storySummary, npcList, npcGoals) {
+    return `
+故事背景：${storySummary}
 
-NPC列表：${state.scene.npcList}
+NPC列表：${npcList}
 
-NPC目标：${state.scene.npcGoals}
+NPC目标：${npcGoals}
 
 请选择一个最合适的NPC来主动问候玩家，问候内容要与故事背景相关。
 
@@ -667,12 +518,108 @@ ${state.modules.dialogue.jsonMode ?
 `格式：[NPC名字] 问候内容 [情绪：情绪动画]
 情绪动画从以下选择：高兴、难过、失望、振奋、绝望、疯狂、希望、平静`}
 `;
+}
+
+// ============================================
+// 初始问候预取
+// 场景信息填好（或下一幕的场景描述生成后）就让代理开始生成问候，
+// 玩家点击"开始对话"时直接取走结果；代理按请求内容匹配，场景信息改动后旧的预取会被取消
+// ============================================
+
+const GREETING_PREFETCH_KEY = 'greeting';
+let greetingPrefetchTimer = null;
 
-        const response = await callOpenAI(
-            state.modules.dialogue.prompt,
-            greetingPrompt,
-            state.modules.dialogue.jsonMode
+function buildGreetingRequest(greetingPrompt) {
+    return buildChatRequest([
+        { role: 'system', content: state.modules.dialogue.prompt },
+        { role: 'user', content: greetingPrompt }
+    ], state.modules.dialogue.jsonMode);
+}
+
+// 预取失败不影响游戏，开始对话时会改为正常请求
+async function postPrefetch(path, body) {
+    try {
+        return await fetch(path, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ api_key: state.apiKey, key: GREETING_PREFETCH_KEY, ...body })
+        });
+    } catch (error) {
+        console.warn('预取请求失败:', error);
+        return null;
+    }
+}
+
+function prefetchGreeting(storySummary, npcList, npcGoals) {
+    if (!state.apiKey || !state.modules.dialogue.prompt || !storySummary || !npcList || !npcGoals) {
+        return;
+    }
+    const request = buildGreetingRequest(buildGreetingPrompt(storySummary, npcList, npcGoals));
+    postPrefetch('/api/prefetch', { request: request });
+}
+
+function cancelGreetingPrefetch() {
+    clearTimeout(greetingPrefetchTimer);
+    postPrefetch('/api/prefetch/cancel', {});
+}
+
+// 场景初始化页面的输入停顿一会儿后再预取，避免每次按键都触发
+function scheduleGreetingPrefetch() {
+    clearTimeout(greetingPrefetchTimer);
+    greetingPrefetchTimer = setTimeout(() => {
+        if (state.scene.nextNPCDialogue) {
+            return;  // 下一幕已有故事模块生成的初始对话
+        }
+        prefetchGreeting(
+            document.getElementById('story-summary').value.trim(),
+            document.getElementById('npc-list').value.trim(),
+            document.getElementById('npc-goals').value.trim()
         );
+    }, 800);
+}
+
+['story-summary', 'npc-list', 'npc-goals'].forEach(id => {
+    document.getElementById(id).addEventListener('input', scheduleGreetingPrefetch);
+});
+
+// 取走预取的问候，没有可用结果（未预取、场景信息已改动或生成失败）时返回 null
+async function takePrefetchedGreeting(greetingPrompt) {
+    clearTimeout(greetingPrefetchTimer);
+    const response = await postPrefetch('/api/prefetch/take', { request: buildGreetingRequest(greetingPrompt) });
+    if (!response || !response.ok) {
+        return null;
+    }
+    const data = await response.json();
+    console.log(`⚡ 使用预取的初始问候（等待 ${data.waited_ms} ms）`);
+    return data.content;
+}
+
+// 生成初始问候函数
+async function generateInitialGreeting() {
+    showLoading(true);
+    
+    try {
+        // 构建提示词
+        const greetingPrompt = buildGreetingPrompt(state.scene.storySummary, state.scene.npcList, state.scene.npcGoals);
+
+        let response = await takePrefetchedGreeting(greetingPrompt);
+        if (response === null) {
+            // 文本格式下流式显示问候，JSON 格式需要完整结果才能解析
+            const streamingMessage = state.modules.dialogue.jsonMode ? null : createStreamingMessage();
+            try {
+                response = await callOpenAI(
+                    state.modules.dialogue.prompt,
+                    greetingPrompt,
+                    state.modules.dialogue.jsonMode,
+                    {
+                        priority: 'dialogue',
+                        onDelta: streamingMessage ? streamIntoMessage(streamingMessage) : undefined
+                    }
+                );
+            } finally {
+                if (streamingMessage) streamingMessage.remove();
+            }
+        }
 
         // 解析并显示问候
         if (state.modules.dialogue.jsonMode) {
@@ -715,19 +662,43 @@ document.getElementById('send-btn').addEventListener('click', async () => {
     // 调用对话模块
     showLoading(true);
     try {
-        // 构建包含历史记录的消息数组
-        const messages = [];
-        
-        // 第一条消息：场景信息、记忆上下文和指令
-        const memoryContext = generateMemoryContext(state.playerMemory);
-        
-        const contextMessage = `
+        const streamingMessage = state.modules.dialogue.jsonMode ? null : createStreamingMessage();
+        let response;
+        try {
+            // 对话历史保存在代理的会话中，每轮只发送玩家的新台词
+            response = await callDialogueSession(
+                userInput,
+                streamingMessage ? { onDelta: streamIntoMessage(streamingMessage) } : {}
+            );
+        } finally {
+            if (streamingMessage) streamingMessage.remove();
+        }
+
+        // 解析响应
+        parseNPCResponse(response, state.modules.dialogue.jsonMode);
+
+        // 添加到聊天历史（先添加玩家输入，再添加NPC响应）
+        state.scene.chatHistory.push({ role: 'player', content: userInput });
+        state.scene.chatHistory.push({ role: 'npc', content: response });
+
+        // 玩家记忆由代理在服务器端合并几轮对话后更新，不再每轮调用记忆模块
+
+    } catch (error) {
+        console.error('对话模块错误:', error);
+    } finally {
+        showLoading(false);
+    }
+});
+
+// 对话模块的上下文：场景信息和指令（作为会话的第一条用户消息）
+// 玩家记忆由代理服务器按每轮台词检索相关条目后放在前面
+function buildDialogueContext() {
+    return `
 故事背景：${state.scene.storySummary}
 
 NPC列表：${state.scene.npcList}
 
 NPC目标：${state.scene.npcGoals}
-${memoryContext}
 
 请根据上述信息和对话历史，决定让几个NPC回应（1个、2个或更多都可以，要符合实际情况）。
 记住之前的对话内容，保持对话的连贯性和一致性。
@@ -750,49 +721,107 @@ ${state.modules.dialogue.jsonMode ?
 情绪动画从以下选择：高兴、难过、失望、振奋、绝望、疯狂、希望、平静
 注意：不是所有NPC都要回应，只返回需要说话的NPC。`}
 `;
-        
-        messages.push({ role: 'user', content: contextMessage });
-        
-        // 添加历史对话（限制最近10轮对话，避免token过多）
-        const maxHistory = 20; // 10轮对话 = 20条消息（玩家+NPC）
-        const recentHistory = state.scene.chatHistory.slice(-maxHistory);
-        
-        for (const msg of recentHistory) {
-            if (msg.role === 'player') {
-                messages.push({ role: 'user', content: `玩家：${msg.content}` });
-            } else if (msg.role === 'npc') {
-                messages.push({ role: 'assistant', content: msg.content });
-            }
+}
+
+// 创建代理服务器上的对话会话，上传一次上下文和已有的对话记录
+async function createDialogueSession(context) {
+    const requestBody = {
+        api_key: state.apiKey,
+        model: state.model,
+        temperature: 0.7,
+        system_prompt: state.modules.dialogue.prompt,
+        context: context,
+        // 限制最近10轮对话，避免token过多（服务器端同样只保留最近的记录）
+        history: state.scene.chatHistory.slice(-20),
+        // 对话过程中代理每隔几轮在后台更新滚动场景总结，结束对话时只需合并最后几轮
+        summary: {
+            system_prompt: state.modules.summary.prompt,
+            background: `故事背景：${state.scene.storySummary}\n\nNPC目标：${state.scene.npcGoals}`,
+            json_mode: state.modules.summary.jsonMode
         }
-        
-        // 当前玩家输入
-        messages.push({ role: 'user', content: `玩家：${userInput}` });
+    };
+    if (state.modules.dialogue.jsonMode) {
+        requestBody.response_format = { type: 'json_object' };
+    }
+    if (state.modules.memory.enabled) {
+        requestBody.player_id = state.playerId;
+        requestBody.npc_names = state.scene.npcList;
+        requestBody.memory = {
+            system_prompt: state.modules.memory.prompt,
+            scene: state.scene.storySummary.substring(0, 100)
+        };
+    }
 
-        const response = await callOpenAI(
-            state.modules.dialogue.prompt,
-            messages,
-            state.modules.dialogue.jsonMode
-        );
+    const response = await fetch('/api/session', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(requestBody)
+    });
+    if (!response.ok) {
+        throw new Error(`创建对话会话失败: HTTP ${response.status}`);
+    }
 
-        // 解析响应
-        parseNPCResponse(response, state.modules.dialogue.jsonMode);
+    const data = await response.json();
+    state.scene.sessionId = data.session_id;
+    state.scene.sessionContext = context;
+    console.log('💬 已创建对话会话，包含历史记录', requestBody.history.length, '条');
+}
 
-        // 添加到聊天历史（先添加玩家输入，再添加NPC响应）
-        state.scene.chatHistory.push({ role: 'player', content: userInput });
-        state.scene.chatHistory.push({ role: 'npc', content: response });
+// 发送一轮玩家台词，返回 NPC 回复；options 与 callOpenAI 相同（onDelta 开启流式）
+async function callDialogueSession(userInput, options = {}) {
+    const context = buildDialogueContext();
+    const streaming = typeof options.onDelta === 'function';
 
-        // 更新玩家记忆（异步，不阻塞UI）
-        updatePlayerMemory([
-            { role: 'player', content: userInput },
-            { role: 'npc', content: response }
-        ]).catch(err => console.error('记忆更新失败:', err));
+    const sendTurn = async () => {
+        if (!state.scene.sessionId) {
+            await createDialogueSession(context);
+        }
+        const requestBody = { content: userInput };
+        // 上下文（例如玩家记忆）变化时才重新发送
+        if (context !== state.scene.sessionContext) {
+            requestBody.context = context;
+        }
+        if (streaming) {
+            requestBody.stream = true;
+        }
+        return fetch(`/api/session/${state.scene.sessionId}/turn`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Request-Priority': 'dialogue'
+            },
+            body: JSON.stringify(requestBody)
+        });
+    };
 
+    try {
+        let response = await sendTurn();
+        if (response.status === 404) {
+            // 会话已过期（例如代理服务器重启），用本地的对话记录重新创建
+            state.scene.sessionId = null;
+            response = await sendTurn();
+        }
+
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(`API Error: ${errorData.error?.message || response.statusText}`);
+        }
+        state.scene.sessionContext = context;
+
+        if (streaming) {
+            return await readEventStream(response, options.onDelta);
+        }
+
+        const data = await response.json();
+        return data.choices[0].message.content;
     } catch (error) {
-        console.error('对话模块错误:', error);
-    } finally {
-        showLoading(false);
+        console.error('OpenAI API Error:', error);
+        alert(`API 调用失败: ${error.message}\n\n提示：请确保使用 proxy_server.py 启动服务器`);
+        throw error;
     }
-});
+}
 
 // 解析 NPC 响应
 function parseNPCResponse(response, isJson) {
@@ -847,6 +876,34 @@ function addMessage(type, content, npcName = null, emotion = null) {
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
 
+// 显示一条正在流式生成的 NPC 消息，生成结束后由正式解析结果替换
+function createStreamingMessage() {
+    const messagesContainer = document.getElementById('messages');
+    const chatContainer = document.getElementById('chat-container');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message npc streaming';
+    messageDiv.innerHTML = '<div class="content"></div>';
+    messagesContainer.appendChild(messageDiv);
+
+    return {
+        update(text) {
+            messageDiv.querySelector('.content').textContent = text;
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        },
+        remove() {
+            messageDiv.remove();
+        }
+    };
+}
+
+// 流式回调：收到第一段内容时关闭加载遮罩，之后持续更新临时消息
+function streamIntoMessage(streamingMessage) {
+    return (text) => {
+        showLoading(false);
+        streamingMessage.update(text);
+    };
+}
+
 // HTML 转义
 function escapeHtml(text) {
     const div = document.createElement('div');
@@ -876,7 +933,8 @@ document.getElementById('end-dialogue-btn').addEventListener('click', async () =
     showLoading(true);
 
     try {
-        // 调用总结模块
+        // 总结、下一幕和信件由代理的场景结束流水线生成：
+        // 先生成总结，总结完成后下一幕和信件并发生成，各部分完成后立即显示
         const chatHistoryText = state.scene.chatHistory
             .map(msg => `${msg.role === 'player' ? '玩家' : 'NPC'}：${msg.content}`)
             .join('\n\n');
@@ -892,22 +950,9 @@ ${chatHistoryText}
 请总结当前场景的故事发展。
 `;
 
-        const summaryResponse = await callOpenAI(
-            state.modules.summary.prompt,
-            summaryPrompt,
-            state.modules.summary.jsonMode
-        );
-
-        // 显示总结
-        document.getElementById('scene-summary').textContent = summaryResponse;
-        document.getElementById('scene-summary').classList.remove('loading');
-
-        // 更新故事总结
-        const updatedStorySummary = summaryResponse;
-
-        // 调用故事模块
+        // 下一幕和信件的提示词中 {{summary}} 由代理替换为生成的总结
         const storyPrompt = `
-上一幕的故事总结：${updatedStorySummary}
+上一幕的故事总结：{{summary}}
 
 NPC列表：${state.scene.npcList}
 
@@ -936,21 +981,92 @@ ${state.modules.story.jsonMode ?
 情绪动画从以下选择：高兴、难过、失望、振奋、绝望、疯狂、希望、平静`}
 `;
 
-        const storyResponse = await callOpenAI(
-            state.modules.story.prompt,
-            storyPrompt,
-            state.modules.story.jsonMode
-        );
-
-        // 显示下一幕
-        displayNextScene(storyResponse, state.modules.story.jsonMode, updatedStorySummary);
+        const sections = {
+            summary: {
+                system_prompt: state.modules.summary.prompt,
+                prompt: summaryPrompt,
+                json_mode: state.modules.summary.jsonMode
+            },
+            story: {
+                system_prompt: state.modules.story.prompt,
+                prompt: storyPrompt,
+                json_mode: state.modules.story.jsonMode
+            }
+        };
 
         // 生成信件（如果启用）
         if (state.modules.letter.enabled) {
-            console.log('🔧 开始生成NPC信件...');
-            generateNPCLetter(chatHistoryText, updatedStorySummary);
+            sections.letter = {
+                system_prompt: state.modules.letter.prompt,
+                prompt: buildLetterPrompt(chatHistoryText, '{{summary}}'),
+                json_mode: state.modules.letter.jsonMode
+            };
         }
 
+        const summaryElement = document.getElementById('scene-summary');
+        let summaryText = '';
+        let updatedStorySummary = '';
+
+        // 同时结束对话会话：代理提交本场景尚未写入记忆的对话
+        const sessionId = state.scene.sessionId;
+        state.scene.sessionId = null;
+
+        await callScenePipeline(sections, sessionId, (event) => {
+            if (event.delta !== undefined) {
+                summaryText += event.delta;
+                summaryElement.classList.remove('loading');
+                summaryElement.textContent = summaryText;
+                return;
+            }
+
+            const error = event.status === 200 ? null : new Error(`API Error: ${event.error?.message || `HTTP ${event.status}`}`);
+            switch (event.section) {
+                case 'summary':
+                    if (error) {
+                        console.error('生成总结错误:', error);
+                        summaryElement.classList.remove('loading');
+                        summaryElement.textContent = '生成失败，请重试';
+                        break;
+                    }
+                    // 显示总结，并作为更新后的故事总结
+                    summaryElement.textContent = event.content;
+                    summaryElement.classList.remove('loading');
+                    updatedStorySummary = event.content;
+                    if (sections.letter) {
+                        console.log('🔧 开始生成NPC信件...');
+                        const letterContainer = document.getElementById('npc-letter');
+                        letterContainer.classList.add('loading');
+                        letterContainer.innerHTML = '<p>📝 正在撰写信件...</p>';
+                    }
+                    break;
+                case 'story':
+                    if (error) {
+                        console.error('生成下一幕错误:', error);
+                        document.getElementById('next-scene').classList.remove('loading');
+                        document.getElementById('next-scene').textContent = '生成失败，请重试';
+                    } else {
+                        displayNextScene(event.content, state.modules.story.jsonMode, updatedStorySummary);
+                    }
+                    break;
+                case 'letter':
+                    if (error) {
+                        console.error('生成信件错误:', error);
+                        showLetterError();
+                    } else {
+                        displayNPCLetter(event.content, state.modules.letter.jsonMode);
+                    }
+                    break;
+                case 'memory':
+                    if (event.memory) {
+                        state.playerMemory = event.memory;
+                    }
+                    if (event.memory_update) {
+                        console.log('✅ 玩家记忆更新完成，写入', event.memory_update.changed, '项');
+                    }
+                    break;
+            }
+        });
+
     } catch (error) {
         console.error('生成总结/故事错误:', error);
         document.getElementById('scene-summary').textContent = '生成失败，请重试';
@@ -1029,20 +1145,18 @@ function displayNextScene(response, isJson, updatedStorySummary) {
         nextSceneDiv.innerHTML = html || escapeHtml(response);
     }
 
+    // 故事模块没有给出下一幕的初始对话时，提前预取下一幕的问候
+    if (!state.scene.nextNPCDialogue) {
+        prefetchGreeting(state.scene.nextStorySummary, state.scene.npcList, state.scene.npcGoals);
+    }
+
     // 启用下一幕按钮
     document.getElementById('next-scene-btn').disabled = false;
 }
 
-// 生成NPC信件
-async function generateNPCLetter(chatHistory, sceneSummary) {
-    const letterContainer = document.getElementById('npc-letter');
-    
-    // 显示加载状态
-    letterContainer.classList.add('loading');
-    letterContainer.innerHTML = '<p>📝 正在撰写信件...</p>';
-    
-    try {
-        const letterPrompt = `
+// 构造NPC信件的请求内容
+function buildLetterPrompt(chatHistory, sceneSummary) {
+    return `
 故事总结：${sceneSummary}
 
 对话记录：
@@ -1071,21 +1185,13 @@ ${state.modules.letter.jsonMode ?
 【信件内容】
 信件正文...`}
 `;
+}
 
-        const letterResponse = await callOpenAI(
-            state.modules.letter.prompt,
-            letterPrompt,
-            state.modules.letter.jsonMode
-        );
-
-        // 显示信件
-        displayNPCLetter(letterResponse, state.modules.letter.jsonMode);
-
-    } catch (error) {
-        console.error('生成信件错误:', error);
-        letterContainer.classList.remove('loading');
-        letterContainer.innerHTML = '<p style="color: #e74c3c;">信件生成失败</p>';
-    }
+// 信件生成失败
+function showLetterError() {
+    const letterContainer = document.getElementById('npc-letter');
+    letterContainer.classList.remove('loading');
+    letterContainer.innerHTML = '<p style="color: #e74c3c;">信件生成失败</p>';
 }
 
 // 显示NPC信件
@@ -1374,8 +1480,8 @@ document.getElementById('export-memory-btn').addEventListener('click', () => {
     exportPlayerMemory();
 });
 
-document.getElementById('clear-memory-btn').addEventListener('click', () => {
-    if (clearPlayerMemory()) {
+document.getElementById('clear-memory-btn').addEventListener('click', async () => {
+    if (await clearPlayerMemory()) {
         closeMemoryModal();
     }
 });
@@ -1391,8 +1497,12 @@ document.getElementById('memory-modal').addEventListener('click', (e) => {
 // 初始化
 // ============================================
 
-// 初始化玩家记忆
-state.playerMemory = loadPlayerMemory();
+// 初始化玩家记忆（先使用空白记忆，服务器返回后替换）
+state.playerId = getPlayerId();
+state.playerMemory = createEmptyMemory();
+loadPlayerMemory().then(memory => {
+    state.playerMemory = memory;
+});
 
 // 初始化各模块的JSON Mode自动提示
 console.log('🔧 正在初始化 JSON Mode 自动提示...');
@@ -0,0 +1,700 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理服务器基准测试
+
+用法：
+    python bench_proxy.py concurrency --requests 40 --concurrency 20 --delay 0.5
+    python bench_proxy.py players --players 50 --scenes 2 --turns 5 --output results.json
+    python bench_proxy.py players --players 50 --compare results.json
+    python bench_proxy.py passthrough --sizes 10,100,1000 --requests 100
+
+concurrency: 对比单线程（旧）与并发模式的吞吐量。
+上游使用 mock_openai_server.py，每个请求固定延迟 --delay 秒，模拟 OpenAI 的生成耗时。
+
+players: 模拟多名玩家按 app.js 的请求顺序游玩（预取的开场问候，每轮对话，记忆更新由代理合并提交，
+场景结束时 总结 → 故事 + 信件），代理和模拟上游都在独立进程中运行。
+输出吞吐量、各类请求的 p50/p95/p99 延迟、代理进程的 CPU 时间和内存，
+并可保存为 JSON，用 --compare 与之前的结果对比。
+
+passthrough: 用带大段对话历史的请求（默认 10 KB ~ 1 MB）对比 /api/openai（解析并重新编码 JSON）
+与 /api/openai/passthrough（原样转发）每个请求消耗的代理 CPU 时间。
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import proxy_server
+from mock_openai_server import MockConfig, create_mock_server
+
+
+def _start_in_thread(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def _post_json(url, payload):
+    data = json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(req, timeout=600) as response:
+        response.read()
+        return response.status
+
+
+def run_load(url, total_requests, concurrency):
+    """以指定并发数发送请求，返回 (耗时秒数, 成功数)"""
+    payload = {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": "你好"}],
+        "api_key": "sk-bench",
+    }
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        statuses = list(pool.map(lambda _: _post_json(url, payload), range(total_requests)))
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(1 for s in statuses if s == 200)
+
+
+def bench_concurrency(args):
+    upstream = create_mock_server(config=MockConfig(latency=f'fixed:{args.delay}'))
+    _start_in_thread(upstream)
+    proxy_server.UPSTREAM_ROUTER = proxy_server.UpstreamRouter(
+        [proxy_server.Upstream('mock', f"http://127.0.0.1:{upstream.server_address[1]}/v1")])
+
+    print(f"上游延迟 {args.delay}s，请求数 {args.requests}，客户端并发 {args.concurrency}")
+    print(f"{'模式':<12}{'耗时(s)':>10}{'吞吐(req/s)':>14}{'成功':>8}")
+
+    results = {}
+    for mode in ('serial', 'concurrent'):
+        httpd = proxy_server.create_server(0, serial=(mode == 'serial'), max_workers=args.max_workers)
+        _start_in_thread(httpd)
+        url = f"http://127.0.0.1:{httpd.server_address[1]}/api/openai"
+        elapsed, ok = run_load(url, args.requests, args.concurrency)
+        httpd.shutdown()
+        httpd.server_close()
+        results[mode] = args.requests / elapsed
+        print(f"{mode:<12}{elapsed:>10.2f}{results[mode]:>14.2f}{ok:>8}")
+
+    print(f"加速比: {results['concurrent'] / results['serial']:.1f}x")
+    upstream.shutdown()
+
+
+# ============================================
+# 模拟玩家负载
+# ============================================
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 与 app.js 中各模块提示词保持相同的特征文本，模拟服务据此返回对应格式
+SCENE = {
+    'story_summary': '王国边境的小镇上，接连有旅人失踪，镇长请来了冒险者调查。',
+    'npc_list': '镇长艾伦、铁匠玛莎、流浪诗人洛克',
+    'npc_goals': '镇长想尽快平息恐慌；玛莎在隐瞒她弟弟的下落；洛克想把这件事写成诗。',
+}
+
+PLAYER_LINES = [
+    '你好，我是来调查失踪案的冒险者。',
+    '最近有没有陌生人来过镇上？',
+    '玛莎，你看起来有心事。',
+    '洛克，你在森林边见过什么吗？',
+    '我答应你们，一定会找到失踪的人。',
+    '这把旧钥匙是从哪里来的？',
+]
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"端口 {port} 在 {timeout} 秒内没有开始监听")
+
+
+def _child_pids(pid):
+    """进程的直接子进程（多进程模式下的工作进程）"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _process_usage(pid):
+    """读取进程及其子进程合计的 CPU 时间（秒）和内存（KB），仅支持 Linux，其他系统返回 None"""
+    try:
+        usage = {'cpu_seconds': 0.0, 'rss_kb': 0, 'peak_rss_kb': 0}
+        for member in [pid] + _child_pids(pid):
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime + stime，以及已退出并被回收的子进程的 cutime + cstime
+            usage['cpu_seconds'] += sum(int(v) for v in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key == 'VmRSS':
+                        usage['rss_kb'] += int(value.split()[0])
+                    elif key == 'VmHWM':
+                        usage['peak_rss_kb'] += int(value.split()[0])
+        return usage
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def percentile(values, pct):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), int(round(pct / 100 * len(ordered) + 0.5))))
+    return ordered[rank - 1]
+
+
+class LatencyRecorder:
+    """线程安全地记录每个请求的类型、耗时和状态码"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+
+    def add(self, kind, seconds, status):
+        with self._lock:
+            self.samples.append((kind, seconds, status))
+
+    def summary(self):
+        with self._lock:
+            samples = list(self.samples)
+        by_kind = {}
+        for kind, seconds, status in samples:
+            by_kind.setdefault(kind, []).append((seconds, status))
+        by_kind['all'] = [(seconds, status) for _kind, seconds, status in samples]
+        result = {}
+        for kind, items in sorted(by_kind.items()):
+            latencies = [seconds for seconds, status in items if status == 200]
+            result[kind] = {
+                'count': len(items),
+                'errors': sum(1 for _seconds, status in items if status != 200),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+            }
+        return result
+
+
+class SimulatedPlayer:
+    """按 app.js 的请求顺序游玩的模拟玩家"""
+
+    def __init__(self, port, index, args, recorder):
+        self.port = port
+        self.args = args
+        self.recorder = recorder
+        self.random = random.Random(args.seed * 1000 + index)
+        self.history = []
+        self.session_id = None
+        self.player_id = f'bench-{args.seed}-{index}'
+        self.json_mode = args.json_mode
+        self._idle = []     # 空闲的持久连接（与浏览器一样，请求之间复用）
+
+    def post(self, kind, system_prompt, user_content, json_mode=None):
+        """发送一次 /api/openai 请求，返回回复文本（失败时返回空字符串）"""
+        json_mode = self.json_mode if json_mode is None else json_mode
+        messages = [{'role': 'system', 'content': system_prompt}]
+        if isinstance(user_content, str):
+            messages.append({'role': 'user', 'content': user_content})
+        else:
+            messages.extend(user_content)
+        body = {'model': self.args.model, 'messages': messages, 'temperature': 0.7, 'api_key': 'sk-bench'}
+        if json_mode:
+            body['response_format'] = {'type': 'json_object'}
+        return self._completion_text(self.send(kind, '/api/openai', body))
+
+    def request(self, path, body):
+        """POST 一个 JSON 请求，返回 (连接, 响应)
+
+        默认复用空闲的持久连接；复用的连接已被代理关闭（空闲超时、达到请求数上限）时与浏览器一样换一条新连接重试。
+        """
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        while True:
+            reused = bool(self._idle)
+            conn = self._idle.pop() if reused else \
+                http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.args.timeout)
+            try:
+                conn.request('POST', path, body=data, headers={'Content-Type': 'application/json'})
+                return conn, conn.getresponse()
+            except ConnectionError:
+                conn.close()
+                if not reused:
+                    raise
+
+    def release(self, conn, response):
+        """响应读完后归还连接；--no-keepalive 或代理要求关闭时断开"""
+        if self.args.keepalive and response is not None and response.isclosed() and not response.will_close:
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+    def send(self, kind, path, body):
+        """POST 一个 JSON 请求并记录延迟，返回 (状态码, 解析后的响应)；kind 为 None 时不记录"""
+        started = time.perf_counter()
+        status = 0
+        data = None
+        conn = response = None
+        try:
+            conn, response = self.request(path, body)
+            raw = response.read()
+            status = response.status
+            data = json.loads(raw)
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        finally:
+            if conn is not None:
+                self.release(conn, response)
+        if kind is not None:
+            self.recorder.add(kind, time.perf_counter() - started, status)
+        return status, data
+
+    @staticmethod
+    def _completion_text(result):
+        status, data = result
+        try:
+            return data['choices'][0]['message']['content'] if status == 200 else ''
+        except (KeyError, IndexError, TypeError):
+            return ''
+
+    def post_scene_end(self, sections, session_id):
+        """发送一次 /api/scene/end 请求，sections 为 {段名: (system prompt, 用户内容)}
+
+        每段的延迟记为从发出请求到收到它完成那一行的时间；带 session_id 时记忆更新记为 memory。
+        """
+        body = {'api_key': 'sk-bench', 'model': self.args.model}
+        for name, (system_prompt, prompt) in sections.items():
+            body[name] = {'system_prompt': system_prompt, 'prompt': prompt, 'json_mode': self.json_mode}
+        kinds = list(sections)
+        if session_id is not None:
+            body['session_id'] = session_id
+            kinds.append('memory')
+
+        started = time.perf_counter()
+        pending = set(kinds)
+        conn = response = None
+        try:
+            conn, response = self.request('/api/scene/end', body)
+            while pending and response.status == 200:
+                line = response.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if 'status' in event:
+                    pending.discard(event['section'])
+                    self.recorder.add(event['section'], time.perf_counter() - started, event['status'])
+            response.read()
+        except (OSError, http.client.HTTPException, ValueError, KeyError):
+            pass
+        finally:
+            if conn is not None:
+                self.release(conn, response)
+        for kind in pending:
+            self.recorder.add(kind, time.perf_counter() - started, 0)
+
+    def scene_context(self):
+        return (f"故事背景：{SCENE['story_summary']}\n\nNPC列表：{SCENE['npc_list']}\n\n"
+                f"NPC目标：{SCENE['npc_goals']}\n")
+
+    def play(self):
+        try:
+            for _scene in range(self.args.scenes):
+                self.history = []
+                self.session_id = None
+                self.history.append({'role': 'npc', 'content': self.greeting()})
+
+                for _turn in range(self.args.turns):
+                    time.sleep(self.random.uniform(0, self.args.think_time))
+                    self.dialogue_turn(self.random.choice(PLAYER_LINES))
+
+                self.end_scene()
+        finally:
+            self.close()
+
+    def greeting(self):
+        # 与 app.js 相同：场景信息填好时开始预取问候，玩家点击"开始对话"时取走，没有可用结果时改为正常请求
+        body = {'model': self.args.model, 'temperature': 0.7,
+                'messages': [{'role': 'system', 'content': '你是对话模块。'},
+                             {'role': 'user', 'content': self.scene_context() + '\n请选择一个最合适的NPC来主动问候玩家。'}]}
+        if self.json_mode:
+            body['response_format'] = {'type': 'json_object'}
+        prefetch = {'api_key': 'sk-bench', 'key': 'greeting', 'request': body}
+        self.send(None, '/api/prefetch', prefetch)
+        time.sleep(self.random.uniform(0, self.args.think_time))
+
+        started = time.perf_counter()
+        status, data = self.send(None, '/api/prefetch/take', prefetch)
+        if status == 200:
+            self.recorder.add('greeting', time.perf_counter() - started, status)
+            return data['content']
+        return self.post('greeting', body['messages'][0]['content'], body['messages'][1:])
+
+    def dialogue_turn(self, player_line):
+        # 与 app.js 相同：第一轮创建服务器端会话，之后每轮只发送玩家台词
+        if self.session_id is None:
+            body = {'api_key': 'sk-bench', 'model': self.args.model, 'temperature': 0.7,
+                    'system_prompt': '你是对话模块。',
+                    'context': self.scene_context()
+                    + '\n请根据上述信息和对话历史，决定让几个NPC回应（1个、2个或更多都可以）。',
+                    'history': self.history[-20:],
+                    'player_id': self.player_id, 'npc_names': SCENE['npc_list'],
+                    'memory': {'system_prompt': '你是记忆模块。', 'scene': SCENE['story_summary'][:100]},
+                    'summary': {'system_prompt': '你是总结模块。',
+                                'background': f"故事背景：{SCENE['story_summary']}\n\nNPC目标：{SCENE['npc_goals']}"}}
+            if self.json_mode:
+                body['response_format'] = {'type': 'json_object'}
+            status, data = self.send(None, '/api/session', body)
+            self.session_id = data['session_id'] if status == 200 else None
+        if self.session_id is None:
+            self.recorder.add('dialogue', 0.0, 0)
+            reply = ''
+        else:
+            reply = self._completion_text(
+                self.send('dialogue', f'/api/session/{self.session_id}/turn', {'content': player_line}))
+        self.history.append({'role': 'player', 'content': player_line})
+        self.history.append({'role': 'npc', 'content': reply})
+
+    def end_scene(self):
+        # 与 app.js 相同：通过 /api/scene/end 生成总结，再并发生成下一幕和信件，同时结束会话提交记忆更新
+        chat = '\n\n'.join(f"{'玩家' if m['role'] == 'player' else 'NPC'}：{m['content']}" for m in self.history)
+        self.post_scene_end({
+            'summary': ('你是总结模块。',
+                        f"故事背景：{SCENE['story_summary']}\n\n聊天记录：\n{chat}\n\n请总结当前场景的故事发展。"),
+            'story': ('你是故事模块。',
+                      f"上一幕的故事总结：{{{{summary}}}}\n\nNPC列表：{SCENE['npc_list']}\n\n请根据上述信息：\n1. 续写下一幕发生的事情"),
+            'letter': ('你是信件模块。',
+                       f"故事总结：{{{{summary}}}}\n\n对话记录：\n{chat}\n\nNPC列表：{SCENE['npc_list']}\n\n"
+                       f"请选择一个最合适的NPC，以TA的口吻给玩家写一封信。"),
+        }, self.session_id)
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _start_mock(port, args):
+    """在独立进程中启动模拟上游"""
+    return subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, 'mock_openai_server.py'), '--port', str(port),
+         '--latency', args.latency, '--tokens-per-second', str(args.tokens_per_second),
+         '--error-rate', str(args.error_rate), '--seed', str(args.seed)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _start_proxy(port, mock_port, memory_dir, proxy_args):
+    """在独立进程中启动代理，玩家记忆写入临时目录中的数据库，不影响真实存档"""
+    return subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, 'proxy_server.py'), '--port', str(port), '--no-browser',
+         '--pool-warm', '0', '--upstream-base-url', f'http://127.0.0.1:{mock_port}/v1',
+         '--memory-db', os.path.join(memory_dir, 'memory.sqlite')] + proxy_args.split(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_players(args):
+    mock_port = _free_port()
+    proxy_port = _free_port()
+    mock = _start_mock(mock_port, args)
+    memory_dir = tempfile.TemporaryDirectory()
+    proxy = _start_proxy(proxy_port, mock_port, memory_dir.name, args.proxy_args)
+    try:
+        _wait_for_port(mock_port)
+        _wait_for_port(proxy_port)
+        recorder = LatencyRecorder()
+        players = [SimulatedPlayer(proxy_port, i, args, recorder) for i in range(args.players)]
+
+        usage_before = _process_usage(proxy.pid)
+        started = time.perf_counter()
+        threads = [threading.Thread(target=player.play) for player in players]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        usage_after = _process_usage(proxy.pid)
+        connections = _client_connection_stats(proxy_port)
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+        memory_dir.cleanup()
+
+    latency = recorder.summary()
+    total = latency['all']['count']
+    result = {
+        'benchmark': 'players',
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {k: v for k, v in vars(args).items() if k != 'func'},
+        'elapsed_seconds': elapsed,
+        'requests': total,
+        'throughput_rps': total / elapsed if elapsed else None,
+        'latency': latency,
+        'proxy': None,
+        'client_connections': connections,
+    }
+    if usage_before and usage_after:
+        cpu = usage_after['cpu_seconds'] - usage_before['cpu_seconds']
+        result['proxy'] = {
+            'cpu_seconds': cpu,
+            'cpu_ms_per_request': cpu * 1000 / total if total else None,
+            'rss_kb': usage_after['rss_kb'],
+            'peak_rss_kb': usage_after['peak_rss_kb'],
+        }
+
+    print_players_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), result)
+
+
+def _client_connection_stats(port):
+    """从代理的 /metrics 读取浏览器连接数和连接复用率，读取失败时返回 None"""
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    connections = 0
+    requests = {'true': 0, 'false': 0}
+    for line in text.splitlines():
+        if line.startswith('proxy_client_connections_total '):
+            connections = float(line.split()[-1])
+        elif line.startswith('proxy_client_requests_total{reused="'):
+            requests[line.split('"')[1]] = float(line.split()[-1])
+    total = requests['true'] + requests['false']
+    return {'connections': connections, 'requests': total,
+            'reuse_rate': requests['true'] / total if total else None}
+
+
+def history_request(model, size):
+    """构造一个 UTF-8 JSON 编码后约 size 字节、带长对话历史的 Chat Completions 请求"""
+    messages = [{'role': 'system', 'content': '你是一个 RPG 游戏中的 NPC。'},
+                {'role': 'user', 'content': SCENE['story_summary'] + SCENE['npc_list'] + SCENE['npc_goals']}]
+    request = {'model': model, 'messages': messages, 'temperature': 0.7}
+    reply = {'role': 'assistant', 'content': '镇长艾伦叹了口气：“失踪的人都是在森林边最后一次被看到的，我们已经派人找过好几次了。”'}
+    encoded = len(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+    i = 0
+    while encoded < size:
+        line = {'role': 'user', 'content': '玩家：' + PLAYER_LINES[i % len(PLAYER_LINES)]}
+        messages.extend((line, reply))
+        # 每条消息前还有 ", " 分隔符
+        encoded += len(json.dumps([line, reply], ensure_ascii=False).encode('utf-8')) + 2
+        i += 1
+    return request
+
+
+def _post_raw(port, path, body, headers, timeout):
+    """POST 已编码的请求体，返回 (状态码, 耗时秒数)；连接出错时状态码为 0"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    started = time.perf_counter()
+    status = 0
+    try:
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        status = response.status
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        conn.close()
+    return status, time.perf_counter() - started
+
+
+def bench_passthrough(args):
+    mock_port = _free_port()
+    proxy_port = _free_port()
+    mock = _start_mock(mock_port, args)
+    memory_dir = tempfile.TemporaryDirectory()
+    proxy = _start_proxy(proxy_port, mock_port, memory_dir.name, args.proxy_args)
+    results = []
+    try:
+        _wait_for_port(mock_port)
+        _wait_for_port(proxy_port)
+        for size_kb in args.sizes:
+            request = history_request(args.model, int(size_kb * 1024))
+            modes = (
+                ('parsed', '/api/openai', dict(request, api_key='sk-bench'), {}),
+                ('passthrough', '/api/openai/passthrough', request, {'Authorization': 'Bearer sk-bench'}),
+            )
+            for mode, path, payload, extra_headers in modes:
+                # 与浏览器的 JSON.stringify 一样不转义中文
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                headers = dict(extra_headers, **{'Content-Type': 'application/json'})
+                _post_raw(proxy_port, path, body, headers, args.timeout)   # 预热连接池
+                usage_before = _process_usage(proxy.pid)
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    samples = list(pool.map(lambda _: _post_raw(proxy_port, path, body, headers, args.timeout),
+                                            range(args.requests)))
+                usage_after = _process_usage(proxy.pid)
+                cpu_ms = None
+                if usage_before and usage_after:
+                    cpu_ms = (usage_after['cpu_seconds'] - usage_before['cpu_seconds']) * 1000 / args.requests
+                results.append({
+                    'size_kb': size_kb,
+                    'body_bytes': len(body),
+                    'mode': mode,
+                    'cpu_ms_per_request': cpu_ms,
+                    'p50': percentile([elapsed for _, elapsed in samples], 50),
+                    'errors': sum(1 for status, _ in samples if status != 200),
+                })
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+        memory_dir.cleanup()
+
+    print(f"每种大小、每种模式 {args.requests} 个请求，客户端并发 {args.concurrency}，上游延迟 {args.latency}")
+    print(f"{'大小(KB)':<10}{'模式':<14}{'CPU(ms/请求)':>14}{'p50(ms)':>10}{'错误':>6}")
+    for row in results:
+        cpu = '-' if row['cpu_ms_per_request'] is None else f"{row['cpu_ms_per_request']:.2f}"
+        print(f"{row['body_bytes'] / 1024:<10.0f}{row['mode']:<14}{cpu:>14}{_ms(row['p50']):>10}{row['errors']:>6}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'benchmark': 'passthrough', 'commit': _git_commit(), 'results': results}, f,
+                      ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+
+def _ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def print_players_report(result):
+    params = result['params']
+    print(f"玩家 {params['players']} 名 × {params['scenes']} 幕 × {params['turns']} 轮，"
+          f"上游延迟 {params['latency']}，代理参数 '{params['proxy_args']}'")
+    print(f"总请求 {result['requests']}，耗时 {result['elapsed_seconds']:.2f}s，"
+          f"吞吐 {result['throughput_rps']:.1f} req/s")
+    print(f"{'类型':<10}{'数量':>7}{'错误':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for kind, stats in result['latency'].items():
+        print(f"{kind:<10}{stats['count']:>7}{stats['errors']:>6}"
+              f"{_ms(stats['p50']):>10}{_ms(stats['p95']):>10}{_ms(stats['p99']):>10}")
+    proxy = result['proxy']
+    if proxy:
+        print(f"代理进程: CPU {proxy['cpu_seconds']:.2f}s（{proxy['cpu_ms_per_request']:.2f} ms/请求），"
+              f"RSS {proxy['rss_kb'] / 1024:.1f} MB，峰值 {proxy['peak_rss_kb'] / 1024:.1f} MB")
+    else:
+        print("代理进程: 当前系统不支持读取 CPU/内存（仅支持 Linux）")
+    connections = result.get('client_connections')
+    if connections and connections['reuse_rate'] is not None:
+        print(f"客户端连接: {connections['connections']:.0f} 条，{connections['requests']:.0f} 个请求，"
+              f"复用率 {connections['reuse_rate']:.1%}")
+
+
+def print_comparison(baseline, current):
+    """打印与基线结果的对比（正数表示变慢/变多）"""
+    def delta(old, new):
+        if old in (None, 0) or new is None:
+            return '-'
+        return f'{(new - old) / old:+.1%}'
+
+    print(f"\n与基线对比（基线提交 {baseline.get('commit')}，当前提交 {current.get('commit')}）：")
+    print(f"吞吐: {baseline['throughput_rps']:.1f} → {current['throughput_rps']:.1f} req/s "
+          f"({delta(baseline['throughput_rps'], current['throughput_rps'])})")
+    for kind, stats in current['latency'].items():
+        old = baseline['latency'].get(kind)
+        if old:
+            print(f"{kind:<10} p50 {delta(old['p50'], stats['p50']):>8}  p95 {delta(old['p95'], stats['p95']):>8}"
+                  f"  p99 {delta(old['p99'], stats['p99']):>8}")
+    if baseline.get('proxy') and current.get('proxy'):
+        print(f"CPU/请求: {delta(baseline['proxy']['cpu_ms_per_request'], current['proxy']['cpu_ms_per_request'])}"
+              f"  峰值 RSS: {delta(baseline['proxy']['peak_rss_kb'], current['proxy']['peak_rss_kb'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代理服务器基准测试")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('concurrency', help="对比单线程与并发模式的吞吐量")
+    p.add_argument('--requests', type=int, default=40, help="总请求数")
+    p.add_argument('--concurrency', type=int, default=20, help="客户端并发数")
+    p.add_argument('--delay', type=float, default=0.5, help="模拟上游每个请求的延迟（秒）")
+    p.add_argument('--max-workers', type=int, default=proxy_server.DEFAULT_MAX_WORKERS,
+                   help="并发模式的最大并发请求数")
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser('players', help="模拟多名玩家的完整游戏流程")
+    p.add_argument('--players', type=int, default=20, help="同时游玩的玩家数")
+    p.add_argument('--scenes', type=int, default=2, help="每名玩家游玩的场景数")
+    p.add_argument('--turns', type=int, default=5, help="每个场景的对话轮数")
+    p.add_argument('--think-time', type=float, default=0.5, help="两轮对话之间的最大思考时间（秒，均匀分布）")
+    p.add_argument('--json-mode', action='store_true', help="对话模块使用 JSON 模式")
+    p.add_argument('--model', default='gpt-4o-mini', help="请求中的模型名")
+    p.add_argument('--latency', default='uniform:0.2,0.6', help="模拟上游的延迟分布")
+    p.add_argument('--tokens-per-second', type=float, default=0.0, help="模拟上游的生成速率")
+    p.add_argument('--error-rate', type=float, default=0.0, help="模拟上游的错误率")
+    p.add_argument('--timeout', type=float, default=120.0, help="单个请求的超时（秒）")
+    p.add_argument('--seed', type=int, default=1, help="随机种子")
+    p.add_argument('--proxy-args', default='', help="传给 proxy_server.py 的额外参数，如 '--cache --coalesce'")
+    p.add_argument('--no-keepalive', dest='keepalive', action='store_false',
+                   help="每个请求使用一条新连接（不复用持久连接，对比用）")
+    p.add_argument('--output', default=None, help="把结果保存为 JSON 文件")
+    p.add_argument('--compare', default=None, help="与之前保存的 JSON 结果对比")
+    p.set_defaults(func=bench_players)
+
+    p = sub.add_parser('passthrough', help="对比解析转发与原样透传每个请求的代理 CPU 时间")
+    p.add_argument('--sizes', type=lambda v: [float(x) for x in v.split(',')], default=[10, 100, 1000],
+                   help="请求体大小（KB，逗号分隔）")
+    p.add_argument('--requests', type=int, default=100, help="每种大小、每种模式的请求数")
+    p.add_argument('--concurrency', type=int, default=4, help="客户端并发数")
+    p.add_argument('--model', default='gpt-4o-mini', help="请求中的模型名")
+    p.add_argument('--latency', default='fixed:0', help="模拟上游的延迟分布")
+    p.add_argument('--tokens-per-second', type=float, default=0.0, help="模拟上游的生成速率")
+    p.add_argument('--error-rate', type=float, default=0.0, help="模拟上游的错误率")
+    p.add_argument('--timeout', type=float, default=120.0, help="单个请求的超时（秒）")
+    p.add_argument('--seed', type=int, default=1, help="随机种子")
+    p.add_argument('--proxy-args', default='', help="传给 proxy_server.py 的额外参数")
+    p.add_argument('--output', default=None, help="把结果保存为 JSON 文件")
+    p.set_defaults(func=bench_passthrough)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
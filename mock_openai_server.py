@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟 OpenAI Chat Completions 服务
+
+用于在离线环境中对代理服务器和游戏流程做压力测试，不消耗真实额度。
+支持流式输出（SSE）、response_format: json_object、可配置的延迟分布、
+token 生成速率和错误注入，并能针对对话、总结、故事、记忆、信件各模块的
+提示词返回格式合理的内容。
+
+用法：
+    python mock_openai_server.py --port 8001 --latency uniform:0.2,0.8 --tokens-per-second 40
+    python proxy_server.py --upstream-base-url http://127.0.0.1:8001/v1
+"""
+
+import argparse
+import http.server
+import json
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import uuid
+
+# 各模块提示词中的特征文本 -> 模块名
+MODULE_MARKERS = (
+    ('主动问候玩家', 'greeting'),
+    ('决定让几个NPC回应', 'dialogue'),
+    ('请总结当前场景', 'summary'),
+    ('续写下一幕', 'story'),
+    ('更新玩家记忆', 'memory'),
+    ('写一封信', 'letter'),
+)
+
+EMOTIONS = ['高兴', '难过', '失望', '振奋', '绝望', '疯狂', '希望', '平静']
+
+NPC_LINES = [
+    '你来得正是时候，这里最近不太平。',
+    '我听说北边的森林里出现了奇怪的光。',
+    '别急着下结论，先听我把话说完。',
+    '如果你愿意帮忙，我会记住这份人情。',
+    '这件事比你想象的要复杂得多。',
+    '嘘……有人在偷听我们说话。',
+]
+
+
+class MockConfig:
+    """模拟服务的行为配置
+
+    Args:
+        latency: 首个 token 之前的延迟分布，如 "fixed:0.5"、"uniform:0.2,1.0"、
+            "normal:0.5,0.1"、"lognormal:-0.7,0.4"
+        tokens_per_second: 生成速率，0 表示瞬间生成
+        error_rate: 返回 HTTP 错误的概率
+        error_statuses: 注入错误时随机选择的状态码
+        reset_rate: 直接断开连接（不返回任何响应）的概率
+        seed: 随机种子，便于复现
+    """
+
+    def __init__(self, latency='fixed:0', tokens_per_second=0.0, error_rate=0.0,
+                 error_statuses=(429, 500, 503), reset_rate=0.0, seed=None):
+        self.latency_kind, self.latency_params = parse_distribution(latency)
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.reset_rate = reset_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self):
+        with self._lock:
+            kind, params = self.latency_kind, self.latency_params
+            if kind == 'fixed':
+                value = params[0]
+            elif kind == 'uniform':
+                value = self.random.uniform(params[0], params[1])
+            elif kind == 'normal':
+                value = self.random.gauss(params[0], params[1])
+            else:
+                value = self.random.lognormvariate(params[0], params[1])
+        return max(0.0, value)
+
+    def roll(self, probability):
+        with self._lock:
+            return self.random.random() < probability
+
+    def choice(self, items):
+        with self._lock:
+            return self.random.choice(items)
+
+
+def parse_distribution(spec):
+    """解析 "类型:参数1,参数2" 形式的延迟分布"""
+    kind, _, params = spec.partition(':')
+    kind = kind.strip().lower()
+    values = [float(p) for p in params.split(',') if p.strip()] if params else []
+    expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+    if kind not in expected or len(values) != expected[kind]:
+        raise ValueError(f"无效的延迟分布: {spec}（示例: fixed:0.5, uniform:0.2,1.0, normal:0.5,0.1, lognormal:-0.7,0.4）")
+    return kind, values
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数（中文约每字一个 token）"""
+    return max(1, len(text) * 2 // 3)
+
+
+def _find_line(text, label):
+    match = re.search(label + r'[:：]\s*(.+)', text)
+    return match.group(1).strip() if match else ''
+
+
+def _npc_names(text):
+    names = [n.strip() for n in re.split(r'[、,，;；/\s]+', _find_line(text, 'NPC列表')) if n.strip()]
+    return names or ['神秘人']
+
+
+def _player_line(messages):
+    for message in reversed(messages):
+        content = message.get('content') or ''
+        if message.get('role') == 'user' and content.startswith('玩家：'):
+            return content[3:].strip()
+    return ''
+
+
+def detect_module(prompt_text):
+    for marker, module in MODULE_MARKERS:
+        if marker in prompt_text:
+            return module
+    return 'generic'
+
+
+def generate_content(messages, json_mode, config):
+    """根据提示词判断模块并生成对应格式的回复"""
+    prompt_text = '\n'.join(str(m.get('content') or '') for m in messages)
+    module = detect_module(prompt_text)
+    npcs = _npc_names(prompt_text)
+    npc = config.choice(npcs)
+    emotion = config.choice(EMOTIONS)
+    player = _player_line(messages)
+    line = config.choice(NPC_LINES)
+
+    if module == 'greeting':
+        content = f'欢迎你，旅行者。{line}'
+        if json_mode:
+            return json.dumps({'npc_name': npc, 'content': content, 'emotion': emotion}, ensure_ascii=False)
+        return f'[{npc}] {content} [情绪：{emotion}]'
+
+    if module == 'dialogue':
+        speakers = npcs[:2] if len(npcs) > 1 and config.roll(0.5) else [npc]
+        replies = []
+        for speaker in speakers:
+            reply = f'你说“{player[:20]}”？{config.choice(NPC_LINES)}' if player else config.choice(NPC_LINES)
+            replies.append({'npc_name': speaker, 'content': reply, 'emotion': config.choice(EMOTIONS)})
+        if json_mode:
+            return json.dumps({'responses': replies}, ensure_ascii=False)
+        return '\n'.join(f"[{r['npc_name']}] {r['content']} [情绪：{r['emotion']}]" for r in replies)
+
+    if module == 'summary':
+        summary = f'玩家与{"、".join(npcs)}进行了交谈，{npc}透露了一些关键线索，局势开始发生变化。'
+        if json_mode:
+            return json.dumps({'summary': summary}, ensure_ascii=False)
+        return summary
+
+    if module == 'story':
+        scene = f'夜幕降临，{npc}带着玩家来到了城外的旧塔，塔顶闪烁着微弱的光芒。'
+        dialogue = f'就是这里了。{line}'
+        if json_mode:
+            return json.dumps({
+                'scene_description': scene,
+                'npc_dialogue': {'npc_name': npc, 'content': dialogue, 'emotion': emotion},
+            }, ensure_ascii=False)
+        return f'【场景描述】\n{scene}\n\n【NPC初始对话】\n[{npc}] {dialogue} [情绪：{emotion}]'
+
+    if module == 'memory':
+        scene = _find_line(prompt_text, '当前场景')[:30]
+        updates = {
+            'new_key_facts': [{'fact': f'玩家提到：{player[:30]}', 'scene': scene}] if player else [],
+            'relationship_updates': {
+                npc: {'relationship': '熟人', 'trust_level': config.choice([4, 5, 6, 7]),
+                      'new_interactions': ['与玩家交谈']}
+            },
+        }
+        return json.dumps(updates, ensure_ascii=False)
+
+    if module == 'letter':
+        letter = f'亲爱的朋友：\n自从那天分别之后，我一直在想你说过的话。{line}\n希望我们很快能再见面。'
+        if json_mode:
+            return json.dumps({'npc_name': npc, 'letter_content': letter}, ensure_ascii=False)
+        return f'【来信者】{npc}\n\n【信件内容】\n{letter}'
+
+    if json_mode:
+        return json.dumps({'content': '这是模拟服务返回的内容。'}, ensure_ascii=False)
+    return '这是模拟服务返回的内容。'
+
+
+class MockOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    """模拟 /v1/chat/completions 和 /v1/models"""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('/v1/models', '/models'):
+            self.send_json(200, {'object': 'list', 'data': [{'id': 'mock-model', 'object': 'model'}]})
+        else:
+            self.send_json(404, {'error': {'message': 'Not Found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self.send_json(404, {'error': {'message': 'Not Found', 'type': 'invalid_request_error'}})
+            return
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_json(401, {'error': {'message': 'Missing API key', 'type': 'invalid_request_error'}})
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_json(400, {'error': {'message': 'Invalid JSON body', 'type': 'invalid_request_error'}})
+            return
+
+        time.sleep(self.config.sample_latency())
+
+        if self.config.roll(self.config.reset_rate):
+            # 模拟连接被重置：不返回任何内容，以 RST 断开
+            self.close_connection = True
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.connection.close()
+            return
+        if self.config.roll(self.config.error_rate):
+            self.send_injected_error()
+            return
+
+        messages = request.get('messages') or []
+        json_mode = (request.get('response_format') or {}).get('type') == 'json_object'
+        content = generate_content(messages, json_mode, self.config)
+        usage = {
+            'prompt_tokens': sum(estimate_tokens(str(m.get('content') or '')) for m in messages),
+            'completion_tokens': estimate_tokens(content),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        model = request.get('model') or 'mock-model'
+
+        if request.get('stream'):
+            include_usage = (request.get('stream_options') or {}).get('include_usage')
+            self.send_stream(model, content, usage if include_usage else None)
+        else:
+            if self.config.tokens_per_second > 0:
+                time.sleep(usage['completion_tokens'] / self.config.tokens_per_second)
+            self.send_json(200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            })
+
+    def send_injected_error(self):
+        status = self.config.choice(self.config.error_statuses)
+        messages = {429: 'Rate limit reached (mock)', 500: 'Internal server error (mock)',
+                    503: 'The server is overloaded (mock)'}
+        headers = {'Retry-After': '1'} if status in (429, 503) else None
+        self.send_json(status, {'error': {'message': messages.get(status, 'Mock error'), 'type': 'server_error'}},
+                       headers)
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, model, content, usage):
+        """按 token 速率逐段发送 chat.completion.chunk 事件（chunked 编码）"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        created = int(time.time())
+
+        def event(delta, finish_reason=None, extra=None):
+            chunk = {
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            if extra:
+                chunk.update(extra)
+            self.write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+
+        event({'role': 'assistant', 'content': ''})
+        step = 2
+        delay = step / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0
+        for i in range(0, len(content), step):
+            if delay:
+                time.sleep(delay)
+            event({'content': content[i:i + step]})
+        event({}, 'stop')
+        if usage:
+            self.write_chunk(('data: ' + json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [], 'usage': usage,
+            }) + '\n\n').encode('utf-8'))
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print(f"[MOCK] {format % args}")
+
+
+def create_mock_server(host='127.0.0.1', port=0, config=None, verbose=False):
+    """创建模拟服务（port 为 0 时自动分配端口），调用方负责 serve_forever"""
+    server = http.server.ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.config = config or MockConfig()
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI Chat Completions 服务")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认 127.0.0.1）")
+    parser.add_argument('--port', type=int, default=8001, help="监听端口（默认 8001）")
+    parser.add_argument('--latency', default='fixed:0',
+                        help="首个 token 前的延迟分布：fixed:秒 | uniform:最小,最大 | normal:均值,标准差 | lognormal:mu,sigma")
+    parser.add_argument('--tokens-per-second', type=float, default=0.0,
+                        help="生成速率（token/秒），0 表示瞬间生成")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回 HTTP 错误的概率（0~1）")
+    parser.add_argument('--error-statuses', default='429,500,503', help="注入错误时使用的状态码，逗号分隔")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="直接断开连接的概率（0~1）")
+    parser.add_argument('--seed', type=int, default=None, help="随机种子")
+    parser.add_argument('--verbose', action='store_true', help="打印每个请求的日志")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        error_statuses=[int(s) for s in args.error_statuses.split(',') if s.strip()],
+        reset_rate=args.reset_rate,
+        seed=args.seed,
+    )
+    server = create_mock_server(args.host, args.port, config, verbose=args.verbose)
+    print(f"[MOCK] 模拟 OpenAI 服务已启动: http://{args.host}:{args.port}/v1")
+    print(f"[MOCK] 延迟 {args.latency}，速率 {args.tokens_per_second:g} token/s，"
+          f"错误率 {args.error_rate:g}，断连率 {args.reset_rate:g}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[MOCK] 已停止")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+上游请求准入控制
+
+- 优先级：玩家正在等待的对话请求优先于总结/故事，其次是后台的记忆更新和信件，推测性预取排在最后
+- 并发上限：同时发往上游的请求数受限，超出的请求按优先级排队，队列有长度上限
+- 限流：每个 API Key 一个令牌桶，与上游配额对应
+
+队列已满或令牌短时间内无法补充时抛出 AdmissionRejected，由调用方返回 429 和 Retry-After。
+"""
+
+import hashlib
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# 请求类别 -> 优先级（数字越小越优先）
+PRIORITY_LEVELS = {
+    'dialogue': 0,
+    'greeting': 0,
+    'summary': 1,
+    'story': 1,
+    'default': 1,
+    'memory': 2,
+    'letter': 2,
+    # 推测性预取可能用不上，排在所有实际请求之后，负载高时最先被挤掉
+    'prefetch': 3,
+}
+
+DEFAULT_PRIORITY_CLASS = 'default'
+
+
+def normalize_priority_class(name):
+    """把请求声明的类别规范化为 PRIORITY_LEVELS 中的名称，未知类别视为 default"""
+    name = (name or '').strip().lower()
+    return name if name in PRIORITY_LEVELS else DEFAULT_PRIORITY_CLASS
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝（队列已满或超出限流）"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """预订一个令牌，返回需要等待的秒数（0 表示立即可用）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def cancel(self):
+        """归还一个未使用的预订"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+class PrioritySlots:
+    """按优先级分配的并发槽位，每个优先级的排队数有上限"""
+
+    def __init__(self, capacity, queue_limit):
+        self.capacity = capacity
+        self.queue_limit = queue_limit
+        self._cond = threading.Condition()
+        self._available = capacity
+        self._waiters = []   # 堆：[优先级, 序号, 状态]
+        self._queued = {}
+        self._sequence = itertools.count()
+
+    def acquire(self, level, timeout):
+        with self._cond:
+            if self._available > 0 and not self._waiters:
+                self._available -= 1
+                return
+            if self._queued.get(level, 0) >= self.queue_limit:
+                raise AdmissionRejected("请求队列已满", retry_after=1)
+            waiter = [level, next(self._sequence), 'waiting']
+            heapq.heappush(self._waiters, waiter)
+            self._queued[level] = self._queued.get(level, 0) + 1
+            deadline = time.monotonic() + timeout
+            while waiter[2] == 'waiting':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    waiter[2] = 'cancelled'
+                    self._queued[level] -= 1
+                    raise AdmissionRejected("排队超时", retry_after=1)
+                self._cond.wait(remaining)
+
+    def try_acquire(self):
+        """不排队：有空闲槽位且没有人在排队时占用一个并返回 True，否则返回 False"""
+        with self._cond:
+            if self._available > 0 and not self._waiters:
+                self._available -= 1
+                return True
+            return False
+
+    def release(self):
+        with self._cond:
+            while self._waiters:
+                waiter = heapq.heappop(self._waiters)
+                if waiter[2] == 'waiting':
+                    # 直接把槽位交给优先级最高的等待者
+                    waiter[2] = 'granted'
+                    self._queued[waiter[0]] -= 1
+                    self._cond.notify_all()
+                    return
+            self._available += 1
+
+    def queued(self):
+        with self._cond:
+            return dict(self._queued)
+
+
+class AdmissionTicket:
+    """一次已准入的上游调用，退出时归还并发槽位"""
+
+    def __init__(self, slots, queue_wait):
+        self._slots = slots
+        self.queue_wait = queue_wait
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        """归还并发槽位（只归还一次）"""
+        if self._slots is not None:
+            self._slots.release()
+            self._slots = None
+
+
+class AdmissionController:
+    """上游准入控制
+
+    Args:
+        max_concurrent: 同时发往上游的请求数上限，0 表示不限制
+        queue_limit: 每个优先级最多排队的请求数
+        queue_timeout: 排队等待的最长时间（秒）
+        rate: 每个 API Key 每秒允许的请求数，0 表示不限流
+        burst: 令牌桶容量
+        max_rate_wait: 等待令牌的最长时间（秒），超过则直接拒绝
+    """
+
+    def __init__(self, max_concurrent=0, queue_limit=64, queue_timeout=30.0,
+                 rate=0.0, burst=10, max_rate_wait=5.0):
+        self.slots = PrioritySlots(max_concurrent, queue_limit) if max_concurrent > 0 else None
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.max_rate_wait = max_rate_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, api_key):
+        key = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def admit(self, api_key, priority_class, max_wait=None):
+        """等待准入，返回 AdmissionTicket（用 with 包住上游调用）
+
+        max_wait 为本次请求最多愿意等待的秒数（例如请求剩余的截止时间），不超过配置的等待上限。
+        """
+        started = time.monotonic()
+        max_rate_wait = self.max_rate_wait if max_wait is None else min(self.max_rate_wait, max_wait)
+        queue_timeout = self.queue_timeout if max_wait is None else min(self.queue_timeout, max_wait)
+        if self.rate > 0:
+            bucket = self._bucket(api_key)
+            wait = bucket.reserve()
+            if wait > max_rate_wait:
+                bucket.cancel()
+                raise AdmissionRejected("超出该 API Key 的请求速率限制", retry_after=wait)
+            if wait > 0:
+                time.sleep(wait)
+
+        if self.slots is not None:
+            timeout = max(0.0, queue_timeout - (time.monotonic() - started))
+            self.slots.acquire(PRIORITY_LEVELS[priority_class], timeout)
+        return AdmissionTicket(self.slots, time.monotonic() - started)
+
+    def try_admit(self, api_key):
+        """不等待的准入（用于对冲请求等可有可无的额外调用）：令牌和并发槽位都立即可用时
+        返回 AdmissionTicket，否则返回 None，不占用任何额度
+        """
+        bucket = None
+        if self.rate > 0:
+            bucket = self._bucket(api_key)
+            if bucket.reserve() > 0:
+                bucket.cancel()
+                return None
+        if self.slots is not None and not self.slots.try_acquire():
+            if bucket is not None:
+                bucket.cancel()
+            return None
+        return AdmissionTicket(self.slots, 0.0)
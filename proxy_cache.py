@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+代理响应缓存与重复请求合并
+
+按请求内容（去掉 api_key）计算哈希作为键，缓存完全相同请求的响应。
+内存层是带 TTL 的 LRU；可选的 SQLite 磁盘层在重启后仍然有效，并限制总大小。
+SingleFlight 把同时进行中的相同请求合并为一次上游调用。
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CachedResponse = namedtuple('CachedResponse', ['content_type', 'body', 'created'])
+
+
+def request_fingerprint(request_data, api_key=None):
+    """计算请求的规范化哈希：键排序、紧凑格式，忽略 api_key
+
+    传入 api_key 时把它的哈希也计入，使不同密钥的请求互不共享结果。
+    """
+    canonical = {k: v for k, v in request_data.items() if k != 'api_key'}
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(encoded.encode('utf-8'))
+    if api_key:
+        digest.update(b'\0' + hashlib.sha256(api_key.encode('utf-8')).digest())
+    return digest.hexdigest()
+
+
+class SqliteCacheTier:
+    """SQLite 磁盘缓存层，超过 max_bytes 时按最久未访问淘汰"""
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " content_type TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._db.commit()
+
+    def get(self, key, ttl):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_type, body, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[2] > ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return CachedResponse(row[0], bytes(row[1]), row[2])
+
+    def put(self, key, entry):
+        size = len(entry.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, entry.content_type, entry.body, size, entry.created, time.time())
+            )
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(total - self.max_bytes)
+            self._db.commit()
+
+    def _evict(self, excess):
+        """删除最久未访问的条目，直到释放 excess 字节"""
+        freed = 0
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if freed >= excess:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            freed += size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ResponseCache:
+    """内存 LRU + TTL 缓存，可选 SQLite 磁盘层
+
+    Args:
+        max_entries: 内存层最多保存的响应数
+        ttl: 缓存有效期（秒）
+        disk: 可选的 SqliteCacheTier
+    """
+
+    def __init__(self, max_entries=256, ttl=600.0, disk=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'disk_hits': 0}
+
+    def get(self, key):
+        """返回未过期的 CachedResponse，没有则返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry.created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry
+                del self._entries[key]
+
+        if self.disk is not None:
+            entry = self.disk.get(key, self.ttl)
+            if entry is not None:
+                with self._lock:
+                    self._store(key, entry)
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                return entry
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key, content_type, body):
+        entry = CachedResponse(content_type, body, time.time())
+        with self._lock:
+            self._store(key, entry)
+        if self.disk is not None:
+            self.disk.put(key, entry)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+class _InFlightCall:
+    """一次正在进行的上游调用"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并同时进行中的相同请求
+
+    第一个请求（leader）真正调用 fn，其余相同键的请求等待并共享它的结果。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {'leaders': 0, 'followers': 0}
+
+    def do(self, key, fn):
+        """执行或等待 fn()，返回 (结果, 是否为共享结果)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+                self._stats['leaders'] += 1
+            else:
+                self._stats['followers'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        """返回统计信息，ratio 为被合并的请求占全部请求的比例"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        total = stats['leaders'] + stats['followers']
+        stats['ratio'] = stats['followers'] / total if total else 0.0
+        return stats
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+客户端断开检测与请求截止时间
+
+玩家关闭页面或重试后，浏览器的连接已经断开，代理却仍在等上游生成完（最长 60 秒），
+白白占用上游额度和工作线程。DisconnectWatcher 用一个后台线程（selectors）同时监视
+所有正在等待上游的客户端连接和请求的截止时间：连接被浏览器关闭或超过截止时间时，
+关闭该请求使用的上游连接，上游随即停止生成，阻塞在上游读写上的工作线程也立即返回。
+"""
+
+import selectors
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from proxy_pool import abort_connection
+
+# 中断原因
+REASON_DISCONNECTED = 'disconnected'
+REASON_DEADLINE = 'deadline'
+
+# recv 时不阻塞（Windows 没有 MSG_DONTWAIT，select 报告可读后 recv 本来也不会阻塞）
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class RequestAborted(Exception):
+    """请求已被中断（客户端断开或超过截止时间）"""
+
+    def __init__(self, reason):
+        super().__init__('客户端已断开' if reason == REASON_DISCONNECTED else '请求超过截止时间')
+        self.reason = reason
+
+
+class CancelScope:
+    """一次可被中断的请求
+
+    Attributes:
+        deadline: 截止时间（time.monotonic()），None 表示没有截止时间
+        reason: 被中断时为中断原因，否则为 None
+        interrupted: 中断时是否关闭了正在使用的上游连接（即上游响应不完整）
+    """
+
+    def __init__(self, watcher, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self.interrupted = False
+        self._watcher = watcher
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._children = []
+        self.sock = None
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时返回 None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self, default):
+        """上游读写超时：不超过默认值，也不超过剩余时间
+
+        比剩余时间略长一点，让截止时间先由 DisconnectWatcher 处理（按超时中断而不是读写超时错误）。
+        """
+        remaining = self.remaining()
+        return default if remaining is None else min(default, remaining + 0.1)
+
+    def watch(self, sock):
+        """开始监视客户端连接（请求体读完之后调用，否则未读的请求体会被当成新数据）"""
+        self._watcher.watch(self, sock)
+
+    def abort(self, reason):
+        """中断请求：关闭正在使用的上游连接；已中断时不做任何事"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            connections = list(self._connections)
+            children = list(self._children)
+            self.interrupted = bool(connections)
+        for conn in connections:
+            abort_connection(conn)
+        for child in children:
+            child.abort(reason)
+
+    def child(self):
+        """派生一个可以单独中断的子 scope（例如对冲请求中的一路），本 scope 中断时子 scope 一并中断"""
+        child = CancelScope(self._watcher, self.deadline)
+        with self._lock:
+            if self.reason is None:
+                self._children.append(child)
+                return child
+        child.abort(self.reason)
+        return child
+
+    def poll(self):
+        """返回中断原因（顺带检查截止时间），未中断时返回 None"""
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.abort(REASON_DEADLINE)
+        return self.reason
+
+    def check(self):
+        """已中断（或已超过截止时间）时抛出 RequestAborted，在开始上游调用之前使用"""
+        if self.poll() is not None:
+            raise RequestAborted(self.reason)
+
+    def check_interrupted(self):
+        """上游响应读完（连接已关闭）后使用：响应是因为中断而提前结束的时抛出 RequestAborted
+
+        响应完整读完后客户端才断开（或才到截止时间）不算中断。
+        """
+        if self.interrupted:
+            raise RequestAborted(self.reason)
+
+    def attach(self, conn):
+        """UpstreamPool.request 的 on_connection：记下上游连接，中断时关闭它"""
+        self.check()
+        with self._lock:
+            if self.reason is None:
+                self._connections.add(conn)
+                return lambda dropped=False: self._detach(conn)
+        raise RequestAborted(self.reason)
+
+    def _detach(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+            return self.reason is not None
+
+
+class DisconnectWatcher:
+    """用一个后台线程监视客户端连接是否断开、请求是否超过截止时间
+
+    用法：
+        with WATCHER.scope(deadline) as scope:
+            ...读完请求体...
+            scope.watch(sock)
+            UPSTREAM_POOL.request(..., timeout=scope.timeout(60), on_connection=scope.attach)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scopes = set()
+        self._pending = []      # 交给后台线程执行的 (操作, 套接字, scope)
+        self._thread = None
+        self._selector = None
+        self._wakeup = None
+
+    @contextmanager
+    def scope(self, deadline=None):
+        scope = CancelScope(self, deadline)
+        with self._lock:
+            self._ensure_thread()
+            self._scopes.add(scope)
+        if deadline is not None:
+            self._wake()
+        try:
+            yield scope
+        finally:
+            with self._lock:
+                self._scopes.discard(scope)
+                if scope.sock is not None:
+                    self._pending.append(('remove', scope.sock, scope))
+            if scope.sock is not None:
+                self._wake()
+
+    def watch(self, scope, sock):
+        with self._lock:
+            if scope.sock is not None:
+                return
+            scope.sock = sock
+            self._pending.append(('add', sock, scope))
+        self._wake()
+
+    def _ensure_thread(self):
+        """（持有锁）第一次使用时启动后台线程"""
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        receiver, self._wakeup = socket.socketpair()
+        receiver.setblocking(False)
+        self._wakeup.setblocking(False)
+        self._selector.register(receiver, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        try:
+            self._wakeup.send(b'\0')
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            for key, _events in self._selector.select(self._next_timeout()):
+                if key.data is None:
+                    try:
+                        key.fileobj.recv(4096)
+                    except OSError:
+                        pass
+                else:
+                    self._check_connection(key)
+            self._apply_pending()
+            self._expire_deadlines()
+
+    def _next_timeout(self):
+        with self._lock:
+            deadlines = [scope.deadline for scope in self._scopes
+                         if scope.deadline is not None and scope.reason is None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for action, sock, scope in pending:
+            try:
+                if action == 'add':
+                    self._selector.register(sock, selectors.EVENT_READ, scope)
+                else:
+                    self._selector.unregister(sock)
+            except (KeyError, ValueError, OSError):
+                # 套接字已关闭，或监视已因为收到新数据而结束
+                pass
+
+    def _check_connection(self, key):
+        """客户端连接可读：读到 EOF（或连接被重置）说明浏览器已断开"""
+        try:
+            data = key.fileobj.recv(1, _PEEK_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        # 收到新数据（例如同一连接上的下一个请求）时无法再判断是否断开，停止监视该连接
+        try:
+            self._selector.unregister(key.fileobj)
+        except (KeyError, ValueError):
+            pass
+        if data:
+            return
+        with self._lock:
+            active = key.data in self._scopes
+        if active:
+            key.data.abort(REASON_DISCONNECTED)
+
+    def _expire_deadlines(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [scope for scope in self._scopes
+                       if scope.deadline is not None and scope.reason is None and scope.deadline <= now]
+        for scope in expired:
+            scope.abort(REASON_DEADLINE)
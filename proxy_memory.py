@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+玩家记忆服务（SQLite 持久化）
+
+记忆文档的结构与 app.js 的 createEmptyMemory() 相同。存储时按字段拆分成行：
+- player_info 的每个字段、每个 NPC 的关系各占 memory_fields 表的一行
+- 事实、目标、事件、物品、技能、秘密等列表的每一项占 memory_items 表的一行
+
+应用记忆模块返回的更新指令时只写入变化的行，不再整体重写整个文档。
+MemoryRetriever 为对话挑选与当前台词最相关的几条记忆，控制每轮提示词的长度。
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from proxy_retrieval import BM25Index, estimate_tokens, weighted_query
+
+# 列表类字段
+ITEM_SECTIONS = (
+    'key_facts',
+    'goals_and_promises',
+    'important_events',
+    'inventory_mentions',
+    'skills_and_abilities',
+    'secrets_discovered',
+)
+
+# 更新指令中的字段 -> (记忆字段, 必须存在的键)；必须存在的键为 None 表示该列表的元素是去重的字符串
+PATCH_ITEM_FIELDS = {
+    'new_key_facts': ('key_facts', 'fact'),
+    'new_goals_and_promises': ('goals_and_promises', 'content'),
+    'new_important_events': ('important_events', 'event'),
+    'new_inventory': ('inventory_mentions', None),
+    'new_skills': ('skills_and_abilities', None),
+    'new_secrets': ('secrets_discovered', None),
+}
+
+PLAYER_INFO_FIELDS = ('name', 'description', 'personality', 'background')
+PLAYER_INFO_LABELS = {'name': '名字', 'description': '描述', 'personality': '性格', 'background': '背景'}
+
+# 每个 NPC 保留的互动记录数（与 app.js 相同）
+MAX_KEY_INTERACTIONS = 10
+
+# 记忆更新提示词中每类记录最多列出的条数
+PROMPT_VIEW_RECENT = 8
+
+MEMORY_UPDATE_PROMPT = """
+请分析以下对话，提取关键信息并更新玩家记忆。
+
+当前场景：{scene}
+
+对话内容：
+{conversation}
+
+当前已有的记忆（摘要，已记录的内容不要重复返回）：
+{memory_view}
+
+请返回JSON格式的更新指令。格式如下：
+{{
+  "player_info": {{
+    "name": "玩家名字（如果提到）",
+    "description": "更新的描述（如果提到）",
+    "personality": "更新的性格（如果提到）",
+    "background": "更新的背景（如果提到）"
+  }},
+  "new_key_facts": [
+    {{ "fact": "关键事实", "scene": "{scene}" }}
+  ],
+  "relationship_updates": {{
+    "NPC名字": {{
+      "relationship": "关系类型",
+      "trust_level": 7,
+      "new_interactions": ["新的互动记录"]
+    }}
+  }},
+  "new_goals_and_promises": [
+    {{
+      "type": "goal 或 promise",
+      "content": "内容",
+      "related_npc": "相关NPC",
+      "status": "active",
+      "scene": "{scene}"
+    }}
+  ],
+  "new_important_events": [
+    {{ "event": "重要事件", "scene": "{scene}", "impact": "影响" }}
+  ],
+  "new_inventory": ["新物品"],
+  "new_skills": ["新技能"],
+  "new_secrets": ["新发现的秘密"]
+}}
+
+注意：
+1. 只返回需要更新的字段，没有更新的字段可以省略或设为null
+2. 不要杜撰信息，只记录明确提到的内容
+3. 保持客观，不添加主观解释
+"""
+
+
+def create_empty_memory():
+    """与 app.js 的 createEmptyMemory() 相同的空白记忆"""
+    memory = {'player_info': {field: '' for field in PLAYER_INFO_FIELDS}, 'relationships': {}}
+    for section in ITEM_SECTIONS:
+        memory[section] = []
+    return memory
+
+
+def _is_meaningful(value):
+    return bool(value) and value not in ('null', '无')
+
+
+def format_conversation(conversation):
+    """把 [{"role", "npc_name", "content"}, ...] 格式化为提示词中的对话内容"""
+    lines = []
+    for msg in conversation:
+        if msg.get('role') == 'player':
+            lines.append(f"玩家：{msg.get('content', '')}")
+        else:
+            lines.append(f"{msg.get('npc_name') or 'NPC'}：{msg.get('content', '')}")
+    return '\n'.join(lines)
+
+
+def npc_entries(reply):
+    """把 NPC 回复原文转换为对话条目
+
+    回复可能是 JSON（{"responses": [...]} 或单个 NPC）或纯文本，解析方式与 app.js 相同。
+    """
+    try:
+        parsed = json.loads(reply)
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        return [{'role': 'npc', 'content': reply}]
+    if isinstance(parsed.get('responses'), list):
+        return [{'role': 'npc', 'npc_name': r.get('npc_name'), 'content': r.get('content', '')}
+                for r in parsed['responses'] if isinstance(r, dict)]
+    return [{'role': 'npc', 'npc_name': parsed.get('npc_name') or 'NPC', 'content': parsed.get('content', '')}]
+
+
+def turn_conversation(player_line, reply):
+    """把一轮对话（玩家台词和 NPC 回复原文）转换为 format_conversation 使用的条目"""
+    return [{'role': 'player', 'content': player_line}] + npc_entries(reply)
+
+
+def history_conversation(history):
+    """把会话历史 [(role, content), ...] 转换为 format_conversation 使用的条目"""
+    entries = []
+    for role, content in history:
+        if role == 'player':
+            entries.append({'role': 'player', 'content': content})
+        else:
+            entries.extend(npc_entries(content))
+    return entries
+
+
+def prompt_view(memory):
+    """记忆的紧凑文本视图，供记忆模块判断哪些信息已经记录过
+
+    只列出关系、进行中的目标和最近的记录，长度不随存档增长而无限增加。
+    """
+    lines = []
+    info = [f"{PLAYER_INFO_LABELS[k]}：{v}" for k, v in memory['player_info'].items()
+            if v and k in PLAYER_INFO_LABELS]
+    lines.append('玩家信息：' + ('；'.join(info) if info else '暂无'))
+
+    if memory['relationships']:
+        lines.append('NPC关系：')
+        for npc, rel in memory['relationships'].items():
+            lines.append(f"- {npc}：{rel.get('relationship') or '未知'}，信任度 {rel.get('trust_level', 5)}/10")
+
+    active = [g for g in memory['goals_and_promises'] if g.get('status') == 'active']
+    if active:
+        lines.append('进行中的目标和承诺：')
+        for goal in active[-PROMPT_VIEW_RECENT:]:
+            kind = '目标' if goal.get('type') == 'goal' else '承诺'
+            lines.append(f"- {kind}：{goal.get('content')}")
+
+    for section, label, key in (('key_facts', '关键事实', 'fact'), ('important_events', '重要事件', 'event')):
+        items = memory[section]
+        if items:
+            lines.append(f"{label}（共 {len(items)} 条，最近 {min(len(items), PROMPT_VIEW_RECENT)} 条）：")
+            lines.extend(f"- {item.get(key)}" for item in items[-PROMPT_VIEW_RECENT:])
+
+    for section, label in (('inventory_mentions', '物品'), ('skills_and_abilities', '技能'),
+                           ('secrets_discovered', '已发现的秘密')):
+        if memory[section]:
+            lines.append(f"{label}：{'、'.join(memory[section])}")
+    return '\n'.join(lines)
+
+
+class MemoryStore:
+    """按玩家 ID 保存记忆的 SQLite 存储"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memory_fields ("
+            " player_id TEXT NOT NULL,"
+            " section TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (player_id, section, key))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memory_items ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " player_id TEXT NOT NULL,"
+            " section TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS memory_items_player ON memory_items (player_id, section)")
+        self._db.commit()
+        # 玩家 ID -> 修改次数，供检索索引判断是否需要重建
+        self._versions = {}
+
+    def version(self, player_id):
+        with self._lock:
+            return self._versions.get(player_id, 0)
+
+    def _touch(self, player_id):
+        self._versions[player_id] = self._versions.get(player_id, 0) + 1
+
+    def load(self, player_id):
+        """返回玩家的完整记忆文档（没有记录时返回空白记忆）"""
+        with self._lock:
+            return self._load(player_id)
+
+    def _load(self, player_id):
+        memory = create_empty_memory()
+        for section, key, value in self._db.execute(
+                "SELECT section, key, value FROM memory_fields WHERE player_id = ?", (player_id,)):
+            if section == 'player_info':
+                memory['player_info'][key] = json.loads(value)
+            elif section == 'relationships':
+                memory['relationships'][key] = json.loads(value)
+        for section, value in self._db.execute(
+                "SELECT section, value FROM memory_items WHERE player_id = ? ORDER BY id", (player_id,)):
+            if section in memory:
+                memory[section].append(json.loads(value))
+        return memory
+
+    def apply_updates(self, player_id, updates):
+        """应用记忆模块返回的更新指令（规则与 app.js 的 applyMemoryUpdates 相同），返回写入的行数"""
+        if not isinstance(updates, dict):
+            raise ValueError("更新指令必须是 JSON 对象")
+        now = time.time()
+        changed = 0
+        with self._lock:
+            player_info = updates.get('player_info')
+            if isinstance(player_info, dict):
+                for key, value in player_info.items():
+                    if key in PLAYER_INFO_FIELDS and _is_meaningful(value):
+                        self._put_field(player_id, 'player_info', key, value, now)
+                        changed += 1
+
+            relationship_updates = updates.get('relationship_updates')
+            if isinstance(relationship_updates, dict):
+                for npc, update in relationship_updates.items():
+                    if isinstance(update, dict):
+                        self._update_relationship(player_id, npc, update, now)
+                        changed += 1
+
+            for field, (section, required_key) in PATCH_ITEM_FIELDS.items():
+                items = updates.get(field)
+                if not isinstance(items, list):
+                    continue
+                for item in items:
+                    if required_key is None:
+                        if not item or not isinstance(item, str) or self._has_item(player_id, section, item):
+                            continue
+                    elif not isinstance(item, dict) or not item.get(required_key):
+                        continue
+                    elif section == 'key_facts':
+                        item = dict(item, timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)))
+                    self._db.execute(
+                        "INSERT INTO memory_items (player_id, section, value, created) VALUES (?, ?, ?, ?)",
+                        (player_id, section, json.dumps(item, ensure_ascii=False), now)
+                    )
+                    changed += 1
+            self._db.commit()
+            if changed:
+                self._touch(player_id)
+        return changed
+
+    def _put_field(self, player_id, section, key, value, now):
+        self._db.execute(
+            "INSERT OR REPLACE INTO memory_fields VALUES (?, ?, ?, ?, ?)",
+            (player_id, section, key, json.dumps(value, ensure_ascii=False), now)
+        )
+
+    def _update_relationship(self, player_id, npc, update, now):
+        row = self._db.execute(
+            "SELECT value FROM memory_fields WHERE player_id = ? AND section = 'relationships' AND key = ?",
+            (player_id, npc)
+        ).fetchone()
+        if row is None:
+            relationship = {
+                'relationship': update.get('relationship') or '中立',
+                'trust_level': update.get('trust_level') or 5,
+                'key_interactions': [],
+            }
+        else:
+            relationship = json.loads(row[0])
+            if update.get('relationship'):
+                relationship['relationship'] = update['relationship']
+            if update.get('trust_level') is not None:
+                relationship['trust_level'] = update['trust_level']
+        interactions = update.get('new_interactions')
+        if isinstance(interactions, list):
+            relationship['key_interactions'] = (relationship['key_interactions'] + interactions)[-MAX_KEY_INTERACTIONS:]
+        self._put_field(player_id, 'relationships', npc, relationship, now)
+
+    def _has_item(self, player_id, section, value):
+        return self._db.execute(
+            "SELECT 1 FROM memory_items WHERE player_id = ? AND section = ? AND value = ? LIMIT 1",
+            (player_id, section, json.dumps(value, ensure_ascii=False))
+        ).fetchone() is not None
+
+    def replace(self, player_id, memory):
+        """用完整的记忆文档替换玩家的记忆（用于导入）"""
+        now = time.time()
+        with self._lock:
+            self._clear(player_id)
+            for key, value in (memory.get('player_info') or {}).items():
+                if key in PLAYER_INFO_FIELDS and value:
+                    self._put_field(player_id, 'player_info', key, value, now)
+            for npc, relationship in (memory.get('relationships') or {}).items():
+                self._put_field(player_id, 'relationships', npc, relationship, now)
+            for section in ITEM_SECTIONS:
+                self._db.executemany(
+                    "INSERT INTO memory_items (player_id, section, value, created) VALUES (?, ?, ?, ?)",
+                    [(player_id, section, json.dumps(item, ensure_ascii=False), now)
+                     for item in memory.get(section) or []]
+                )
+            self._db.commit()
+            self._touch(player_id)
+
+    def clear(self, player_id):
+        with self._lock:
+            self._clear(player_id)
+            self._db.commit()
+            self._touch(player_id)
+
+    def _clear(self, player_id):
+        self._db.execute("DELETE FROM memory_fields WHERE player_id = ?", (player_id,))
+        self._db.execute("DELETE FROM memory_items WHERE player_id = ?", (player_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def memory_documents(memory):
+    """把记忆拆成可检索的条目，返回 [(文本, 新旧顺序), ...]，顺序越大越新"""
+    documents = []
+    for npc, rel in memory['relationships'].items():
+        text = f"{npc}：{rel.get('relationship') or '未知'}（信任度{rel.get('trust_level', 5)}/10）"
+        interactions = rel.get('key_interactions') or []
+        if interactions:
+            text += '，最近互动：' + '；'.join(str(i) for i in interactions[-3:])
+        documents.append(text)
+    for goal in memory['goals_and_promises']:
+        if goal.get('status') == 'active':
+            kind = '目标' if goal.get('type') == 'goal' else '承诺'
+            related = f"（相关NPC：{goal['related_npc']}）" if goal.get('related_npc') else ''
+            documents.append(f"{kind}：{goal.get('content')}{related}")
+    documents.extend(f"事实：{fact.get('fact')}" for fact in memory['key_facts'])
+    for event in memory['important_events']:
+        impact = f"（影响：{event['impact']}）" if event.get('impact') else ''
+        documents.append(f"事件：{event.get('event')}{impact}")
+    documents.extend(f"线索：{secret}" for secret in memory['secrets_discovered'])
+    documents.extend(f"物品：{item}" for item in memory['inventory_mentions'])
+    documents.extend(f"技能：{skill}" for skill in memory['skills_and_abilities'])
+    return [(text, order) for order, text in enumerate(documents)]
+
+
+def player_info_context(memory):
+    """玩家基本信息（总是放进对话上下文，长度固定）"""
+    info = memory['player_info']
+    if not (info.get('name') or info.get('description')):
+        return ''
+    text = '玩家信息：' + (f"{info['name']} - " if info.get('name') else '') + (info.get('description') or '无')
+    if info.get('personality'):
+        text += f"\n性格：{info['personality']}"
+    return text
+
+
+class MemoryRetriever:
+    """为对话挑选相关记忆
+
+    以当前玩家台词和场景中的 NPC 为查询，用 BM25 给每条记忆打分，
+    按得分取前 top_k 条，总长度不超过 token_budget，存档再大每轮的上下文长度也基本不变。
+    得分低于最高分 min_score_ratio 倍的条目（通常只是共用了"的"、"了"这样的常用字）不选。
+
+    Args:
+        store: MemoryStore
+        top_k: 最多选取的记忆条数
+        token_budget: 选取的记忆总共最多占用的 token 数（估计值）
+        npc_weight: 场景 NPC 在查询中的权重（玩家台词为 1）
+        min_score_ratio: 相对最高分的最低得分比例
+    """
+
+    def __init__(self, store, top_k=8, token_budget=300, npc_weight=0.5, min_score_ratio=0.3):
+        self.store = store
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.npc_weight = npc_weight
+        self.min_score_ratio = min_score_ratio
+        self._lock = threading.Lock()
+        self._indexes = {}   # 玩家 ID -> (记忆版本, 记忆, 条目, BM25Index)
+
+    def _index_for(self, player_id):
+        version = self.store.version(player_id)
+        with self._lock:
+            cached = self._indexes.get(player_id)
+        if cached is not None and cached[0] == version:
+            return cached[1:]
+        memory = self.store.load(player_id)
+        documents = memory_documents(memory)
+        index = BM25Index([text for text, _order in documents])
+        with self._lock:
+            self._indexes[player_id] = (version, memory, documents, index)
+        return memory, documents, index
+
+    def select(self, player_id, player_line, npc_text=''):
+        """返回与本轮对话最相关的记忆条目文本列表"""
+        _memory, documents, index = self._index_for(player_id)
+        if not documents:
+            return []
+        query = weighted_query((player_line, 1.0), (npc_text, self.npc_weight))
+        scores = index.scores(query)
+        ranked = sorted(range(len(documents)), key=lambda i: (scores[i], documents[i][1]), reverse=True)
+        threshold = scores[ranked[0]] * self.min_score_ratio
+        selected = []
+        used = 0
+        for i in ranked:
+            if scores[i] <= 0 or scores[i] < threshold or len(selected) >= self.top_k:
+                break
+            cost = estimate_tokens(documents[i][0])
+            if used + cost > self.token_budget:
+                continue
+            selected.append(documents[i][0])
+            used += cost
+        return selected
+
+    def context_for(self, player_id, player_line, npc_text=''):
+        """组装对话上下文中的【玩家记忆档案】部分，没有可用记忆时返回空字符串"""
+        memory, _documents, _index = self._index_for(player_id)
+        info = player_info_context(memory)
+        items = self.select(player_id, player_line, npc_text)
+        if not info and not items:
+            return ''
+        lines = ['【玩家记忆档案】']
+        if info:
+            lines.append(info)
+        if items:
+            lines.append('与当前对话相关的记忆：')
+            lines.extend(f'- {item}' for item in items)
+        return '\n'.join(lines) + '\n'
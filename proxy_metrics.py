@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+代理服务器指标（Prometheus 文本格式）
+
+每个指标有自己的锁，临界区只做一次字典更新；直方图的分桶查找在锁外完成，
+因此记录指标几乎不会给请求增加延迟。
+
+多进程模式下每个工作进程用 snapshot() 导出自己的指标，merge_snapshots() 把各进程的快照相加，
+render_snapshot() 输出合并后的结果。
+"""
+
+import bisect
+import threading
+
+# 上游耗时直方图的分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def snapshot(self):
+        """导出当前值：{"name", "type", "help", "labels", "samples": [[标签值列表, 值], ...]}（可 JSON 序列化）"""
+        with self._lock:
+            samples = [[list(label_values), self._copy_value(value)] for label_values, value in self._values.items()]
+        return {'name': self.name, 'type': self.type_name, 'help': self.help_text,
+                'labels': list(self.label_names), 'samples': samples}
+
+    @staticmethod
+    def _copy_value(value):
+        return value
+
+    def render(self):
+        return _render_family(self.snapshot())
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Counter):
+    """可增可减的当前值"""
+
+    type_name = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    """分桶直方图"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _copy_value(value):
+        return [list(value[0]), value[1], value[2]]
+
+    def snapshot(self):
+        family = super().snapshot()
+        family['buckets'] = list(self.buckets)
+        return family
+
+
+def _render_family(family):
+    """把一个指标（snapshot() 的格式）输出为 Prometheus 文本行"""
+    name = family['name']
+    label_names = family['labels']
+    lines = [f'# HELP {name} {family["help"]}', f'# TYPE {name} {family["type"]}']
+    samples = sorted((tuple(label_values), value) for label_values, value in family['samples'])
+    if family['type'] != 'histogram':
+        for label_values, value in samples:
+            lines.append(f'{name}{_format_labels(label_names, label_values)} {_format_value(value)}')
+        return lines
+    bounds = tuple(family['buckets']) + (float('inf'),)
+    for label_values, (counts, total, count) in samples:
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            labels = _format_labels(label_names, label_values, f'le="{le}"')
+            lines.append(f'{name}_bucket{labels} {cumulative}')
+        labels = _format_labels(label_names, label_values)
+        lines.append(f'{name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{name}_count{labels} {count}')
+    return lines
+
+
+def _add_values(a, b):
+    if isinstance(a, list):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+    return a + b
+
+
+def merge_snapshots(snapshots):
+    """把多个进程的快照（MetricsRegistry.snapshot() 的返回值）按指标名和标签值相加"""
+    merged = {}
+    for families in snapshots:
+        for family in families:
+            target = merged.get(family['name'])
+            if target is None:
+                target = merged[family['name']] = dict(family, samples={})
+            for label_values, value in family['samples']:
+                key = tuple(label_values)
+                current = target['samples'].get(key)
+                target['samples'][key] = value if current is None else _add_values(current, value)
+    return [dict(family, samples=[[list(k), v] for k, v in family['samples'].items()])
+            for family in merged.values()]
+
+
+def without_gauges(families):
+    """去掉快照中的 gauge（进程重启后只保留累计值作为基数）"""
+    return [family for family in families if family['type'] != 'gauge']
+
+
+def render_snapshot(families):
+    """输出快照的 Prometheus 文本格式"""
+    lines = []
+    for family in families:
+        lines.extend(_render_family(family))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRegistry:
+    """指标注册表，render() 输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """注册一个在导出时调用的函数，返回 [(名称, 类型, 说明, 值[, {标签: 标签值}]), ...]
+
+        用于把连接池、缓存等组件自己维护的统计信息一并导出；同名的多项（标签值不同）合并为一个指标。
+        """
+        self._collectors.append(collect)
+
+    def snapshot(self):
+        """导出所有指标（包括 collector 的统计）的当前值，格式见 _Metric.snapshot()"""
+        families = [metric.snapshot() for metric in self._metrics]
+        collected = {}
+        for collect in self._collectors:
+            for name, type_name, help_text, value, *labels in collect():
+                labels = labels[0] if labels else {}
+                family = collected.get(name)
+                if family is None:
+                    family = collected[name] = {'name': name, 'type': type_name, 'help': help_text,
+                                                'labels': list(labels), 'samples': []}
+                    families.append(family)
+                family['samples'].append([[str(labels[label]) for label in family['labels']], value])
+        return families
+
+    def render(self):
+        return render_snapshot(self.snapshot())
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter(
+    'proxy_requests_total', '代理处理的 /api/openai 请求数', ('model', 'status'))
+IN_FLIGHT = REGISTRY.gauge(
+    'proxy_in_flight_requests', '正在处理的 /api/openai 请求数')
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    'proxy_upstream_latency_seconds', '从发出上游请求到读完响应的耗时', ('model', 'status'))
+UPSTREAM_TTFB = REGISTRY.histogram(
+    'proxy_upstream_ttfb_seconds', '从发出上游请求到收到第一个响应体字节的耗时', ('model', 'status'))
+BYTES_IN = REGISTRY.counter(
+    'proxy_request_bytes_total', '浏览器发给代理的请求体字节数', ('model', 'status'))
+BYTES_OUT = REGISTRY.counter(
+    'proxy_response_bytes_total', '代理返回给浏览器的响应体字节数', ('model', 'status'))
+PROMPT_TOKENS = REGISTRY.counter(
+    'proxy_prompt_tokens_total', '上游响应 usage.prompt_tokens 之和', ('model', 'status'))
+COMPLETION_TOKENS = REGISTRY.counter(
+    'proxy_completion_tokens_total', '上游响应 usage.completion_tokens 之和', ('model', 'status'))
+
+# 准入排队耗时的分桶（秒）
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+QUEUE_WAIT = REGISTRY.histogram(
+    'proxy_admission_queue_wait_seconds', '请求在准入控制中排队（等待令牌和并发槽位）的时间', ('priority',),
+    buckets=QUEUE_WAIT_BUCKETS)
+ADMISSION_REJECTED = REGISTRY.counter(
+    'proxy_admission_rejected_total', '因队列已满或超出限流而返回 429 的请求数', ('priority',))
+ABORTED = REGISTRY.counter(
+    'proxy_aborted_requests_total', '因客户端断开（disconnected）或超过截止时间（deadline）而中断上游调用的请求数',
+    ('reason',))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    'proxy_upstream_retries_total', '上游请求的重试次数，按触发原因（状态码或 connection）分组', ('reason',))
+UPSTREAM_RESPONSE_TIME = REGISTRY.histogram(
+    'proxy_upstream_response_header_seconds', '按上游统计的从发出请求到收到响应头的耗时', ('upstream',))
+CLIENT_CONNECTIONS = REGISTRY.counter(
+    'proxy_client_connections_total', '浏览器到代理的 TCP 连接数（不含工作进程之间的转发）')
+CLIENT_REQUESTS = REGISTRY.counter(
+    'proxy_client_requests_total', '浏览器发给代理的 HTTP 请求数（含静态文件），reused 表示是否复用了已有的持久连接',
+    ('reused',))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+按请求类别选择模型，延迟超过 SLO 时自动改用更快的模型
+
+浏览器（state.model）和故事工作流（config.OPENAI_MODEL）整个会话只用一个模型，但记忆更新、
+信件这类后台请求不需要最慢的模型。路由策略按请求类别（dialogue、memory、letter 等）指定模型：
+- 类别配置了 model 时使用它，否则使用请求中的模型
+- 类别配置了 slo_p95_ms 和 fallback 时，该类别在主模型上最近成功请求的 p95 耗时超过 SLO
+  就改用 fallback，冷却 cooldown_seconds 秒后重新使用主模型并重新统计耗时
+- 没有单独配置的类别使用 "default" 的规则，也没有 "default" 时保持请求中的模型
+
+每次路由决定连同请求结果写入 JSON Lines 日志（可选），切换模型时打印 [ROUTING] 日志。
+代理服务器（--model-routing）和 story/ 中的 AIModule 共用本模块和同一种配置文件。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+# 路由原因
+REASON_REQUESTED = 'requested'      # 使用请求中的模型
+REASON_POLICY = 'policy'            # 使用类别配置的模型
+REASON_SLO_FALLBACK = 'slo_fallback'  # 主模型超过 SLO，改用更快的模型
+
+DEFAULT_ROUTE = 'default'
+
+# 一次路由决定：primary 为不考虑 SLO 时应使用的模型，model 为实际使用的模型
+RoutingDecision = namedtuple('RoutingDecision', ['request_class', 'requested', 'primary', 'model', 'reason'])
+
+
+class ModelRoute:
+    """一个请求类别的路由规则
+
+    Args:
+        model: 该类别使用的模型，None 表示使用请求中的模型
+        slo_ms: 主模型 p95 耗时的上限（毫秒），None 表示不检查
+        fallback: 超过 SLO 时改用的模型
+    """
+
+    def __init__(self, model=None, slo_ms=None, fallback=None):
+        if (slo_ms is None) != (fallback is None):
+            raise ValueError("slo_p95_ms 和 fallback 必须同时配置")
+        if slo_ms is not None and slo_ms <= 0:
+            raise ValueError("slo_p95_ms 必须大于 0")
+        self.model = model or None
+        self.slo_ms = slo_ms
+        self.fallback = fallback or None
+
+
+class _LatencyWindow:
+    """一个（类别, 主模型）最近成功请求的耗时，以及是否正在使用 fallback"""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.fallback_until = 0.0
+        self.active = False
+        self.fallbacks = 0
+
+    def p95(self):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ModelRouter:
+    """按请求类别路由模型
+
+    用法：
+        decision = router.route('memory', request_data.get('model'))
+        ...用 decision.model 调用上游...
+        router.finish(decision, status, elapsed)
+
+    Args:
+        routes: {类别: ModelRoute}
+        window: 每个（类别, 主模型）保留的最近耗时样本数
+        min_samples: 样本数不足时不判断 SLO
+        cooldown: 改用 fallback 后多久（秒）重新尝试主模型
+        log_path: 路由日志文件（JSON Lines），None 表示不写
+    """
+
+    def __init__(self, routes, window=100, min_samples=20, cooldown=60.0, log_path=None):
+        self.routes = dict(routes)
+        self.window = window
+        self.min_samples = max(1, min_samples)
+        self.cooldown = cooldown
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._decisions = {}    # (类别, 模型, 原因) -> 次数
+        # O_APPEND：多进程模式下各工作进程写同一个文件，每行一次 write，不会互相截断
+        self._log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644) if log_path else None
+
+    def rule(self, request_class):
+        """请求类别的路由规则，没有时返回 None"""
+        return self.routes.get(request_class) or self.routes.get(DEFAULT_ROUTE)
+
+    def route(self, request_class, requested):
+        """为一次请求选择模型，返回 RoutingDecision"""
+        rule = self.rule(request_class)
+        if rule is None:
+            decision = RoutingDecision(request_class, requested, requested, requested, REASON_REQUESTED)
+        else:
+            primary = rule.model or requested
+            reason = REASON_POLICY if rule.model and rule.model != requested else REASON_REQUESTED
+            model = primary
+            restored = None
+            if rule.fallback is not None and primary is not None:
+                with self._lock:
+                    state = self._windows.get((request_class, primary))
+                    if state is not None and state.active:
+                        if time.monotonic() < state.fallback_until:
+                            model, reason = rule.fallback, REASON_SLO_FALLBACK
+                        else:
+                            state.active = False
+                            restored = state
+            if restored is not None:
+                print(f"[ROUTING] {request_class} 冷却结束，恢复使用 {primary}")
+                self._write_log({'event': 'restore', 'class': request_class, 'model': primary})
+            decision = RoutingDecision(request_class, requested, primary, model, reason)
+        with self._lock:
+            key = (request_class, str(decision.model or 'unknown'), decision.reason)
+            self._decisions[key] = self._decisions.get(key, 0) + 1
+        return decision
+
+    def finish(self, decision, status=None, elapsed=None):
+        """记录一次请求的结果：status 为上游状态码（出错时为 None），elapsed 为上游耗时（秒）
+
+        只有主模型成功（200）的耗时计入 SLO 统计。
+        """
+        self._write_log({
+            'class': decision.request_class,
+            'requested': decision.requested,
+            'model': decision.model,
+            'reason': decision.reason,
+            'status': status,
+            'latency_ms': round(elapsed * 1000, 1) if elapsed is not None else None,
+        })
+        rule = self.rule(decision.request_class)
+        if (rule is None or rule.slo_ms is None or status != 200 or elapsed is None
+                or decision.model != decision.primary or decision.primary is None):
+            return
+        breached = None
+        with self._lock:
+            key = (decision.request_class, decision.primary)
+            state = self._windows.get(key)
+            if state is None:
+                state = self._windows[key] = _LatencyWindow(self.window)
+            if state.active:
+                # 切换前已发出的请求，不计入下一轮统计
+                return
+            state.samples.append(elapsed)
+            p95 = state.p95()
+            if len(state.samples) >= self.min_samples and p95 * 1000 > rule.slo_ms:
+                state.active = True
+                state.fallback_until = time.monotonic() + self.cooldown
+                state.fallbacks += 1
+                state.samples.clear()
+                breached = p95
+        if breached is not None:
+            print(f"[ROUTING] {decision.request_class} 在 {decision.primary} 上的 p95 耗时 {breached * 1000:.0f} ms "
+                  f"超过 SLO {rule.slo_ms:g} ms，{self.cooldown:g}s 内改用 {rule.fallback}")
+            self._write_log({'event': 'fallback', 'class': decision.request_class, 'model': decision.primary,
+                             'fallback': rule.fallback, 'p95_ms': round(breached * 1000, 1), 'slo_ms': rule.slo_ms})
+
+    def _write_log(self, record):
+        if self._log_fd is None:
+            return
+        line = json.dumps(dict(time=round(time.time(), 3), **record), ensure_ascii=False) + '\n'
+        try:
+            os.write(self._log_fd, line.encode('utf-8'))
+        except OSError as e:
+            print(f"[ROUTING] 写路由日志失败: {e}")
+
+    def stats(self):
+        """各（类别, 主模型）的 SLO 状态和各（类别, 模型, 原因）的路由次数"""
+        now = time.monotonic()
+        with self._lock:
+            windows = [{
+                'class': request_class,
+                'model': model,
+                'fallback_active': state.active and now < state.fallback_until,
+                'p95_ms': round(state.p95() * 1000, 1) if state.samples else None,
+                'samples': len(state.samples),
+                'fallbacks': state.fallbacks,
+            } for (request_class, model), state in self._windows.items()]
+            decisions = [{'class': request_class, 'model': model, 'reason': reason, 'count': count}
+                         for (request_class, model, reason), count in self._decisions.items()]
+        return {'windows': windows, 'decisions': decisions}
+
+
+def load_model_routing(path, log_path=None):
+    """读取路由策略文件，返回 ModelRouter
+
+    JSON 对象：{"classes": {类别: {"model", "slo_p95_ms", "fallback"}, ...},
+    以及可选的 "window"、"min_samples"、"cooldown_seconds"}。
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict) or not isinstance(config.get('classes'), dict):
+        raise ValueError("路由策略必须是包含 classes 对象的 JSON 对象")
+    routes = {}
+    for request_class, entry in config['classes'].items():
+        if not isinstance(entry, dict):
+            raise ValueError(f"类别 {request_class} 的规则必须是 JSON 对象")
+        try:
+            slo_ms = float(entry['slo_p95_ms']) if entry.get('slo_p95_ms') is not None else None
+            routes[request_class] = ModelRoute(entry.get('model'), slo_ms, entry.get('fallback'))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"类别 {request_class}: {e}") from e
+    return ModelRouter(routes, window=int(config.get('window', 100)), min_samples=int(config.get('min_samples', 20)),
+                       cooldown=float(config.get('cooldown_seconds', 60.0)), log_path=log_path)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+上游连接池
+
+复用到 OpenAI 的 HTTP/1.1 keep-alive 连接，避免每轮对话都重新进行
+DNS 解析、TCP 握手和 TLS 握手。
+"""
+
+import http.client
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+# 复用连接时可能遇到的“对端已关闭”类错误，遇到后换一条新连接重试一次
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+
+def abort_connection(conn):
+    """从其他线程中断连接上进行中的请求：关闭底层套接字，阻塞中的读写随即返回或抛出异常"""
+    sock = conn.sock
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _drop_connection(conn, on_close):
+    """放弃一条还没有得到响应的连接"""
+    if on_close is not None:
+        on_close(dropped=True)
+    conn.close()
+
+
+class PooledResponse:
+    """上游响应：读完后把连接归还连接池
+
+    用法：
+        with pool.request('POST', url, body, headers) as response:
+            data = response.read()
+    """
+
+    def __init__(self, pool, host_key, conn, response, reused, connect_ms, on_close=None):
+        self._pool = pool
+        self._host_key = host_key
+        self._conn = conn
+        self._response = response
+        self._on_close = on_close
+        self._released = False
+        self.reused = reused
+        self.connect_ms = connect_ms
+
+    @property
+    def status(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    @property
+    def headers(self):
+        return self._response.headers
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def readline(self, limit=-1):
+        return self._response.readline(limit)
+
+    def close(self):
+        """归还连接；响应未读完或对端要求关闭时直接断开"""
+        if self._released:
+            return
+        self._released = True
+        aborted = self._on_close() if self._on_close is not None else False
+        response = self._response
+        reusable = response.isclosed() and not response.will_close and not aborted
+        if not reusable:
+            response.close()
+        self._pool._release(self._host_key, self._conn, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class UpstreamPool:
+    """按主机划分的 keep-alive 连接池
+
+    Args:
+        max_idle_per_host: 每个主机最多保留的空闲连接数（池大小）
+        max_per_host: 每个主机同时使用中的连接上限，超出时请求排队等待
+        idle_timeout: 空闲连接的最长保留时间（秒），超时后丢弃
+        timeout: 默认读写超时（秒）
+    """
+
+    def __init__(self, max_idle_per_host=16, max_per_host=64, idle_timeout=60.0, timeout=60.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = {}          # host_key -> [(conn, last_used), ...]
+        self._host_slots = {}    # host_key -> Semaphore(max_per_host)
+        self._connect_ms = {}    # host_key -> 建连耗时的滑动平均
+        self._stats = {
+            'connections_opened': 0,
+            'connections_reused': 0,
+            'connect_ms_saved': 0.0,
+        }
+
+    @staticmethod
+    def _host_key(url):
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'https'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        return (scheme, parts.hostname, port)
+
+    def _slots(self, host_key):
+        with self._lock:
+            slots = self._host_slots.get(host_key)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_per_host)
+                self._host_slots[host_key] = slots
+            return slots
+
+    def _new_connection(self, host_key, timeout):
+        """建立新连接，返回 (连接, 建连耗时毫秒)；耗时包含 DNS、TCP 和 TLS 握手"""
+        scheme, host, port = host_key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        started = time.perf_counter()
+        conn.connect()
+        connect_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats['connections_opened'] += 1
+            previous = self._connect_ms.get(host_key)
+            self._connect_ms[host_key] = connect_ms if previous is None else previous * 0.8 + connect_ms * 0.2
+        return conn, connect_ms
+
+    def _take_idle(self, host_key):
+        """取出一条仍在有效期内的空闲连接"""
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(host_key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for stale in expired:
+            stale.close()
+        return conn
+
+    def _release(self, host_key, conn, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(host_key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append((conn, time.monotonic()))
+                    conn = None
+        if conn is not None:
+            conn.close()
+        self._slots(host_key).release()
+
+    def request(self, method, url, body=None, headers=None, timeout=None, on_connection=None):
+        """发送请求并返回 PooledResponse（调用方负责 close 或使用 with）
+
+        on_connection(conn) 在每次发送请求前调用，调用方可以记下连接以便在其他线程中用
+        abort_connection 中断请求；它可以返回一个函数 on_close，在响应关闭、连接归还连接池之前调用，
+        该函数返回 True 表示请求被中断过，连接不再复用。没有得到响应就放弃的连接（复用的连接已失效、
+        换新连接重试，或请求出错）调用 on_close(dropped=True)，调用方应忘掉这条连接。
+        """
+        host_key = self._host_key(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        timeout = timeout or self.timeout
+        slots = self._slots(host_key)
+        slots.acquire()
+        try:
+            conn = self._take_idle(host_key)
+            if conn is not None:
+                conn.sock.settimeout(timeout)
+                on_close = None
+                try:
+                    on_close = on_connection(conn) if on_connection is not None else None
+                    conn.request(method, path, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                    return self._reused_response(host_key, conn, response, on_close)
+                except _STALE_CONNECTION_ERRORS:
+                    # 空闲期间被上游关闭的连接（或请求已被中断），换新连接重试；
+                    # 先让调用方忘掉旧连接，否则它关闭的套接字会被当成新请求被中断
+                    _drop_connection(conn, on_close)
+                except Exception:
+                    _drop_connection(conn, on_close)
+                    raise
+
+            conn, connect_ms = self._new_connection(host_key, timeout)
+            on_close = None
+            try:
+                on_close = on_connection(conn) if on_connection is not None else None
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            except Exception:
+                _drop_connection(conn, on_close)
+                raise
+            return PooledResponse(self, host_key, conn, response, reused=False, connect_ms=connect_ms,
+                                  on_close=on_close)
+        except Exception:
+            slots.release()
+            raise
+
+    def _reused_response(self, host_key, conn, response, on_close=None):
+        with self._lock:
+            saved_ms = self._connect_ms.get(host_key, 0.0)
+            self._stats['connections_reused'] += 1
+            self._stats['connect_ms_saved'] += saved_ms
+        return PooledResponse(self, host_key, conn, response, reused=True, connect_ms=saved_ms, on_close=on_close)
+
+    def warm(self, url, count=1):
+        """预先建立 count 条到 url 所在主机的连接"""
+        host_key = self._host_key(url)
+        for _ in range(count):
+            conn, _connect_ms = self._new_connection(host_key, self.timeout)
+            with self._lock:
+                idle = self._idle.setdefault(host_key, [])
+                if len(idle) >= self.max_idle_per_host:
+                    conn.close()
+                    return
+                idle.append((conn, time.monotonic()))
+
+    def stats(self):
+        """返回连接池统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle_connections'] = sum(len(idle) for idle in self._idle.values())
+        return stats
+
+    def close(self):
+        """关闭全部空闲连接"""
+        with self._lock:
+            idle_lists = list(self._idle.values())
+            self._idle.clear()
+        for idle in idle_lists:
+            for conn, _last_used in idle:
+                conn.close()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+推测性预取
+
+页面在玩家真正需要结果之前（例如场景设置填好、下一幕描述生成后）就让代理开始生成 NPC 问候，
+结果放在一个短期有效的槽位里，玩家进入对话页面时直接取走，不必再等上游生成。
+
+槽位按 (API Key, 客户端给的 key) 区分，同一个 key 再次预取不同的请求时取消旧的预取；
+超过有效期没有取走的槽位自动作废，仍在生成的会被取消。
+"""
+
+import hashlib
+import threading
+import time
+
+
+class PrefetchCancelled(Exception):
+    """预取已被取消（被新的预取替换、显式取消或过期）"""
+
+
+class PrefetchSlot:
+    """一次预取
+
+    Attributes:
+        fingerprint: 请求指纹，取结果时用于确认与当前请求一致
+        result: 完成后为 (上游状态码, 回复文本或错误响应)
+    """
+
+    def __init__(self, fingerprint, ttl):
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+        self.expires = self.created + ttl
+        self.result = None
+        self.cancelled = False
+        self.taken = False
+        self._done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        self._done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._done.set()
+
+    def check(self):
+        """生成过程中调用：已取消（或过期仍未被取走）时抛出 PrefetchCancelled，中断上游请求"""
+        if self.cancelled or (not self.taken and time.monotonic() > self.expires):
+            raise PrefetchCancelled()
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+
+class PrefetchStore:
+    """预取槽位
+
+    Args:
+        ttl: 槽位的有效期（秒），过期未取走的预取作废
+        max_slots: 最多同时保存的槽位数，超出时取消最早的
+    """
+
+    def __init__(self, ttl=60.0, max_slots=256):
+        self.ttl = ttl
+        self.max_slots = max_slots
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._stats = {'started': 0, 'reused': 0, 'hits': 0, 'misses': 0, 'cancelled': 0, 'expired': 0}
+
+    @staticmethod
+    def _slot_key(api_key, key):
+        return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest(), key
+
+    def start(self, api_key, key, fingerprint, runner):
+        """开始预取；同一个 key 正在预取相同的请求时复用它
+
+        runner(slot) 在后台线程中执行，负责生成结果并调用 slot.finish()。返回 (slot, 是否复用)。
+        """
+        slot_key = self._slot_key(api_key, key)
+        with self._lock:
+            self._expire()
+            current = self._slots.get(slot_key)
+            if current is not None and current.fingerprint == fingerprint and not current.cancelled:
+                current.expires = time.monotonic() + self.ttl
+                self._stats['reused'] += 1
+                return current, True
+            if current is not None:
+                self._cancel(current)
+            slot = self._slots[slot_key] = PrefetchSlot(fingerprint, self.ttl)
+            while len(self._slots) > self.max_slots:
+                oldest = min(self._slots, key=lambda k: self._slots[k].created)
+                self._cancel(self._slots.pop(oldest))
+            self._stats['started'] += 1
+        threading.Thread(target=runner, args=(slot,), daemon=True).start()
+        return slot, False
+
+    def take(self, api_key, key, fingerprint=None, timeout=60.0):
+        """取走预取的结果（只能取一次），仍在生成时等待完成
+
+        fingerprint 不为 None 时必须与预取的请求一致。没有可用的预取时返回 None。
+        """
+        slot_key = self._slot_key(api_key, key)
+        with self._lock:
+            self._expire()
+            slot = self._slots.get(slot_key)
+            if slot is None or (fingerprint is not None and slot.fingerprint != fingerprint):
+                self._stats['misses'] += 1
+                return None
+            del self._slots[slot_key]
+            slot.taken = True
+        if not slot.wait(timeout) or slot.cancelled or slot.result is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        with self._lock:
+            self._stats['hits'] += 1
+        return slot
+
+    def cancel(self, api_key, key):
+        """取消预取，返回是否存在该预取"""
+        with self._lock:
+            slot = self._slots.pop(self._slot_key(api_key, key), None)
+            if slot is None:
+                return False
+            self._cancel(slot)
+            return True
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            return dict(self._stats, slots=len(self._slots))
+
+    def _cancel(self, slot):
+        """（持有锁）取消一个槽位"""
+        if not slot.done:
+            self._stats['cancelled'] += 1
+        slot.cancel()
+
+    def _expire(self):
+        """（持有锁）作废过期的槽位"""
+        now = time.monotonic()
+        for slot_key in [k for k, slot in self._slots.items() if slot.expires <= now]:
+            slot = self._slots.pop(slot_key)
+            self._stats['expired'] += 1
+            slot.cancel()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+上游重试与对冲请求
+
+- 重试：上游返回 429/5xx 或连接被重置时，按带随机抖动的指数退避等待后重试，
+  上游给出 Retry-After 时至少等待这么久；等待不会超过请求的截止时间
+- 对冲：非流式请求超过该模型近期延迟的 p95 仍未返回时，再发一个相同的请求，取先完成的结果，
+  另一个立即中断；对冲请求数受预算限制（默认不超过请求数的 10%），不会成倍增加上游负载
+  对冲请求另外经过准入（不排队），上游并发或限流额度用满时不发出
+"""
+
+import email.utils
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from proxy_cancellation import CancelScope
+
+# 默认重试的上游状态码
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 对冲中输掉的一路的中断原因
+REASON_HEDGE_LOST = 'hedge_lost'
+
+
+def parse_retry_after(value):
+    """解析 Retry-After（秒数或 HTTP 日期），返回秒数；没有或无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """重试策略
+
+    Args:
+        max_retries: 最多重试次数（0 表示不重试）
+        base_delay: 第一次重试前的最长等待（秒），之后每次翻倍
+        max_delay: 单次等待的上限（秒）；上游要求的 Retry-After 更长时不再重试，直接返回上游的响应
+        retry_statuses: 需要重试的上游状态码
+    """
+
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0, retry_statuses=RETRY_STATUSES):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def next_delay(self, attempt, status=None, retry_after=None, remaining=None):
+        """第 attempt 次（从 0 开始）调用失败后重试前的等待秒数，不应重试时返回 None
+
+        status 为 None 表示连接错误；remaining 为请求剩余的时间，等不到重试就不再重试。
+        """
+        if attempt >= self.max_retries:
+            return None
+        if status is not None and status not in self.retry_statuses:
+            return None
+        # 全抖动：在 [0, 退避上限] 中随机取值，避免多个请求同时重试
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hinted = parse_retry_after(retry_after)
+        if hinted is not None:
+            if hinted > self.max_delay:
+                return None
+            delay = max(delay, hinted)
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+
+class Hedger:
+    """对冲请求
+
+    Args:
+        quantile: 按近期延迟的哪个分位数决定何时发出对冲请求
+        budget: 对冲请求占请求数的比例上限
+        window: 每个模型保留的近期延迟样本数
+        min_samples: 样本数不足时不对冲
+        min_delay: 对冲前至少等待的秒数
+    """
+
+    def __init__(self, quantile=0.95, budget=0.1, window=200, min_samples=20, min_delay=0.05):
+        self.quantile = quantile
+        self.budget = budget
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._tokens = 1.0
+        self._stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'over_budget': 0, 'no_slot': 0}
+
+    def observe(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay(self, key):
+        """对冲前等待的秒数（近期延迟的分位数），样本不足时返回 None"""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))])
+
+    def _spend(self):
+        """每个请求积攒 budget 个令牌，发出一次对冲花掉一个"""
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            self._stats['over_budget'] += 1
+            return False
+
+    def _refund(self):
+        """没能发出对冲请求时退回 _spend 花掉的令牌"""
+        with self._lock:
+            self._tokens = min(10.0, self._tokens + 1.0)
+            self._stats['no_slot'] += 1
+
+    def run(self, key, call, scope=None, accept=lambda value: True, admit=None):
+        """执行 call(attempt_scope)，超过 key 的延迟分位数仍未完成时再发一次，返回先完成且 accept 的结果
+
+        每一路使用 scope 派生的子 scope，输掉的一路被中断；两路都失败时抛出主请求的异常。
+        admit 为对冲请求的准入：不等待，返回对冲请求结束时调用的释放函数，返回 None 时不发出对冲请求。
+        """
+        parent = scope if scope is not None else CancelScope(None)
+        with self._lock:
+            self._stats['requests'] += 1
+            self._tokens = min(10.0, self._tokens + self.budget)
+        delay = self.delay(key)
+        if delay is None:
+            started = time.perf_counter()
+            value = call(parent)
+            if accept(value):
+                self.observe(key, time.perf_counter() - started)
+            return value
+
+        results = queue.Queue()
+        attempts = []
+
+        def attempt(index, attempt_scope, release):
+            started = time.perf_counter()
+            try:
+                results.put((index, call(attempt_scope), None, time.perf_counter() - started))
+            except BaseException as e:
+                results.put((index, None, e, None))
+            finally:
+                if release is not None:
+                    release()
+
+        def launch(release=None):
+            attempt_scope = parent.child()
+            attempts.append(attempt_scope)
+            threading.Thread(target=attempt, args=(len(attempts) - 1, attempt_scope, release), daemon=True).start()
+
+        launch()
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            outcome = None
+            if self._spend():
+                release = admit() if admit is not None else None
+                if admit is not None and release is None:
+                    self._refund()
+                    print(f"[HEDGE] {key} 请求超过 p{self.quantile * 100:.0f}，但没有空闲的上游并发额度，不发出对冲请求")
+                else:
+                    print(f"[HEDGE] {key} 请求超过 p{self.quantile * 100:.0f}（{delay * 1000:.0f} ms）仍未返回，发出对冲请求")
+                    with self._lock:
+                        self._stats['hedged'] += 1
+                    launch(release)
+
+        # 取第一个被接受的结果；都不被接受时用先完成的结果，都失败时抛出主请求的异常
+        pending = len(attempts)
+        winner = fallback = None
+        errors = {}
+        while pending and winner is None:
+            index, value, error, elapsed = outcome if outcome is not None else results.get()
+            outcome = None
+            pending -= 1
+            if error is not None:
+                errors[index] = error
+            elif accept(value):
+                winner = (index, value, elapsed)
+            elif fallback is None:
+                fallback = (index, value, elapsed)
+        for attempt_scope in attempts:
+            attempt_scope.abort(REASON_HEDGE_LOST)   # 已完成的一路中断时什么也不做
+        if winner is None and fallback is None:
+            raise errors[0]   # 两路都失败时主请求（序号 0）一定也失败了
+        index, value, elapsed = winner or fallback
+        if index > 0:
+            with self._lock:
+                self._stats['hedge_wins'] += 1
+        if winner is not None:
+            self.observe(key, elapsed)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -5,20 +5,690 @@ AI RPG 测试系统 - 带 OpenAI 代理的本地服务器
 解决浏览器直接调用 OpenAI API 的 CORS 限制
 """
 
+import http.client
 import http.server
 import socketserver
 import json
-import urllib.request
-import urllib.error
 import webbrowser
 import os
 import sys
 import socket
+import argparse
+import threading
+import time
+import email.utils
+import html
+import math
+import queue
+import re
+import signal
+from collections import namedtuple
+from contextlib import contextmanager
 from urllib.parse import urlparse, parse_qs
 
+import proxy_metrics as metrics
+from proxy_admission import (AdmissionController, AdmissionRejected, DEFAULT_PRIORITY_CLASS,
+                             normalize_priority_class)
+from proxy_cache import ResponseCache, SingleFlight, SqliteCacheTier, request_fingerprint
+from proxy_cancellation import REASON_DEADLINE, REASON_DISCONNECTED, DisconnectWatcher, RequestAborted
+from proxy_model_routing import load_model_routing
+from proxy_memory import (MEMORY_UPDATE_PROMPT, MemoryRetriever, MemoryStore, format_conversation,
+                          history_conversation, prompt_view, turn_conversation)
+from proxy_pool import UpstreamPool
+from proxy_prefetch import PrefetchCancelled, PrefetchStore
+from proxy_resilience import Hedger, RetryPolicy
+from proxy_retrieval import estimate_tokens
+from proxy_sessions import ROLLING_SUMMARY_PROMPT, SessionStore
+from proxy_static import StaticAssetCache
+from proxy_turn_scheduler import TurnBatchScheduler
+from proxy_upstreams import ROUTING_STRATEGIES, Upstream, UpstreamRouter, load_upstreams
+from proxy_workers import FORWARDED_HEADER, WorkerSupervisor, reuseport_supported
+
 # 尝试的端口列表
 PORTS_TO_TRY = [8000, 8080, 8888, 3000, 5000, 9000]
 
+# 上游 OpenAI 接口地址（可用 --upstream-base-url 或环境变量 OPENAI_BASE_URL 修改，--upstreams 配置多个上游）
+DEFAULT_UPSTREAM_BASE_URL = 'https://api.openai.com/v1'
+
+# 非流式响应转发时每次读取的字节数
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# 为统计 token 用量而保留的响应体上限（更大的响应不解析 usage）
+USAGE_CAPTURE_LIMIT = 1024 * 1024
+
+# 透传模式：不解析请求体，只在开头这么多字节内查找 model 字段（用于按模型统计指标）
+MODEL_SNIFF_BYTES = 4096
+MODEL_FIELD = re.compile(rb'"model"\s*:\s*"([^"\\]{1,128})"')
+
+# 请求截止时间：剩余的毫秒数，超过后代理中断上游请求并返回 504
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+
+# 一次批量请求最多包含的子请求数
+MAX_BATCH_SIZE = 16
+
+# 场景结束流水线的各段（名称同时作为请求类别），总结完成后下一幕和信件并发生成
+SCENE_SECTIONS = ('summary', 'story', 'letter')
+
+# 下一幕和信件的提示词中替换为场景总结的占位符
+SUMMARY_PLACEHOLDER = '{{summary}}'
+
+# 场景结束流水线检查客户端断开和截止时间的间隔（秒），以及中断后等待各段结束的最长时间（秒）
+SCENE_EVENT_POLL = 1.0
+SCENE_ABORT_GRACE = 2.0
+
+# 并发模式下同时处理的最大连接数（每条连接占用一个工作线程，空闲的持久连接也占用）
+DEFAULT_MAX_WORKERS = 256
+
+# 浏览器持久连接的空闲超时（秒）和每条连接最多处理的请求数（在 main 中按命令行参数配置）
+KEEPALIVE_TIMEOUT = 15.0
+KEEPALIVE_MAX_REQUESTS = 1000
+
+# 处理器没有读取的请求体（例如 404 的请求）不超过这么大时读掉丢弃以继续复用连接，否则关闭连接
+MAX_DISCARD_BODY = 64 * 1024
+
+# 上游路由：在一个或多个上游（接口地址 + API Key）之间分配请求（在 main 中按命令行参数配置）
+UPSTREAM_ROUTER = UpstreamRouter([Upstream('default', DEFAULT_UPSTREAM_BASE_URL)])
+
+# 浏览器没有提供 API Key（所有上游都使用服务器端的 Key）时用它代替，限流和预取槽位按它区分
+SERVER_KEY_PLACEHOLDER = 'server-key'
+
+# 上游连接池（在 main 中按命令行参数重新配置）
+UPSTREAM_POOL = UpstreamPool()
+
+# 响应缓存（默认关闭，使用 --cache 启用）
+RESPONSE_CACHE = None
+
+# 静态资源内存缓存（--no-static-cache 关闭）
+STATIC_CACHE = StaticAssetCache()
+
+# 相同请求合并（默认关闭，使用 --coalesce 启用）
+COALESCER = None
+
+# 上游准入控制：优先级排队与按 API Key 限流（默认关闭，使用 --upstream-concurrency / --rate-limit 启用）
+ADMISSION = None
+
+# 不允许作为静态文件返回的文件（在 main 中加入 --memory-db、--cache-db 的实际路径）
+PRIVATE_FILES = frozenset()
+
+# 不允许作为静态文件返回的文件名（*.sqlite 数据库及其 -wal、-journal 等文件）
+PRIVATE_FILE_PATTERN = re.compile(r'\.sqlite[^/\\]*$', re.IGNORECASE)
+
+# 服务器端对话会话（在 main 中按命令行参数重新配置）
+SESSIONS = SessionStore()
+
+# 会话接口路径：/api/session、/api/session/<id>/turn 和 /api/session/<id>/end
+SESSION_TURN_PATH = re.compile(r'^/api/session/([A-Za-z0-9_-]+)/turn$')
+SESSION_END_PATH = re.compile(r'^/api/session/([A-Za-z0-9_-]+)/end$')
+
+# 玩家记忆存储（在 main 中按 --memory-db 打开）
+MEMORY_STORE = None
+
+# 对话上下文的记忆检索（在 main 中按 --memory-top-k / --memory-token-budget 配置）
+MEMORY_RETRIEVER = None
+
+# 会话对话的记忆更新调度（在 main 中按 --memory-flush-turns / --memory-idle-flush 配置）
+MEMORY_SCHEDULER = None
+
+# 会话的滚动场景总结调度（在 main 中按 --summary-every / --summary-idle 配置）
+SUMMARY_SCHEDULER = None
+
+# 上游 429/5xx 和连接错误的重试策略（在 main 中按 --retries 等参数配置）
+RETRY_POLICY = RetryPolicy()
+
+# 可以重试的连接错误（读写超时不重试）
+RETRYABLE_ERRORS = (ConnectionError, http.client.HTTPException)
+
+# 对冲请求（默认关闭，使用 --hedge 启用）：只用于玩家等待中的非流式请求，故事、预取和后台类别不对冲
+HEDGER = None
+HEDGE_CLASSES = frozenset(('dialogue', 'greeting', 'summary'))
+
+# 按请求类别选择模型，延迟超过 SLO 时改用更快的模型（默认关闭，使用 --model-routing 启用）
+MODEL_ROUTER = None
+
+# 监视等待上游的客户端连接和请求截止时间，客户端断开或超时时中断上游请求
+DISCONNECT_WATCHER = DisconnectWatcher()
+
+# 推测性预取的结果槽位（在 main 中按 --prefetch-ttl 配置）
+PREFETCH = PrefetchStore()
+
+# 记忆接口路径：/api/memory/<玩家 ID>[/export|patch|update|import|clear]
+MEMORY_PATH = re.compile(r'^/api/memory/([A-Za-z0-9_-]{1,64})(?:/([a-z]+))?$')
+
+# 多进程模式下本工作进程的 WorkerContext（单进程模式为 None）
+WORKERS = None
+
+# 多进程模式下需要看请求体才能确定由哪个工作进程处理的接口
+OWNED_BODY_PATHS = ('/api/session', '/api/scene/end', '/api/prefetch', '/api/prefetch/take', '/api/prefetch/cancel')
+
+# 在工作进程之间转发请求时不转发的逐跳请求头/响应头
+HOP_BY_HOP_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te',
+                                'trailer', 'upgrade', 'host'))
+
+# 完整读取后的上游响应
+UpstreamResult = namedtuple('UpstreamResult', ['status', 'content_type', 'body'])
+
+
+def collect_component_metrics():
+    """把连接池、缓存和请求合并的统计信息导出为指标"""
+    samples = []
+    pool = UPSTREAM_POOL.stats()
+    samples += [
+        ('proxy_upstream_connections_opened_total', 'counter', '新建的上游连接数', pool['connections_opened']),
+        ('proxy_upstream_connections_reused_total', 'counter', '复用的上游连接次数', pool['connections_reused']),
+        ('proxy_upstream_connect_saved_seconds_total', 'counter', '复用连接节省的建连时间估计',
+         pool['connect_ms_saved'] / 1000),
+        ('proxy_upstream_idle_connections', 'gauge', '连接池中的空闲连接数', pool['idle_connections']),
+    ]
+    if RESPONSE_CACHE is not None:
+        cache = RESPONSE_CACHE.stats()
+        samples += [
+            ('proxy_cache_hits_total', 'counter', '响应缓存命中次数', cache['hits']),
+            ('proxy_cache_misses_total', 'counter', '响应缓存未命中次数', cache['misses']),
+            ('proxy_cache_entries', 'gauge', '内存缓存中的响应数', cache['entries']),
+        ]
+    if COALESCER is not None:
+        coalesce = COALESCER.stats()
+        samples += [
+            ('proxy_coalesced_requests_total', 'counter', '被合并（共享结果）的请求数', coalesce['followers']),
+            ('proxy_coalesce_leader_requests_total', 'counter', '实际发往上游的可合并请求数', coalesce['leaders']),
+        ]
+    samples.append(('proxy_dialogue_sessions', 'gauge', '服务器端保存的对话会话数', len(SESSIONS)))
+    if MEMORY_SCHEDULER is not None:
+        updates = MEMORY_SCHEDULER.stats()
+        samples += [
+            ('proxy_memory_update_turns_total', 'counter', '交给记忆更新调度的对话轮数', updates['turns']),
+            ('proxy_memory_update_calls_total', 'counter', '实际调用记忆模块的次数', updates['calls']),
+            ('proxy_memory_update_failures_total', 'counter', '失败的记忆更新次数', updates['failures']),
+            ('proxy_memory_update_calls_saved_total', 'counter', '合并多轮对话省下的记忆模块调用次数',
+             updates['calls_saved']),
+            ('proxy_memory_update_pending_turns', 'gauge', '等待更新到记忆的对话轮数', updates['pending_turns']),
+        ]
+    if SUMMARY_SCHEDULER is not None:
+        summaries = SUMMARY_SCHEDULER.stats()
+        samples += [
+            ('proxy_rolling_summary_turns_total', 'counter', '交给滚动场景总结的对话轮数', summaries['turns']),
+            ('proxy_rolling_summary_calls_total', 'counter', '更新滚动场景总结的次数', summaries['calls']),
+            ('proxy_rolling_summary_failures_total', 'counter', '失败的滚动总结更新次数', summaries['failures']),
+            ('proxy_rolling_summary_pending_turns', 'gauge', '尚未合并进滚动总结的对话轮数',
+             summaries['pending_turns']),
+        ]
+    prefetch = PREFETCH.stats()
+    samples += [
+        ('proxy_prefetch_started_total', 'counter', '开始的预取次数', prefetch['started']),
+        ('proxy_prefetch_hits_total', 'counter', '被取走使用的预取次数', prefetch['hits']),
+        ('proxy_prefetch_misses_total', 'counter', '取预取结果时没有可用结果的次数', prefetch['misses']),
+        ('proxy_prefetch_cancelled_total', 'counter', '生成中被取消的预取次数', prefetch['cancelled']),
+        ('proxy_prefetch_expired_total', 'counter', '过期未取走的预取次数', prefetch['expired']),
+    ]
+    if HEDGER is not None:
+        hedge = HEDGER.stats()
+        samples += [
+            ('proxy_hedge_candidates_total', 'counter', '可以对冲的非流式请求数', hedge['requests']),
+            ('proxy_hedge_requests_total', 'counter', '发出的对冲请求数', hedge['hedged']),
+            ('proxy_hedge_wins_total', 'counter', '对冲请求先于原请求完成的次数', hedge['hedge_wins']),
+            ('proxy_hedge_over_budget_total', 'counter', '因超出对冲预算而没有发出对冲请求的次数',
+             hedge['over_budget']),
+            ('proxy_hedge_no_slot_total', 'counter', '因没有空闲的上游并发槽位或限流令牌而没有发出对冲请求的次数',
+             hedge['no_slot']),
+        ]
+    if ADMISSION is not None and ADMISSION.slots is not None:
+        samples.append(('proxy_admission_queued_requests', 'gauge', '正在排队等待上游并发槽位的请求数',
+                        sum(ADMISSION.slots.queued().values())))
+    if MODEL_ROUTER is not None:
+        routing = MODEL_ROUTER.stats()
+        for decision in routing['decisions']:
+            samples.append(('proxy_model_routed_requests_total', 'counter', '按请求类别路由到各模型的请求数',
+                            decision['count'],
+                            {'class': decision['class'], 'model': decision['model'], 'reason': decision['reason']}))
+        for window in routing['windows']:
+            labels = {'class': window['class'], 'model': window['model']}
+            samples += [
+                ('proxy_model_fallback_active', 'gauge', '该类别的主模型是否因超过 SLO 正在改用更快的模型',
+                 int(window['fallback_active']), labels),
+                ('proxy_model_fallbacks_total', 'counter', '该类别的主模型 p95 耗时超过 SLO 的次数',
+                 window['fallbacks'], labels),
+            ]
+    for upstream in UPSTREAM_ROUTER.stats():
+        labels = {'upstream': upstream['name']}
+        samples += [
+            ('proxy_upstream_healthy', 'gauge', '上游是否参与路由（1 为健康，0 为已摘除；多进程模式下为合计）',
+             int(upstream['healthy']), labels),
+            ('proxy_upstream_outstanding_requests', 'gauge', '发往该上游的进行中请求数', upstream['outstanding'], labels),
+            ('proxy_upstream_routed_requests_total', 'counter', '路由到该上游的请求数（含重试）',
+             upstream['requests'], labels),
+            ('proxy_upstream_routed_errors_total', 'counter', '该上游的失败次数（连接错误、429、5xx 等）',
+             upstream['errors'], labels),
+            ('proxy_upstream_ejections_total', 'counter', '该上游因连续失败被摘除的次数', upstream['ejections'], labels),
+        ]
+    return samples
+
+
+metrics.REGISTRY.register_collector(collect_component_metrics)
+
+
+def parse_usage(body):
+    """从完整的 JSON 响应体中解析 usage，没有时返回 None"""
+    try:
+        usage = json.loads(body).get('usage')
+    except (ValueError, AttributeError):
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+def log_pool_usage(response):
+    """记录本次请求复用连接节省的建连/握手时间"""
+    if response.reused:
+        print(f"[POOL] 复用上游连接，节省约 {response.connect_ms:.1f} ms（DNS/TCP/TLS 握手）")
+    else:
+        print(f"[POOL] 新建上游连接，建连耗时 {response.connect_ms:.1f} ms")
+
+
+def sniff_model(body):
+    """不解析 JSON，从请求体开头找出 model 字段，找不到时返回 'unknown'"""
+    match = MODEL_FIELD.search(body, 0, MODEL_SNIFF_BYTES)
+    return match.group(1).decode('utf-8', 'replace') if match else 'unknown'
+
+
+def bearer_token(authorization):
+    """从 Authorization: Bearer ... 请求头中取出 API Key，没有时返回 None"""
+    scheme, _, token = (authorization or '').partition(' ')
+    return (token.strip() or None) if scheme.lower() == 'bearer' else None
+
+
+def client_api_key(api_key):
+    """浏览器提供的 API Key；没有提供但所有上游都配置了服务器端的 Key 时返回 SERVER_KEY_PLACEHOLDER"""
+    if api_key:
+        return api_key
+    return SERVER_KEY_PLACEHOLDER if UPSTREAM_ROUTER.server_keys else None
+
+
+def open_upstream(request_data, api_key, scope=None):
+    """编码请求体并通过连接池向 OpenAI 发送请求，返回 PooledResponse（见 send_upstream）"""
+    return send_upstream(json.dumps(request_data).encode('utf-8'), api_key, scope)
+
+
+def routed_connection(upstream, scope=None):
+    """UpstreamPool.request 的 on_connection：响应关闭时把上游的进行中请求数减一，传入 scope 时记下连接以便中断
+
+    连接池放弃的连接（dropped=True，例如失效后换新连接重试）只从 scope 中移除，请求仍在进行。
+    """
+    def on_connection(conn):
+        detach = scope.attach(conn) if scope is not None else None
+
+        def on_close(dropped=False):
+            if not dropped:
+                UPSTREAM_ROUTER.release(upstream)
+            return detach() if detach is not None else False
+        return on_close
+    return on_connection
+
+
+def send_upstream(body, api_key, scope=None):
+    """通过连接池把已编码的请求体发给 UPSTREAM_ROUTER 选出的上游，返回 PooledResponse（复用 keep-alive 连接）
+
+    上游配置了服务器端的 API Key 时使用它，否则使用浏览器提供的 api_key。
+    上游返回 429/5xx 或连接出错时重试：还有其他健康的上游时立即换一个，否则按 RETRY_POLICY 退避后重试，
+    重试用尽后返回最后一次的响应（或抛出异常）。
+    传入 CancelScope 时，读写超时和重试等待都不超过请求剩余的截止时间，客户端断开或超时时上游连接会被关闭。
+    """
+    attempt = 0
+    failed = []
+    while True:
+        remaining = scope.remaining() if scope is not None else None
+        upstream = UPSTREAM_ROUTER.acquire(exclude=failed)
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {upstream.api_key or api_key}'
+        }
+        started = time.perf_counter()
+        try:
+            response = UPSTREAM_POOL.request(
+                'POST',
+                upstream.chat_url,
+                body=body,
+                headers=headers,
+                timeout=scope.timeout(UPSTREAM_POOL.timeout) if scope is not None else None,
+                on_connection=routed_connection(upstream, scope)
+            )
+        except RETRYABLE_ERRORS as e:
+            UPSTREAM_ROUTER.release(upstream)
+            if scope is not None:
+                scope.check()   # 中断导致的连接错误不重试，也不算上游的失败
+            UPSTREAM_ROUTER.record(upstream)
+            failed.append(upstream)
+            delay = RETRY_POLICY.next_delay(attempt, remaining=remaining)
+            if delay is None:
+                raise
+            if UPSTREAM_ROUTER.available(exclude=failed):
+                delay = 0.0
+            reason = 'connection'
+            print(f"[RETRY] 上游 {upstream.name} 连接出错（{e.__class__.__name__}），"
+                  f"{delay:.2f}s 后第 {attempt + 1} 次重试")
+        except BaseException:
+            UPSTREAM_ROUTER.release(upstream)
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            UPSTREAM_ROUTER.record(upstream, response.status, elapsed)
+            metrics.UPSTREAM_RESPONSE_TIME.observe(upstream.name, value=elapsed)
+            log_pool_usage(response)
+            alternative = upstream.is_failure(response.status) and UPSTREAM_ROUTER.available(exclude=failed + [upstream])
+            # 换一个上游时不必等当前上游要求的 Retry-After
+            retry_after = None if alternative else response.headers.get('Retry-After')
+            delay = RETRY_POLICY.next_delay(attempt, response.status, retry_after, remaining)
+            if delay is None:
+                return response
+            with response:
+                response.read()   # 读完错误响应，连接可以继续复用
+            failed.append(upstream)
+            if alternative:
+                delay = 0.0
+            reason = str(response.status)
+            print(f"[RETRY] 上游 {upstream.name} 返回 HTTP {response.status}，{delay:.2f}s 后第 {attempt + 1} 次重试")
+        metrics.UPSTREAM_RETRIES.inc(reason)
+        time.sleep(delay)
+        attempt += 1
+
+
+def probe_upstream(upstream):
+    """探测被摘除的上游：GET /models 的状态码不说明上游有问题（见 Upstream.is_failure）即认为已恢复"""
+    headers = {'Authorization': f'Bearer {upstream.api_key}'} if upstream.api_key else {}
+    with UPSTREAM_POOL.request('GET', upstream.base_url + '/models', headers=headers, timeout=10) as response:
+        response.read()
+        return not upstream.is_failure(response.status)
+
+
+def fetch_upstream(request_data, api_key, scope=None, hedge=None):
+    """请求上游并完整读取响应，返回 (UpstreamResult, 首字节耗时, 总耗时)
+
+    hedge 为请求类别且启用了对冲时，超过该模型、该类别近期 p95 延迟仍未返回就再发一个相同的请求，取先成功的。
+    """
+    if hedge is not None and HEDGER is not None:
+        return HEDGER.run(f"{request_data.get('model', 'unknown')}/{hedge}",
+                          lambda attempt_scope: read_upstream(request_data, api_key, attempt_scope),
+                          scope, accept=lambda value: value[0].status == 200,
+                          admit=lambda: hedge_admission(api_key))
+    return read_upstream(request_data, api_key, scope)
+
+
+def read_upstream(request_data, api_key, scope=None):
+    """请求一次上游（含重试）并完整读取响应，返回 (UpstreamResult, 首字节耗时, 总耗时)"""
+    started = time.perf_counter()
+    ttfb = None
+    with open_upstream(request_data, api_key, scope) as response:
+        chunks = []
+        while True:
+            chunk = response.read(RELAY_CHUNK_SIZE)
+            if not chunk:
+                break
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            chunks.append(chunk)
+        elapsed = time.perf_counter() - started
+        result = UpstreamResult(
+            response.status,
+            response.headers.get('Content-Type', 'application/json'),
+            b''.join(chunks)
+        )
+    if scope is not None:
+        scope.check_interrupted()
+    return result, (elapsed if ttfb is None else ttfb), elapsed
+
+
+@contextmanager
+def admission_slot(api_key, priority, scope=None):
+    """按请求类别和 API Key 等待准入，返回排队时间（秒）；with 块结束时归还上游并发槽位
+
+    传入 CancelScope 时最多排队到请求的截止时间，排队期间客户端已断开的请求拿到槽位后立即放弃。
+    """
+    if ADMISSION is None:
+        yield None
+        return
+    try:
+        ticket = ADMISSION.admit(api_key, priority, max_wait=scope.remaining() if scope is not None else None)
+    except AdmissionRejected:
+        if scope is not None:
+            scope.check()   # 先到的是截止时间：按超时处理，而不是 429
+        raise
+    with ticket:
+        metrics.QUEUE_WAIT.observe(priority, value=ticket.queue_wait)
+        if ticket.queue_wait >= 0.001:
+            print(f"[QUEUE] {priority} 请求排队 {ticket.queue_wait * 1000:.0f} ms")
+        if scope is not None:
+            scope.check()
+        yield ticket.queue_wait
+
+
+def hedge_admission(api_key):
+    """对冲请求的准入：不排队，也不等待限流令牌，额度不是立即可用时返回 None（不发出对冲请求）
+
+    返回对冲请求结束时调用的释放函数。对冲请求与原请求各占一个上游并发槽位和一个令牌。
+    """
+    if ADMISSION is None:
+        return lambda: None
+    ticket = ADMISSION.try_admit(api_key)
+    return ticket.release if ticket is not None else None
+
+
+def record_upstream_metrics(model, result, ttfb, elapsed):
+    """记录一次不经过客户端连接的上游调用（批量请求的子请求、后台记忆更新）的延迟和 token 用量"""
+    metrics.UPSTREAM_LATENCY.observe(model, str(result.status), value=elapsed)
+    metrics.UPSTREAM_TTFB.observe(model, str(result.status), value=ttfb)
+    usage = parse_usage(result.body) if result.status == 200 else None
+    if usage:
+        metrics.PROMPT_TOKENS.inc(model, str(result.status), amount=usage.get('prompt_tokens') or 0)
+        metrics.COMPLETION_TOKENS.inc(model, str(result.status), amount=usage.get('completion_tokens') or 0)
+
+
+def aborted_status(reason):
+    """被中断的请求记录的状态码：超过截止时间为 504，客户端断开为 499（与 nginx 相同）"""
+    return 504 if reason == REASON_DEADLINE else 499
+
+
+def aborted_error(e):
+    """RequestAborted 对应的错误信息（OpenAI 的 error 格式）"""
+    if e.reason == REASON_DEADLINE:
+        return {'message': str(e), 'type': 'proxy_deadline', 'code': 'deadline_exceeded'}
+    return {'message': str(e), 'type': 'proxy_cancelled', 'code': 'client_disconnected'}
+
+
+def stream_delta(data):
+    """从一个 SSE data 行中取出增量文本，没有时返回 None"""
+    try:
+        return json.loads(data)['choices'][0]['delta'].get('content')
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def route_model(request_data, request_class):
+    """按 MODEL_ROUTER 为请求类别选择模型，返回 (改写 model 后的请求, RoutingDecision)；未启用时返回 (原请求, None)"""
+    if MODEL_ROUTER is None:
+        return request_data, None
+    decision = MODEL_ROUTER.route(request_class, request_data.get('model'))
+    if decision.model != decision.requested:
+        request_data = dict(request_data, model=decision.model)
+    return request_data, decision
+
+
+def finish_route(decision, status, elapsed):
+    """记录路由决定的结果（写路由日志、统计主模型的耗时），decision 为 None 时什么也不做"""
+    if decision is not None:
+        MODEL_ROUTER.finish(decision, status, elapsed)
+
+
+def hedge_class(priority):
+    """请求类别在 HEDGE_CLASSES 中且启用了对冲时返回类别，否则返回 None（故事、预取、记忆更新、信件等不对冲）"""
+    return priority if HEDGER is not None and priority in HEDGE_CLASSES else None
+
+
+def complete_buffered(request_data, api_key, priority, scope=None, route=None):
+    """不经过客户端连接调用一次上游：等待准入、完整读取响应并记录指标，返回 (UpstreamResult, 排队时间)
+
+    route 为 route_model 返回的路由决定，调用结束时记录结果。
+    """
+    status = elapsed = None
+    try:
+        with admission_slot(api_key, priority, scope) as queue_wait:
+            result, ttfb, elapsed = fetch_upstream(request_data, api_key, scope, hedge=hedge_class(priority))
+        status = result.status
+    finally:
+        finish_route(route, status, elapsed)
+    record_upstream_metrics(str(request_data.get('model', 'unknown')), result, ttfb, elapsed)
+    return result, queue_wait
+
+
+def stream_completion(request_data, api_key, priority, on_delta, scope=None, route=None):
+    """同 complete_buffered，但以流式请求上游，每收到一段增量文本调用 on_delta
+
+    返回 UpstreamResult：成功时 body 为拼接好的完整回复文本（UTF-8），失败时为上游的错误响应体。
+    """
+    started = time.perf_counter()
+    ttfb = None
+    status = None
+    try:
+        with admission_slot(api_key, priority, scope):
+            with open_upstream(dict(request_data, stream=True), api_key, scope) as response:
+                if response.status != 200:
+                    result = UpstreamResult(response.status, response.headers.get('Content-Type', 'application/json'),
+                                            response.read())
+                else:
+                    parts = []
+                    while True:
+                        line = response.readline()
+                        if not line:
+                            break
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - started
+                        delta = stream_delta(line[5:]) if line.startswith(b'data:') else None
+                        if delta:
+                            parts.append(delta)
+                            on_delta(delta)
+                    result = UpstreamResult(200, 'text/plain; charset=utf-8', ''.join(parts).encode('utf-8'))
+            if scope is not None:
+                scope.check_interrupted()
+        status = result.status
+    finally:
+        elapsed = time.perf_counter() - started
+        finish_route(route, status, elapsed)
+    record_upstream_metrics(str(request_data.get('model', 'unknown')), result,
+                            elapsed if ttfb is None else ttfb, elapsed)
+    return result
+
+
+def memory_update_request(job, conversation):
+    """组装记忆模块的请求：提示词中只包含记忆的紧凑视图（prompt_view），而不是整个记忆文档
+
+    job 中包含 player_id、model、system_prompt、scene 和可选的 temperature。
+    """
+    prompt = MEMORY_UPDATE_PROMPT.format(
+        scene=job.get('scene', ''),
+        conversation=format_conversation(conversation),
+        memory_view=prompt_view(MEMORY_STORE.load(job['player_id'])),
+    )
+    return {
+        'model': job.get('model'),
+        'messages': [
+            {'role': 'system', 'content': job.get('system_prompt', '')},
+            {'role': 'user', 'content': prompt},
+        ],
+        'temperature': job.get('temperature', 0.7),
+        'response_format': {'type': 'json_object'},
+    }
+
+
+def parse_memory_updates(body):
+    """从记忆模块的响应中取出更新指令，格式不对时抛出 ValueError"""
+    try:
+        return json.loads(json.loads(body)['choices'][0]['message']['content'])
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError(f"缺少字段 {e}") from e
+
+
+def run_memory_update(job, conversation, turns):
+    """MEMORY_SCHEDULER 的提交函数：在后台调用一次记忆模块并写入结果"""
+    request_data, route = route_model(memory_update_request(job, conversation), 'memory')
+    model = str(request_data.get('model') or 'unknown')
+    status = 0
+    try:
+        result, _queue_wait = complete_buffered(request_data, job['api_key'], 'memory', route=route)
+        status = result.status
+        if status != 200:
+            raise RuntimeError(f"上游返回 HTTP {status}")
+        changed = MEMORY_STORE.apply_updates(job['player_id'], parse_memory_updates(result.body))
+        print(f"[MEMORY] 玩家 {job['player_id'][:8]} 记忆更新，写入 {changed} 项")
+        return {'turns': turns, 'changed': changed}
+    except AdmissionRejected:
+        status = 429
+        metrics.ADMISSION_REJECTED.inc('memory')
+        raise
+    finally:
+        metrics.REQUESTS.inc(model, str(status))
+
+
+def run_summary_update(job, conversation, turns):
+    """SUMMARY_SCHEDULER 的提交函数：把新的几轮对话合并进会话的滚动场景总结
+
+    提示词只包含之前的总结和新的几轮对话，长度不随场景变长而增加。
+    """
+    session = job['session']
+    request_data, route = route_model({'model': job.get('model')}, 'summary')
+    model = str(request_data.get('model') or 'unknown')
+    status = 0
+    try:
+        prompt = ROLLING_SUMMARY_PROMPT.format(
+            background=job.get('background', ''),
+            summary=session.rolling_summary or '（暂无）',
+            conversation=format_conversation(conversation),
+        )
+        request_data.update({
+            'messages': [
+                {'role': 'system', 'content': job.get('system_prompt', '')},
+                {'role': 'user', 'content': prompt},
+            ],
+            'temperature': job.get('temperature', 0.7),
+        })
+        if job.get('json_mode'):
+            request_data['response_format'] = {'type': 'json_object'}
+        result, _queue_wait = complete_buffered(request_data, job['api_key'], 'summary', route=route)
+        status = result.status
+        if status != 200:
+            raise RuntimeError(f"上游返回 HTTP {status}")
+        session.rolling_summary = json.loads(result.body)['choices'][0]['message']['content']
+        session.summary_turns += turns
+        return session.rolling_summary
+    except AdmissionRejected:
+        status = 429
+        metrics.ADMISSION_REJECTED.inc('summary')
+        raise
+    finally:
+        metrics.REQUESTS.inc(model, str(status))
+
+
+def run_prefetch(slot, request_data, api_key):
+    """PREFETCH 的生成函数：以流式请求上游，预取被取消时断开上游连接（上游随即停止生成）"""
+    request_data, route = route_model(request_data, 'prefetch')
+    model = str(request_data.get('model', 'unknown'))
+    status = 0
+    started = time.perf_counter()
+    try:
+        slot.check()
+        result = stream_completion(request_data, api_key, 'prefetch', lambda _delta: slot.check(), route=route)
+        status = result.status
+        slot.finish((status, result.body.decode('utf-8', errors='replace')))
+        print(f"[PREFETCH] 预取完成（HTTP {status}），耗时 {time.perf_counter() - started:.2f}s")
+    except PrefetchCancelled:
+        status = 499
+        print(f"[PREFETCH] 预取已取消，{time.perf_counter() - started:.2f}s 后中断上游请求")
+    except AdmissionRejected as e:
+        status = 429
+        metrics.ADMISSION_REJECTED.inc('prefetch')
+        slot.finish((status, str(e)))
+    except Exception as e:
+        status = 502
+        slot.finish((status, f"Proxy Error: {e}"))
+    finally:
+        metrics.REQUESTS.inc(model, str(status))
+
 def find_free_port(ports):
     """查找可用的端口"""
     for port in ports:
@@ -30,84 +700,1310 @@ def find_free_port(ports):
             continue
     return None
 
-PORT = find_free_port(PORTS_TO_TRY)
-if PORT is None:
-    print("错误：所有常用端口都被占用")
-    print(f"尝试的端口: {PORTS_TO_TRY}")
-    sys.exit(1)
 
 class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """带 OpenAI API 代理功能的 HTTP 请求处理器"""
     
+    # 当前 API 请求的 CancelScope（不在 API 请求中时为 None）
+    _scope = None
+    
+    # 多进程模式下路由时已读取的请求体（read_body 直接返回它）
+    _body = None
+
+    # 浏览器与代理之间使用持久连接（HTTP/1.1），每个响应都带 Content-Length 或使用分块编码
+    protocol_version = 'HTTP/1.1'
+
+    # 当前响应是否使用分块编码（长度事先未知的流式响应）
+    _chunked = False
+
+    # 尚未从连接读取的请求体字节数
+    _unread_body = 0
+
+    _bytes_out = 0
+
+    def setup(self):
+        self.timeout = KEEPALIVE_TIMEOUT   # 请求之间空闲超过这么久关闭连接
+        super().setup()
+        self._connection_requests = 0
+
+    def parse_request(self):
+        """读完请求头后调用：统计连接复用情况，记下请求体长度"""
+        if not super().parse_request():
+            return False
+        self._connection_requests += 1
+        self._chunked = False
+        self.mark_connection_busy(True)
+        try:
+            self._unread_body = max(0, int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            self._unread_body = 0
+            self.close_connection = True
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            # 不支持分块编码的请求体，处理完这个请求后无法确定下一个请求从哪里开始
+            self.close_connection = True
+        if not self.headers.get(FORWARDED_HEADER):
+            if self._connection_requests == 1:
+                metrics.CLIENT_CONNECTIONS.inc()
+            metrics.CLIENT_REQUESTS.inc('true' if self._connection_requests > 1 else 'false')
+        return True
+
+    def handle_one_request(self):
+        """处理连接上的一个请求；处理完后结束分块响应、丢弃未读的请求体，连接回到空闲状态"""
+        try:
+            super().handle_one_request()
+            if not self.close_connection:
+                if self._chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+                self.discard_unread_body()
+        except OSError:
+            self.close_connection = True
+        finally:
+            self._chunked = False
+            self.mark_connection_busy(False)
+
+    def mark_connection_busy(self, busy):
+        """告诉服务器连接是否正在处理请求（停止时直接关闭空闲的持久连接）"""
+        mark = getattr(self.server, 'mark_connection', None)
+        if mark is not None:
+            mark(self.connection, busy)
+
+    def discard_unread_body(self):
+        """读掉处理器没有读取的请求体，以便读取同一连接上的下一个请求；太大时关闭连接"""
+        if self._unread_body > MAX_DISCARD_BODY:
+            self.close_connection = True
+        elif self._unread_body:
+            self.read_raw_body()
+
+    def read_raw_body(self):
+        """从连接读取整个请求体（只能读一次，再次调用返回空）"""
+        length, self._unread_body = self._unread_body, 0
+        return self.rfile.read(length) if length else b''
+
+    def start_chunked(self):
+        """长度事先未知的响应（SSE/NDJSON 流）在 end_headers 之前调用
+
+        HTTP/1.1 客户端使用分块编码，响应结束后连接可以继续复用；HTTP/1.0 客户端以关闭连接表示响应结束。
+        """
+        if self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self._chunked = True
+        else:
+            self.close_connection = True
+
     def end_headers(self):
-        # 添加 CORS 头
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        # 只为 API 请求添加 CORS 头，静态文件不需要
+        if self.path.startswith('/api/'):
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers',
+                             f'Content-Type, Authorization, X-Proxy-Cache, X-Request-Priority, {DEADLINE_HEADER}')
+            self.send_header('Access-Control-Expose-Headers',
+                             'X-Proxy-Cache, X-Proxy-Coalesced, X-Queue-Wait-Ms, Retry-After')
+        # 本次 API 请求附加的响应头（例如缓存命中情况）
+        for name, value in getattr(self, '_extra_headers', {}).items():
+            self.send_header(name, value)
+        self._extra_headers = {}
+        # 达到单连接请求数上限、服务器不允许复用连接（单线程模式或正在停止）或请求体太大读不完时，
+        # 本次响应后关闭连接
+        if (self._connection_requests >= KEEPALIVE_MAX_REQUESTS or not getattr(self.server, 'keep_alive', False)
+                or self._unread_body > MAX_DISCARD_BODY):
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            if self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+            self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT:g}, '
+                                           f'max={KEEPALIVE_MAX_REQUESTS - self._connection_requests}')
         super().end_headers()
+
+    def send_error(self, code, message=None, explain=None):
+        """发送错误响应：API 请求返回与 OpenAI 相同格式的 JSON，其他请求返回默认的 HTML 错误页
+
+        与默认实现不同，响应带 Content-Length 且不强制关闭连接，浏览器可以继续复用这条连接；
+        状态行使用标准的原因短语（message 可能包含非 Latin-1 字符，只放在响应体中）。
+        """
+        short, long = self.responses.get(code, ('???', '???'))
+        message = message or short
+        self.log_error("code %d, message %s", code, message)
+        if getattr(self, 'path', '').startswith('/api/'):
+            error_type = 'invalid_request_error' if code < 500 else 'proxy_error'
+            body = json.dumps({'error': {'message': message, 'type': error_type}}, ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = (self.error_message_format % {
+                'code': code,
+                'message': html.escape(message, quote=False),
+                'explain': html.escape(explain or long, quote=False),
+            }).encode('utf-8', 'replace')
+            content_type = self.error_content_type
+        self.send_response(code)
+        has_body = code >= 200 and code not in (204, 205, 304)
+        if has_body:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if has_body and self.command != 'HEAD':
+            self.write_client(body)
+    
+    def do_GET(self):
+        """处理 GET 请求 - 静态文件优先从内存缓存返回"""
+        if self.route_to_owner():
+            return
+        if self.path == '/metrics':
+            self.serve_metrics()
+        elif self.path == '/api/upstreams':
+            self.serve_upstreams()
+        elif self.path.startswith('/api/memory/'):
+            self.serve_memory('GET')
+        elif self.is_private_file():
+            self.send_error(404, "File not found")
+        elif not self.serve_static_asset(head=False):
+            super().do_GET()
+    
+    def do_HEAD(self):
+        if self.is_private_file():
+            self.send_error(404, "File not found")
+        elif not self.serve_static_asset(head=True):
+            super().do_HEAD()
+    
+    def is_private_file(self):
+        """请求的是否为数据库等不能通过静态文件访问的文件"""
+        path = self.translate_path(self.path)
+        if PRIVATE_FILE_PATTERN.search(path):
+            return True
+        real = os.path.realpath(path)
+        return any(real == private or real.startswith(private + '-') for private in PRIVATE_FILES)
+    
+    def serve_static_asset(self, head):
+        """从 STATIC_CACHE 返回静态文件，支持 304 和预压缩；无法处理时返回 False"""
+        if STATIC_CACHE is None:
+            return False
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # 目录请求只处理 index.html，其余（重定向、目录列表）交给默认处理器
+            if not self.path.split('?', 1)[0].endswith('/'):
+                return False
+            path = os.path.join(path, 'index.html')
+        asset = STATIC_CACHE.get(path)
+        if asset is None:
+            return False
+        
+        encoding = STATIC_CACHE.choose_encoding(asset, self.headers.get('Accept-Encoding'))
+        body, etag = asset.variants[encoding]
+        
+        not_modified = self.is_not_modified(asset)
+        if not_modified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', asset.content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not head and not not_modified:
+            self.wfile.write(body)
+        return True
+    
+    def is_not_modified(self, asset):
+        """检查 If-None-Match / If-Modified-Since 条件请求"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            return '*' in tags or bool(tags & asset.etags())
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(asset.mtime) <= since
+        return False
+    
+    def serve_metrics(self):
+        """导出 Prometheus 文本格式的指标（多进程模式下为所有工作进程的合计）"""
+        text = WORKERS.render_metrics() if WORKERS is not None else metrics.REGISTRY.render()
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_upstreams(self):
+        """GET /api/upstreams：各上游的健康状态、进行中请求数和延迟（多进程模式下为处理本请求的工作进程的视图）"""
+        self._extra_headers = {}
+        payload = {'strategy': UPSTREAM_ROUTER.strategy, 'upstreams': UPSTREAM_ROUTER.stats()}
+        if WORKERS is not None:
+            payload['worker'] = WORKERS.index
+        self.send_json(200, payload)
+    
+    def route_to_owner(self):
+        """多进程模式下，把会话、预取和玩家记忆的请求转给保存它们的工作进程，返回是否已转发"""
+        self._body = None
+        if WORKERS is None or self.headers.get(FORWARDED_HEADER):
+            return False
+        owner = self.request_owner()
+        if owner is None or owner == WORKERS.index:
+            return False
+        self.forward_to_worker(owner)
+        return True
+    
+    def request_owner(self):
+        """负责本请求的工作进程序号，任何进程都可以处理时返回 None"""
+        path = self.path.split('?', 1)[0]
+        match = SESSION_TURN_PATH.match(path) or SESSION_END_PATH.match(path)
+        if match:
+            return WORKERS.session_owner(match.group(1))
+        match = MEMORY_PATH.match(path)
+        if match:
+            return WORKERS.owner_of(match.group(1))
+        if self.command != 'POST' or path not in OWNED_BODY_PATHS:
+            return None
+        # 读出的请求体留给 read_body
+        self._body = self.read_raw_body()
+        try:
+            data = json.loads(self._body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if path == '/api/session':
+            # 同一玩家的会话、记忆更新和记忆检索索引都在同一个进程中
+            return WORKERS.owner_of(data['player_id']) if data.get('player_id') else None
+        if path == '/api/scene/end':
+            return WORKERS.session_owner(data.get('session_id'))
+        return WORKERS.owner_of(f"{data.get('api_key')}\0{data.get('key')}")
+    
+    def forward_to_worker(self, index):
+        """把请求转给工作进程 index 的内部端口，响应（包括 SSE/NDJSON 流）原样写回浏览器
+
+        浏览器断开时关闭到内部端口的连接，负责处理的进程随即中断上游请求。
+        """
+        self._response_started = False
+        self._extra_headers = {}
+        self.reset_call_stats()
+        body = self._body if self._body is not None else self.read_raw_body()
+        self._body = None
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        headers[FORWARDED_HEADER] = str(WORKERS.index)
+        with DISCONNECT_WATCHER.scope() as scope:
+            conn = http.client.HTTPConnection('127.0.0.1', WORKERS.internal_ports[index])
+            try:
+                conn.connect()
+                scope.attach(conn)
+                scope.watch(self.connection)
+                conn.request(self.command, self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                self.send_response(response.status, response.reason)
+                for name, value in response.getheaders():
+                    lowered = name.lower()
+                    # Server/Date 和 CORS 头由本进程重新生成
+                    if lowered in HOP_BY_HOP_HEADERS or lowered in ('server', 'date') \
+                            or lowered.startswith('access-control-'):
+                        continue
+                    self.send_header(name, value)
+                if response.getheader('Content-Length') is None:
+                    self.start_chunked()
+                self.end_headers()
+                while True:
+                    chunk = response.read1(RELAY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.write_client(chunk)
+                    self.wfile.flush()
+            except (OSError, http.client.HTTPException, RequestAborted) as e:
+                if self._response_started or scope.reason is not None:
+                    self.close_connection = True
+                else:
+                    self.send_json(502, {'error': {'message': f"转发到工作进程 {index} 失败: {e}",
+                                                   'type': 'proxy_error'}})
+            finally:
+                conn.close()
     
     def do_OPTIONS(self):
         """处理 OPTIONS 预检请求"""
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def do_POST(self):
         """处理 POST 请求 - 代理 OpenAI API"""
+        if self.route_to_owner():
+            return
         if self.path == '/api/openai':
             self.proxy_openai_request()
+        elif self.path == '/api/openai/passthrough':
+            self.handle_api_call(self.forward_passthrough)
+        elif self.path == '/api/openai/batch':
+            self.proxy_openai_batch()
+        elif self.path == '/api/scene/end':
+            self.end_scene()
+        elif self.path == '/api/prefetch':
+            self.handle_api_call(self.start_prefetch)
+        elif self.path == '/api/prefetch/take':
+            self.handle_api_call(self.take_prefetch)
+        elif self.path == '/api/prefetch/cancel':
+            self.handle_api_call(self.cancel_prefetch)
+        elif self.path == '/api/session':
+            self.handle_api_call(self.create_session)
+        elif SESSION_TURN_PATH.match(self.path):
+            self.handle_api_call(self.session_turn)
+        elif SESSION_END_PATH.match(self.path):
+            self.handle_api_call(self.end_session)
+        elif self.path.startswith('/api/memory/'):
+            self.serve_memory('POST')
         else:
             self.send_error(404, "Not Found")
     
     def proxy_openai_request(self):
         """代理 OpenAI API 请求"""
+        self.handle_api_call(self.forward_completion)
+    
+    def handle_api_call(self, call):
+        """API 请求的公共流程：统计指标，准入被拒时返回 429，超过截止时间返回 504，其他异常返回 500
+
+        请求体读完后开始监视客户端连接，浏览器断开或超过截止时间时中断上游请求。
+        """
+        self._response_started = False
+        self._extra_headers = {}
+        self._model = 'unknown'
+        self._bytes_in = 0
+        self._priority = DEFAULT_PRIORITY_CLASS
+        self._route = None
+        self.reset_call_stats()
+        metrics.IN_FLIGHT.inc()
         try:
-            # 读取请求体
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # 提取 API Key
-            api_key = request_data.pop('api_key', None)
-            if not api_key:
-                self.send_error(400, "Missing API Key")
-                return
-            
-            # 准备转发到 OpenAI 的请求
-            openai_url = 'https://api.openai.com/v1/chat/completions'
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {api_key}'
+            with DISCONNECT_WATCHER.scope(self.request_deadline()) as self._scope:
+                try:
+                    call()
+                except RequestAborted as e:
+                    self.abandon_call(e.reason)
+                except AdmissionRejected as e:
+                    metrics.ADMISSION_REJECTED.inc(self._priority)
+                    print(f"[QUEUE] 拒绝 {self._priority} 请求: {e}，{e.retry_after}s 后重试")
+                    self._extra_headers['Retry-After'] = str(e.retry_after)
+                    self.send_json(429, {'error': {'message': str(e), 'type': 'proxy_admission',
+                                                   'code': 'rate_limited'}})
+                except Exception as e:
+                    if self._scope.poll() is not None:
+                        # 中断上游连接导致的读写错误
+                        self.abandon_call(self._scope.reason)
+                    elif self._response_started:
+                        # 其他错误（响应头已发出时无法再返回错误页，只能断开连接）
+                        self.close_connection = True
+                        print(f"[API] 转发中断: {e}")
+                    else:
+                        self.send_error(500, f"Proxy Error: {str(e)}")
+        finally:
+            self._scope = None
+            metrics.IN_FLIGHT.dec()
+            finish_route(self._route, self._response_code, self._upstream_elapsed)
+            self.record_call_metrics(self._model, self._bytes_in)
+    
+    def request_deadline(self):
+        """请求头 X-Request-Deadline-Ms（剩余毫秒数）对应的截止时间，没有或无效时返回 None"""
+        value = self.headers.get(DEADLINE_HEADER)
+        if not value:
+            return None
+        try:
+            remaining_ms = float(value)
+        except ValueError:
+            return None
+        return time.monotonic() + max(0.0, remaining_ms) / 1000
+    
+    def abandon_call(self, reason):
+        """请求被中断：超过截止时间且尚未响应时返回 504，其他情况只能断开连接"""
+        metrics.ABORTED.inc(reason)
+        print(f"[CANCEL] {self.path} {'客户端已断开' if reason == REASON_DISCONNECTED else '超过截止时间'}，"
+              f"已中断上游请求")
+        error = RequestAborted(reason)
+        if reason == REASON_DEADLINE and not self._response_started:
+            self.send_json(aborted_status(reason), {'error': aborted_error(error)})
+            return
+        self.close_connection = True
+        self._response_code = aborted_status(reason)
+    
+    def read_body(self):
+        """读取原始请求体（路由时已读取的直接返回）；API 请求在读完请求体后开始监视客户端连接"""
+        post_data, self._body = self._body, None
+        if post_data is None:
+            post_data = self.read_raw_body()
+        self._bytes_in = len(post_data)
+        if self._scope is not None:
+            self._scope.watch(self.connection)
+        return post_data
+    
+    def read_json_body(self):
+        """读取并解析 JSON 请求体"""
+        return json.loads(self.read_body().decode('utf-8'))
+    
+    def set_priority(self, declared=None, default=None):
+        """确定请求类别：请求头 X-Request-Priority 优先，其次是请求体中声明的类别"""
+        self._priority = normalize_priority_class(
+            self.headers.get('X-Request-Priority') or declared or default)
+    
+    def apply_model_route(self, request_data):
+        """按请求类别选择模型（见 MODEL_ROUTER），返回改写 model 后的请求；指标按实际使用的模型统计"""
+        request_data, self._route = route_model(request_data, self._priority)
+        self._model = str(request_data.get('model', 'unknown'))
+        return request_data
+    
+    def forward_completion(self):
+        """/api/openai：转发一个 Chat Completions 请求"""
+        request_data = self.read_json_body()
+        self._model = str(request_data.get('model', 'unknown'))
+        
+        # 提取 API Key
+        api_key = client_api_key(request_data.pop('api_key', None))
+        if not api_key:
+            self.send_error(400, "Missing API Key")
+            return
+        
+        # priority 字段只给代理使用，不转发给上游
+        self.set_priority(request_data.pop('priority', None))
+        request_data = self.apply_model_route(request_data)
+        
+        # 可缓存的请求先查缓存
+        cache_key = self.cache_key_for(request_data)
+        if cache_key is not None:
+            self.serve_with_cache(cache_key, request_data, api_key)
+        elif COALESCER is not None and not request_data.get('stream'):
+            self.send_body(*self.fetch_shared(request_data, api_key))
+        else:
+            self.forward_openai_request(request_data, api_key)
+    
+    def forward_passthrough(self):
+        """/api/openai/passthrough：请求体原样转发给上游，响应原样写回
+
+        请求体就是发给 OpenAI 的 Chat Completions 请求，不做 JSON 解析和重新编码（大段对话历史也只读一次）；
+        API Key 放在请求头 Authorization: Bearer ... 中，类别用请求头 X-Request-Priority 声明。
+        不经过响应缓存、请求合并、对冲和模型路由（不改写请求体）。
+        """
+        body = self.read_body()
+        self._model = sniff_model(body)
+        api_key = client_api_key(bearer_token(self.headers.get('Authorization')))
+        if not api_key:
+            self.send_error(400, "Missing API Key")
+            return
+        self.set_priority()
+        self.relay_upstream(body, api_key)
+    
+    def create_session(self):
+        """POST /api/session：创建对话会话
+
+        请求体：{"api_key", "model", "system_prompt", "context", "history": [{"role", "content"}],
+        以及可选的 temperature、response_format}；返回 {"session_id", "history_limit"}。
+        带 player_id（和场景 NPC 列表 npc_names）时，每轮从该玩家的记忆中检索相关条目放入上下文；
+        再带上 memory（{"system_prompt": 记忆模块的 System Prompt, "scene": 场景简介}）时，
+        会话的对话交给 MEMORY_SCHEDULER 缓冲，合并几轮后调用一次记忆模块。
+        带 summary（{"system_prompt": 总结模块的 System Prompt, "background": 故事背景和 NPC 目标,
+        "json_mode"}）时，对话过程中每隔几轮在后台更新滚动场景总结，场景结束时只需合并最后几轮。
+        """
+        data = self.read_json_body()
+        api_key = client_api_key(data.get('api_key'))
+        if not api_key:
+            self.send_error(400, "Missing API Key")
+            return
+        template = {k: data[k] for k in ('model', 'temperature', 'response_format') if k in data}
+        self._model = str(template.get('model', 'unknown'))
+        history = [(msg.get('role'), msg.get('content', '')) for msg in data.get('history') or []]
+        session = SESSIONS.create(api_key, template, data.get('system_prompt', ''),
+                                  data.get('context', ''), history,
+                                  player_id=data.get('player_id'), npc_text=data.get('npc_names', ''))
+        memory = data.get('memory')
+        if session.player_id and isinstance(memory, dict):
+            session.memory_update = {
+                'player_id': session.player_id,
+                'api_key': api_key,
+                'model': template.get('model'),
+                'system_prompt': memory.get('system_prompt', ''),
+                'scene': memory.get('scene', ''),
             }
-            
-            # 创建请求
-            req = urllib.request.Request(
-                openai_url,
-                data=json.dumps(request_data).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
-            
-            # 发送请求并获取响应
-            with urllib.request.urlopen(req, timeout=60) as response:
-                response_data = response.read()
+        summary = data.get('summary')
+        if isinstance(summary, dict) and SUMMARY_SCHEDULER is not None:
+            session.summary_update = {
+                'session': session,
+                'api_key': api_key,
+                'model': template.get('model'),
+                'system_prompt': summary.get('system_prompt', ''),
+                'background': summary.get('background', ''),
+                'json_mode': bool(summary.get('json_mode')),
+            }
+            if history:
+                session.turns += 1
+                SUMMARY_SCHEDULER.add_turn(session.id, session.summary_update, history_conversation(history))
+        self.send_json(200, {'session_id': session.id, 'history_limit': SESSIONS.history_limit})
+    
+    def session_turn(self):
+        """POST /api/session/<id>/turn：发送一轮玩家台词
+
+        请求体：{"content": 玩家台词, "context": 场景上下文（仅在变化时发送）, "stream": 是否流式}。
+        响应与 /api/openai 相同；成功后玩家台词和 NPC 回复追加到会话历史。
+        """
+        session = SESSIONS.get(SESSION_TURN_PATH.match(self.path).group(1))
+        data = self.read_json_body()
+        if session is None:
+            self.send_json(404, {'error': {'message': '会话不存在或已过期', 'type': 'invalid_request_error',
+                                           'code': 'session_not_found'}})
+            return
+        player_line = data.get('content', '')
+        self._model = str(session.request_template.get('model', 'unknown'))
+        self.set_priority(default='dialogue')
+        
+        with session.lock:
+            if data.get('context') is not None:
+                session.context = data['context']
+            request_data = self.apply_model_route(
+                session.build_request(player_line, self.memory_context(session, player_line)))
+            if data.get('stream'):
+                request_data['stream'] = True
+                parts = []
+                self.forward_openai_request(request_data, session.api_key, collect=parts)
+                reply = ''.join(parts)
+            else:
+                result = self.fetch_buffered(request_data, session.api_key)
+                self.send_body(*result)
+                reply = ''
+                if result.status == 200:
+                    try:
+                        reply = json.loads(result.body)['choices'][0]['message']['content']
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        pass
+            if reply:
+                session.record_turn(player_line, reply)
+                conversation = turn_conversation(player_line, reply)
+                if session.memory_update is not None and MEMORY_SCHEDULER is not None:
+                    MEMORY_SCHEDULER.add_turn(session.id, session.memory_update, conversation)
+                if session.summary_update is not None:
+                    session.turns += 1
+                    SUMMARY_SCHEDULER.add_turn(session.id, session.summary_update, conversation)
+    
+    def end_session(self):
+        """POST /api/session/<id>/end：场景结束，提交缓冲的对话并删除会话
+
+        等待记忆更新完成后返回 {"memory_update": {"turns", "changed"} 或 null, "memory": 最新记忆或 null}。
+        """
+        session_id = SESSION_END_PATH.match(self.path).group(1)
+        session = SESSIONS.remove(session_id)
+        # 请求体不需要（可以为空），读掉以便复用连接
+        self.read_body()
+        if session is None:
+            self.send_json(404, {'error': {'message': '会话不存在或已过期', 'type': 'invalid_request_error',
+                                           'code': 'session_not_found'}})
+            return
+        self.send_json(200, self.flush_session_memory(session))
+    
+    @staticmethod
+    def flush_session_memory(session):
+        """提交会话缓冲的对话，等待记忆更新完成，返回 {"memory_update", "memory"}"""
+        result = MEMORY_SCHEDULER.flush(session.id) if MEMORY_SCHEDULER is not None else None
+        memory = MEMORY_STORE.load(session.player_id) if session.player_id else None
+        return {'memory_update': result, 'memory': memory}
+    
+    def read_prefetch_body(self):
+        """读取预取接口的请求体，返回 (api_key, key, 去掉代理字段后的请求或 None)；参数缺失时返回 None"""
+        data = self.read_json_body()
+        api_key = client_api_key(data.get('api_key'))
+        key = data.get('key')
+        if not api_key or not isinstance(key, str) or not key:
+            self.send_json(400, {'error': {'message': "缺少 api_key 或 key", 'type': 'invalid_request_error'}})
+            return None
+        request_data = data.get('request')
+        if isinstance(request_data, dict):
+            request_data = {k: v for k, v in request_data.items() if k not in ('api_key', 'priority', 'stream')}
+            self._model = str(request_data.get('model', 'unknown'))
+        else:
+            request_data = None
+        return api_key, key, request_data
+    
+    def start_prefetch(self):
+        """POST /api/prefetch：开始推测性预取
+
+        请求体：{"api_key", "key": 槽位名, "request": Chat Completions 请求}，返回 202 {"key", "reused"}。
+        同一个 key 正在预取相同的请求时不再重复调用上游；请求不同时取消旧的预取。
+        """
+        parsed = self.read_prefetch_body()
+        if parsed is None:
+            return
+        api_key, key, request_data = parsed
+        if request_data is None:
+            self.send_json(400, {'error': {'message': "request 必须是 JSON 对象", 'type': 'invalid_request_error'}})
+            return
+        _slot, reused = PREFETCH.start(api_key, key, request_fingerprint(request_data),
+                                       lambda slot: run_prefetch(slot, request_data, api_key))
+        print(f"[PREFETCH] {'复用进行中的' if reused else '开始'}预取 {key}")
+        self.send_json(202, {'key': key, 'reused': reused})
+    
+    def take_prefetch(self):
+        """POST /api/prefetch/take：取走预取的结果
+
+        请求体：{"api_key", "key", "request"（可选，与预取的请求不一致时视为未命中）}。
+        仍在生成时等待完成；成功返回 {"content", "waited_ms"}，没有可用结果时返回 404（code 为 prefetch_miss），
+        调用方应改为正常请求。
+        """
+        parsed = self.read_prefetch_body()
+        if parsed is None:
+            return
+        api_key, key, request_data = parsed
+        started = time.perf_counter()
+        fingerprint = request_fingerprint(request_data) if request_data is not None else None
+        slot = PREFETCH.take(api_key, key, fingerprint)
+        if slot is None or slot.result[0] != 200:
+            self.send_json(404, {'error': {'message': '没有可用的预取结果', 'type': 'invalid_request_error',
+                                           'code': 'prefetch_miss'}})
+            return
+        waited_ms = round((time.perf_counter() - started) * 1000)
+        print(f"[PREFETCH] 取走预取 {key}，等待 {waited_ms} ms")
+        self.send_json(200, {'content': slot.result[1], 'waited_ms': waited_ms})
+    
+    def cancel_prefetch(self):
+        """POST /api/prefetch/cancel：{"api_key", "key"}，取消预取（生成中的会中断上游请求）"""
+        parsed = self.read_prefetch_body()
+        if parsed is None:
+            return
+        api_key, key, _request_data = parsed
+        self.send_json(200, {'cancelled': PREFETCH.cancel(api_key, key)})
+    
+    def proxy_openai_batch(self):
+        """批量代理：并发请求上游，每完成一个就以一行 JSON（NDJSON）返回
+
+        请求体：{"api_key": "...", "requests": [Chat Completions 请求, ...]}
+        每行结果：{"index": 序号, "status": 上游状态码, "body": 上游响应}，
+        代理自身的错误（限流、网络错误等）用 "error" 代替 "body"。
+        结果按完成顺序返回，不一定与请求顺序相同。
+        """
+        self._response_started = False
+        self._extra_headers = {}
+        self.reset_call_stats()
+        metrics.IN_FLIGHT.inc()
+        scope = None
+        try:
+            with DISCONNECT_WATCHER.scope(self.request_deadline()) as scope:
+                batch = json.loads(self.read_body().decode('utf-8'))
+                scope.watch(self.connection)
+                api_key = client_api_key(batch.get('api_key'))
+                items = batch.get('requests')
+                if not api_key:
+                    self.send_error(400, "Missing API Key")
+                    return
+                if not isinstance(items, list) or not items or len(items) > MAX_BATCH_SIZE:
+                    self.send_json(400, {'error': {
+                        'message': f"requests 必须是包含 1~{MAX_BATCH_SIZE} 个请求的数组",
+                        'type': 'invalid_request_error'}})
+                    return
+                default_priority = self.headers.get('X-Request-Priority')
+                
+                results = queue.Queue()
+                for index, item in enumerate(items):
+                    threading.Thread(
+                        target=self.run_batch_item,
+                        args=(index, item, api_key, default_priority, results, scope),
+                        daemon=True
+                    ).start()
                 
-                # 返回响应
                 self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('X-Accel-Buffering', 'no')
+                self.start_chunked()
                 self.end_headers()
-                self.wfile.write(response_data)
-                
-        except urllib.error.HTTPError as e:
-            # OpenAI API 错误
-            error_body = e.read().decode('utf-8')
-            self.send_response(e.code)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(error_body.encode('utf-8'))
+                for _ in items:
+                    line = json.dumps(results.get(), ensure_ascii=False) + '\n'
+                    self.write_client(line.encode('utf-8'))
+                    self.wfile.flush()
+                if scope.interrupted:
+                    self.abandon_call(scope.reason)
+        except Exception as e:
+            if scope is not None and scope.poll() is not None:
+                self.abandon_call(scope.reason)
+            elif self._response_started:
+                self.close_connection = True
+                print(f"[API] 批量请求中断: {e}")
+            else:
+                self.send_error(500, f"Proxy Error: {str(e)}")
+        finally:
+            metrics.IN_FLIGHT.dec()
+    
+    def run_batch_item(self, index, item, api_key, default_priority, results, scope=None):
+        """在独立线程中执行批量请求中的一项，把结果放入 results 队列"""
+        model = 'unknown'
+        status = 0
+        line = {'index': index}
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("请求必须是 JSON 对象")
+            priority = normalize_priority_class(item.get('priority') or default_priority)
+            request_data = {k: v for k, v in item.items() if k not in ('api_key', 'priority')}
+            model = str(request_data.get('model', 'unknown'))
+            if request_data.get('stream'):
+                raise ValueError("批量请求不支持 stream")
+            request_data, route = route_model(request_data, priority)
+            model = str(request_data.get('model', 'unknown'))
             
+            result, queue_wait = complete_buffered(request_data, api_key, priority, scope, route=route)
+            status = result.status
+            line['status'] = status
+            if queue_wait is not None:
+                line['queue_wait_ms'] = round(queue_wait * 1000)
+            try:
+                line['body'] = json.loads(result.body)
+            except ValueError:
+                line['body'] = result.body.decode('utf-8', errors='replace')
+        except AdmissionRejected as e:
+            status = 429
+            metrics.ADMISSION_REJECTED.inc(priority)
+            line.update(status=status, retry_after=e.retry_after,
+                        error={'message': str(e), 'type': 'proxy_admission', 'code': 'rate_limited'})
+        except RequestAborted as e:
+            status = aborted_status(e.reason)
+            line.update(status=status, error=aborted_error(e))
+        except ValueError as e:
+            status = 400
+            line.update(status=status, error={'message': str(e), 'type': 'invalid_request_error'})
         except Exception as e:
-            # 其他错误
-            self.send_error(500, f"Proxy Error: {str(e)}")
+            if scope is not None and scope.poll() is not None:
+                # 中断上游连接导致的读写错误
+                status = aborted_status(scope.reason)
+                line.update(status=status, error=aborted_error(RequestAborted(scope.reason)))
+            else:
+                status = 502
+                line.update(status=status, error={'message': f"Proxy Error: {e}", 'type': 'proxy_error'})
+        finally:
+            metrics.REQUESTS.inc(model, str(status))
+            results.put(line)
+    
+    def end_scene(self):
+        """POST /api/scene/end：场景结束流水线
+
+        请求体：{"api_key", "model", "summary", "story", "letter"（可选）, "session_id"（可选）}，
+        summary/story/letter 为 {"system_prompt", "prompt", "json_mode"}，
+        story 和 letter 的 prompt 中的 {{summary}} 会替换为生成的场景总结。
+
+        先流式生成总结，总结完成后并发生成下一幕和信件，总耗时约为 总结 + 两者中较慢的一个；
+        带 session_id 时同时结束对话会话并提交缓冲的记忆更新，会话维护了滚动总结时
+        只把最后几轮合并进滚动总结作为场景总结（此时总结行带 "rolling": true，没有增量文本）。
+        以 NDJSON 返回，每行一个事件：
+        {"section": "summary", "delta": 增量文本}、
+        {"section": 段名, "status": 状态码, "content": 完整文本}（失败时用 "error" 代替 "content"）、
+        {"section": "memory", "status": 200, "memory_update", "memory"}。
+        """
+        self._response_started = False
+        self._extra_headers = {}
+        self.reset_call_stats()
+        metrics.IN_FLIGHT.inc()
+        scope = None
+        try:
+            with DISCONNECT_WATCHER.scope(self.request_deadline()) as scope:
+                data = json.loads(self.read_body().decode('utf-8'))
+                scope.watch(self.connection)
+                api_key = client_api_key(data.get('api_key'))
+                if not api_key:
+                    self.send_error(400, "Missing API Key")
+                    return
+                sections = {name: data[name] for name in SCENE_SECTIONS if isinstance(data.get(name), dict)}
+                if 'summary' not in sections or 'story' not in sections:
+                    self.send_json(400, {'error': {'message': "summary 和 story 为必填项",
+                                                   'type': 'invalid_request_error'}})
+                    return
+                session = SESSIONS.remove(data['session_id']) if data.get('session_id') else None
+                
+                events = queue.Queue()
+                started = time.perf_counter()
+                threading.Thread(target=self.run_scene_pipeline,
+                                 args=(data.get('model'), sections, api_key, events, session, scope),
+                                 daemon=True).start()
+                pending = list(sections)
+                if session is not None:
+                    threading.Thread(target=self.finish_session_memory, args=(session, events), daemon=True).start()
+                    pending.append('memory')
+                
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('X-Accel-Buffering', 'no')
+                self.start_chunked()
+                self.end_headers()
+                aborted_at = None
+                while pending:
+                    remaining = scope.remaining() if aborted_at is None else None
+                    try:
+                        event = events.get(timeout=SCENE_EVENT_POLL if remaining is None
+                                           else min(SCENE_EVENT_POLL, remaining + 0.05))
+                    except queue.Empty:
+                        # poll() 同时检查截止时间；中断后各段应很快结束，超过 SCENE_ABORT_GRACE 仍未结束的不再等待
+                        if scope.poll() is None:
+                            continue
+                        aborted_at = aborted_at or time.monotonic()
+                        if time.monotonic() - aborted_at < SCENE_ABORT_GRACE:
+                            continue
+                        # 记忆更新不受中断影响，会在后台继续完成
+                        error = aborted_error(RequestAborted(scope.reason))
+                        for name in pending:
+                            self.write_client((json.dumps({'section': name, 'status': aborted_status(scope.reason),
+                                                           'error': error}, ensure_ascii=False) + '\n').encode('utf-8'))
+                        print(f"[SCENE] 中断后仍未完成的段: {', '.join(pending)}，不再等待")
+                        break
+                    if 'status' in event:
+                        pending.remove(event['section'])
+                        print(f"[SCENE] {event['section']} 完成（HTTP {event['status']}），"
+                              f"距场景结束 {time.perf_counter() - started:.2f}s")
+                    self.write_client((json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                if scope.interrupted:
+                    self.abandon_call(scope.reason)
+        except Exception as e:
+            if scope is not None and scope.poll() is not None:
+                self.abandon_call(scope.reason)
+            elif self._response_started:
+                self.close_connection = True
+                print(f"[API] 场景结束流水线中断: {e}")
+            else:
+                self.send_error(500, f"Proxy Error: {str(e)}")
+        finally:
+            metrics.IN_FLIGHT.dec()
+    
+    def run_scene_pipeline(self, model, sections, api_key, events, session=None, scope=None):
+        """生成总结，成功后并发生成下一幕和信件；各段的事件放入 events 队列
+
+        客户端断开或超过截止时间（scope）时中断各段的上游请求，会话的记忆更新不受影响。
+        流水线本身出错时，所有还没有交给各段处理的段都放入错误事件，end_scene 不会一直等待。
+        """
+        started = set()     # 已交给 run_scene_section（或已放入结果事件）的段
+        try:
+            summary = None
+            if session is not None and session.summary_update is not None:
+                summary = self.rolling_scene_summary(session, events)
+            if summary is None:
+                started.add('summary')
+                summary = self.run_scene_section('summary', model, sections['summary'], api_key, events,
+                                                 stream=True, scope=scope)
+            started.add('summary')
+            branches = [name for name in SCENE_SECTIONS[1:] if name in sections]
+            for name in branches:
+                if summary is None:
+                    started.add(name)
+                    events.put({'section': name, 'status': 0,
+                                'error': {'message': "场景总结生成失败，已跳过", 'type': 'proxy_error'}})
+                    continue
+                spec = dict(sections[name], prompt=str(sections[name].get('prompt', '')).replace(SUMMARY_PLACEHOLDER, summary))
+                threading.Thread(target=self.run_scene_section, args=(name, model, spec, api_key, events),
+                                 kwargs={'scope': scope}, daemon=True).start()
+                started.add(name)
+        except Exception as e:
+            print(f"[SCENE] 场景结束流水线出错: {e}")
+            for name in sections:
+                if name not in started:
+                    events.put({'section': name, 'status': 500,
+                                'error': {'message': f"Proxy Error: {e}", 'type': 'proxy_error'}})
+    
+    @staticmethod
+    def rolling_scene_summary(session, events):
+        """把尚未总结的最后几轮合并进滚动总结，作为场景总结返回；滚动总结不完整时返回 None"""
+        started = time.perf_counter()
+        SUMMARY_SCHEDULER.flush(session.id)
+        if not session.rolling_summary or session.summary_turns < session.turns:
+            print(f"[SUMMARY] 滚动总结不完整（{session.summary_turns}/{session.turns} 轮），改为完整总结")
+            return None
+        print(f"[SUMMARY] 使用滚动总结，收尾耗时 {time.perf_counter() - started:.2f}s")
+        events.put({'section': 'summary', 'status': 200, 'content': session.rolling_summary, 'rolling': True})
+        return session.rolling_summary
+    
+    def run_scene_section(self, name, model, spec, api_key, events, stream=False, scope=None):
+        """生成流水线中的一段，返回完整文本（失败时返回 None）；无论成功与否都放入一个带 status 的事件"""
+        status = 0
+        event = {'section': name}
+        content = None
+        try:
+            request_data = {
+                'model': model,
+                'messages': [
+                    {'role': 'system', 'content': spec.get('system_prompt', '')},
+                    {'role': 'user', 'content': spec.get('prompt', '')},
+                ],
+                'temperature': spec.get('temperature', 0.7),
+            }
+            if spec.get('json_mode'):
+                request_data['response_format'] = {'type': 'json_object'}
+            request_data, route = route_model(request_data, name)
+            model = request_data['model']
+            if stream:
+                result = stream_completion(request_data, api_key, name,
+                                           lambda delta: events.put({'section': name, 'delta': delta}), scope,
+                                           route=route)
+                if result.status == 200:
+                    content = result.body.decode('utf-8')
+            else:
+                result, _queue_wait = complete_buffered(request_data, api_key, name, scope, route=route)
+                if result.status == 200:
+                    content = json.loads(result.body)['choices'][0]['message']['content']
+            status = result.status
+            if content is None:
+                try:
+                    event['error'] = json.loads(result.body).get('error')
+                except (ValueError, AttributeError):
+                    event['error'] = {'message': result.body.decode('utf-8', errors='replace'), 'type': 'upstream_error'}
+        except AdmissionRejected as e:
+            status = 429
+            metrics.ADMISSION_REJECTED.inc(name)
+            event.update(retry_after=e.retry_after,
+                         error={'message': str(e), 'type': 'proxy_admission', 'code': 'rate_limited'})
+        except RequestAborted as e:
+            status = aborted_status(e.reason)
+            event['error'] = aborted_error(e)
+        except Exception as e:
+            if scope is not None and scope.poll() is not None:
+                # 中断上游连接导致的读写错误
+                status = aborted_status(scope.reason)
+                event['error'] = aborted_error(RequestAborted(scope.reason))
+            else:
+                status = 502
+                event['error'] = {'message': f"Proxy Error: {e}", 'type': 'proxy_error'}
+        finally:
+            metrics.REQUESTS.inc(str(model or 'unknown'), str(status))
+        event['status'] = status
+        if content is not None:
+            event['content'] = content
+        events.put(event)
+        return content
+    
+    def finish_session_memory(self, session, events):
+        """结束对话会话：提交缓冲的对话并等待记忆更新完成"""
+        event = {'section': 'memory'}
+        try:
+            event.update(self.flush_session_memory(session), status=200)
+        except Exception as e:
+            event.update(status=500, error={'message': f"Memory Error: {e}", 'type': 'proxy_error'})
+        events.put(event)
+    
+    def reset_call_stats(self):
+        """清空本次 API 请求的统计数据"""
+        self._response_code = None
+        self._upstream_started = None
+        self._upstream_ttfb = None
+        self._upstream_elapsed = None
+        self._bytes_out = 0
+        self._usage = None
+    
+    def record_call_metrics(self, model, bytes_in):
+        """把本次请求的统计数据写入指标"""
+        status = str(self._response_code or 0)
+        metrics.REQUESTS.inc(model, status)
+        metrics.BYTES_IN.inc(model, status, amount=bytes_in)
+        metrics.BYTES_OUT.inc(model, status, amount=self._bytes_out)
+        if self._upstream_elapsed is not None:
+            metrics.UPSTREAM_LATENCY.observe(model, status, value=self._upstream_elapsed)
+        if self._upstream_ttfb is not None:
+            metrics.UPSTREAM_TTFB.observe(model, status, value=self._upstream_ttfb)
+        if self._usage:
+            metrics.PROMPT_TOKENS.inc(model, status, amount=self._usage.get('prompt_tokens') or 0)
+            metrics.COMPLETION_TOKENS.inc(model, status, amount=self._usage.get('completion_tokens') or 0)
+    
+    def mark_upstream_progress(self, finished=False):
+        """记录上游首字节时间，finished 为 True 时记录总耗时"""
+        if self._upstream_started is None:
+            return
+        elapsed = time.perf_counter() - self._upstream_started
+        if self._upstream_ttfb is None:
+            self._upstream_ttfb = elapsed
+        if finished:
+            self._upstream_elapsed = elapsed
+    
+    def note_usage(self, body):
+        """从完整的 JSON 响应体中解析 usage"""
+        usage = parse_usage(body)
+        if usage is not None:
+            self._usage = usage
+    
+    def write_client(self, data):
+        """向浏览器写数据并统计字节数（分块响应中每次写入作为一个块）"""
+        if not data:
+            return
+        if self._chunked:
+            self.wfile.write(b''.join((b'%x\r\n' % len(data), data, b'\r\n')))
+        else:
+            self.wfile.write(data)
+        self._bytes_out += len(data)
+    
+    def send_upstream(self, body, api_key):
+        """发送上游请求并开始计时"""
+        self._upstream_started = time.perf_counter()
+        return send_upstream(body, api_key, self._scope)
+    
+    @contextmanager
+    def admitted(self, api_key, scope=None):
+        """等待准入，并在响应头 X-Queue-Wait-Ms 中报告排队时间"""
+        with admission_slot(api_key, self._priority, scope) as queue_wait:
+            if queue_wait is not None:
+                self._extra_headers['X-Queue-Wait-Ms'] = f'{queue_wait * 1000:.0f}'
+            yield
+    
+    def forward_openai_request(self, request_data, api_key, collect=None):
+        """转发请求并把响应边读边写回浏览器（collect 见 relay_event_stream）"""
+        self.relay_upstream(json.dumps(request_data).encode('utf-8'), api_key, bool(request_data.get('stream')),
+                            collect)
+    
+    def relay_upstream(self, body, api_key, stream=None, collect=None):
+        """发送已编码的请求体并把响应边读边写回浏览器
+
+        stream 为 None 时按上游响应的 Content-Type 判断是否为 SSE 流。
+        """
+        with self.admitted(api_key, self._scope), self.send_upstream(body, api_key) as response:
+            if stream is None:
+                stream = response.headers.get('Content-Type', '').startswith('text/event-stream')
+            # 返回响应（OpenAI 的错误响应原样转发状态码和内容）
+            if stream and response.status == 200:
+                self.relay_event_stream(response, collect)
+            else:
+                self.relay_body(response)
+        if self._scope is not None:
+            # 上游连接被中断时读到的是提前结束的响应
+            self._scope.check_interrupted()
+    
+    def cache_key_for(self, request_data):
+        """返回缓存键；不缓存时返回 None
+
+        只缓存非流式且 temperature 为 0 的请求（结果确定），
+        请求头 X-Proxy-Cache: force 可强制缓存，bypass 可强制跳过。
+        """
+        if RESPONSE_CACHE is None:
+            return None
+        mode = self.headers.get('X-Proxy-Cache', '').strip().lower()
+        # OpenAI 未指定 temperature（或为 null）时默认为 1；无法解析的值交给上游报错，不缓存
+        temperature = request_data.get('temperature')
+        try:
+            deterministic = float(1 if temperature is None else temperature) <= 0
+        except (TypeError, ValueError):
+            deterministic = False
+            mode = 'bypass'
+        if mode == 'bypass' or request_data.get('stream') or not (deterministic or mode == 'force'):
+            self._extra_headers['X-Proxy-Cache'] = 'BYPASS'
+            return None
+        return request_fingerprint(request_data)
+    
+    def serve_with_cache(self, cache_key, request_data, api_key):
+        """命中缓存直接返回，否则请求上游并缓存成功的响应"""
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            self._extra_headers['X-Proxy-Cache'] = 'HIT'
+            self.send_body(200, cached.content_type, cached.body)
+            return
+        
+        result = self.fetch_shared(request_data, api_key)
+        if result.status == 200:
+            RESPONSE_CACHE.put(cache_key, result.content_type, result.body)
+        self._extra_headers['X-Proxy-Cache'] = 'MISS'
+        self.send_body(*result)
+    
+    def fetch_buffered(self, request_data, api_key, cancellable=True):
+        """请求上游并完整读取响应，返回 UpstreamResult
+
+        cancellable 为 False 时（合并后由多个客户端共享的请求）不随本次请求的客户端断开或超时而中断。
+        """
+        scope = self._scope if cancellable else None
+        with self.admitted(api_key, scope):
+            result, self._upstream_ttfb, self._upstream_elapsed = fetch_upstream(
+                request_data, api_key, scope, hedge=hedge_class(self._priority))
+        if result.status == 200:
+            self.note_usage(result.body)
+        return result
+    
+    def fetch_shared(self, request_data, api_key):
+        """同 fetch_buffered，但启用合并时相同的进行中请求只调用一次上游"""
+        if COALESCER is None:
+            return self.fetch_buffered(request_data, api_key)
+        key = request_fingerprint(request_data, api_key)
+        result, shared = COALESCER.do(key, lambda: self.fetch_buffered(request_data, api_key, cancellable=False))
+        if shared:
+            self._extra_headers['X-Proxy-Coalesced'] = '1'
+            stats = COALESCER.stats()
+            print(f"[COALESCE] 合并重复请求（累计 {stats['followers']}/{stats['leaders'] + stats['followers']}，"
+                  f"合并率 {stats['ratio']:.1%}）")
+        return result
+    
+    def send_body(self, status, content_type, body):
+        """发送一个完整的响应体"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write_client(body)
+    
+    def send_json(self, status, payload):
+        """发送 JSON 响应（错误信息使用与 OpenAI 相同的 {"error": {...}} 格式）"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_body(status, 'application/json; charset=utf-8', body)
+    
+    def send_response(self, code, message=None):
+        self._response_started = True
+        self._response_code = code
+        super().send_response(code, message)
+    
+    def serve_memory(self, method):
+        """玩家记忆接口
+
+        GET  /api/memory/<id>          返回完整记忆
+        GET  /api/memory/<id>/export   以附件形式下载完整记忆
+        POST /api/memory/<id>/patch    应用一份更新指令（记忆模块的返回格式）
+        POST /api/memory/<id>/update   在服务器端调用记忆模块分析对话并应用结果
+        POST /api/memory/<id>/import   用上传的完整记忆替换现有记忆
+        POST /api/memory/<id>/clear    清空记忆
+        """
+        match = MEMORY_PATH.match(self.path.split('?', 1)[0])
+        routes = {
+            'GET': {None: self.get_memory, 'export': self.get_memory},
+            'POST': {'patch': self.patch_memory, 'import': self.import_memory, 'clear': self.clear_memory},
+        }
+        if match and method == 'POST' and match.group(2) == 'update':
+            self.handle_api_call(lambda: self.update_memory(match.group(1)))
+            return
+        handler = routes[method].get(match.group(2), None) if match else None
+        if handler is None:
+            self.send_json(404, {'error': {'message': 'Not Found', 'type': 'invalid_request_error'}})
+            return
+        self._extra_headers = {}
+        self.reset_call_stats()
+        try:
+            handler(match.group(1), match.group(2))
+        except ValueError as e:
+            self.send_json(400, {'error': {'message': str(e), 'type': 'invalid_request_error'}})
+        except Exception as e:
+            self.send_json(500, {'error': {'message': f"Memory Error: {e}", 'type': 'proxy_error'}})
+    
+    def get_memory(self, player_id, action):
+        if action == 'export':
+            filename = f"player_memory_{time.strftime('%Y-%m-%d')}.json"
+            self._extra_headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        self.send_json(200, MEMORY_STORE.load(player_id))
+    
+    def patch_memory(self, player_id, _action):
+        changed = MEMORY_STORE.apply_updates(player_id, self.read_json_body())
+        self.send_json(200, {'changed': changed})
+    
+    def import_memory(self, player_id, _action):
+        memory = self.read_json_body()
+        if not isinstance(memory, dict):
+            raise ValueError("记忆必须是 JSON 对象")
+        MEMORY_STORE.replace(player_id, memory)
+        self.send_json(200, MEMORY_STORE.load(player_id))
+    
+    def clear_memory(self, player_id, _action):
+        MEMORY_STORE.clear(player_id)
+        self.send_json(200, {'cleared': True})
+    
+    def update_memory(self, player_id):
+        """调用记忆模块分析最近的对话，把返回的更新指令增量写入记忆
+
+        请求体：{"api_key", "model", "system_prompt", "scene", "conversation": [{"role", "npc_name", "content"}]}
+        提示词中只包含记忆的紧凑视图（prompt_view），而不是整个记忆文档。
+        """
+        data = self.read_json_body()
+        api_key = client_api_key(data.get('api_key'))
+        if not api_key:
+            self.send_error(400, "Missing API Key")
+            return
+        self._model = str(data.get('model', 'unknown'))
+        self.set_priority(default='memory')
+        
+        request_data = self.apply_model_route(
+            memory_update_request(dict(data, player_id=player_id), data.get('conversation') or []))
+        result = self.fetch_buffered(request_data, api_key)
+        if result.status != 200:
+            self.send_body(*result)
+            return
+        try:
+            updates = parse_memory_updates(result.body)
+        except ValueError as e:
+            self.send_json(502, {'error': {'message': f"记忆模块返回的内容无法解析: {e}", 'type': 'proxy_error'}})
+            return
+        changed = MEMORY_STORE.apply_updates(player_id, updates)
+        print(f"[MEMORY] 玩家 {player_id[:8]} 记忆更新，写入 {changed} 项")
+        self.send_json(200, {'updates': updates, 'changed': changed, 'memory': MEMORY_STORE.load(player_id)})
+    
+    def relay_body(self, response):
+        """分块转发普通响应，不在内存中保存完整响应体"""
+        self.send_response(response.status)
+        self.send_header('Content-Type', response.headers.get('Content-Type', 'application/json'))
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        else:
+            self.start_chunked()
+        self.end_headers()
+        captured = []
+        captured_size = 0
+        chunk = response.read(RELAY_CHUNK_SIZE)
+        while chunk:
+            self.mark_upstream_progress()
+            # 多读一块：上游响应读完时先归还上游连接再写最后一块，
+            # 浏览器收完响应立即断开连接时不会被当成中途断开
+            following = response.read(RELAY_CHUNK_SIZE)
+            if not following:
+                self.mark_upstream_progress(finished=True)
+                response.close()
+            self.write_client(chunk)
+            # 保留较小的响应体，用于解析 token 用量
+            captured_size += len(chunk)
+            if captured_size <= USAGE_CAPTURE_LIMIT:
+                captured.append(chunk)
+            chunk = following
+        if self._upstream_elapsed is None:
+            self.mark_upstream_progress(finished=True)
+        if response.status == 200 and captured_size <= USAGE_CAPTURE_LIMIT:
+            self.note_usage(b''.join(captured))
+    
+    def relay_event_stream(self, response, collect=None):
+        """逐个事件转发 Server-Sent Events 流，每个事件结束立即 flush
+
+        传入列表 collect 时，把每个事件中的增量文本依次追加进去（用于拼出完整回复）。
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.start_chunked()
+        self.end_headers()
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            self.mark_upstream_progress()
+            self.write_client(line)
+            if line in (b'\n', b'\r\n'):
+                self.wfile.flush()
+            elif line.startswith(b'data:'):
+                if b'"usage"' in line:
+                    # 开启 stream_options.include_usage 时最后一个事件携带 usage
+                    self.note_usage(line[5:])
+                if collect is not None:
+                    self.collect_delta(line[5:], collect)
+        self.mark_upstream_progress(finished=True)
+        self.wfile.flush()
+    
+    @staticmethod
+    def memory_context(session, player_line):
+        """检索与本轮台词相关的玩家记忆"""
+        if not session.player_id or MEMORY_RETRIEVER is None:
+            return ''
+        started = time.perf_counter()
+        context = MEMORY_RETRIEVER.context_for(session.player_id, player_line, session.npc_text)
+        if context:
+            print(f"[MEMORY] 检索相关记忆 {(time.perf_counter() - started) * 1000:.1f} ms，"
+                  f"约 {estimate_tokens(context)} tokens")
+        return context
+    
+    @staticmethod
+    def collect_delta(data, collect):
+        """从一个 SSE data 行中取出增量文本"""
+        delta = stream_delta(data)
+        if delta:
+            collect.append(delta)
     
     def log_message(self, format, *args):
         """自定义日志输出"""
@@ -115,47 +2011,527 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if self.path.startswith('/api/'):
             print(f"[API] {format % args}")
 
-def main():
+    def log_error(self, format, *args):
+        # 空闲的持久连接超时关闭是正常情况（self.path 还是上一个请求的路径），不输出日志
+        if format.startswith('Request timed out'):
+            return
+        super().log_error(format, *args)
+
+
+class BoundedThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """并发 HTTP 服务器：每条连接一个线程，同时处理的连接数不超过 max_workers
+
+    达到上限时暂停 accept，新连接在内核的监听队列中等待，
+    因此一个耗时 10~60 秒的上游调用不会再阻塞静态文件和其他 API 请求。
+    持久连接在请求之间空闲时仍占用线程，空闲超过 KEEPALIVE_TIMEOUT 后关闭。
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_MAX_WORKERS, reuse_port=False,
+                 bind_and_activate=True):
+        self.max_workers = max_workers
+        self.reuse_port = reuse_port
+        self._worker_slots = threading.BoundedSemaphore(max_workers)
+        self._connections = {}      # 客户端套接字 -> 是否正在处理请求
+        self._connections_lock = threading.Lock()
+        self.draining = False
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def server_bind(self):
+        if self.reuse_port:
+            # 多进程模式：各工作进程各自监听同一端口，由内核分配新连接
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self._worker_slots.acquire()
+        with self._connections_lock:
+            self._connections[request] = False
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._worker_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._worker_slots.release()
+
+    @property
+    def keep_alive(self):
+        """是否允许浏览器复用连接（停止时不再允许）"""
+        return not self.draining
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.pop(request, None)
+        super().shutdown_request(request)
+
+    def mark_connection(self, sock, busy):
+        """处理器在开始和处理完一个请求时调用"""
+        with self._connections_lock:
+            if sock in self._connections:
+                self._connections[sock] = busy
+        if not busy and self.draining:
+            # 停止前开始处理的请求：响应头已经允许复用连接，处理完后直接关闭
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+    def close_idle_connections(self):
+        """关闭请求之间空闲的持久连接（处理器线程读到连接结束后退出），返回关闭的连接数"""
+        with self._connections_lock:
+            idle = [sock for sock, busy in self._connections.items() if not busy]
+        for sock in idle:
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        return len(idle)
+
+    def drain(self, timeout):
+        """等待进行中的请求处理完（最多 timeout 秒），返回是否全部完成
+
+        空闲的持久连接直接关闭，正在处理请求的连接在本次响应后关闭（响应头带 Connection: close）。
+        """
+        self.draining = True
+        self.close_idle_connections()
+        deadline = time.monotonic() + timeout
+        acquired = 0
+        try:
+            while acquired < self.max_workers:
+                if not self._worker_slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                    return False
+                acquired += 1
+            return True
+        finally:
+            for _ in range(acquired):
+                self._worker_slots.release()
+
+
+def create_server(port, serial=False, max_workers=DEFAULT_MAX_WORKERS, handler_class=None, reuse_port=False):
+    """创建服务器实例
+
+    Args:
+        port: 监听端口
+        serial: 是否使用旧的单线程 TCPServer（逐个处理请求）
+        max_workers: 并发模式下的最大并发请求数
+        handler_class: 请求处理器类，默认 ProxyHTTPRequestHandler
+        reuse_port: 是否设置 SO_REUSEPORT（多进程模式）
+    """
+    handler_class = handler_class or ProxyHTTPRequestHandler
+    if serial:
+        return socketserver.TCPServer(("", port), handler_class)
+    return BoundedThreadingHTTPServer(("", port), handler_class, max_workers=max_workers, reuse_port=reuse_port)
+
+
+def create_internal_server(sock, max_workers=DEFAULT_MAX_WORKERS):
+    """在主进程创建好的监听套接字上创建工作进程的内部服务器（接收其他工作进程转发的请求）"""
+    server = BoundedThreadingHTTPServer(sock.getsockname(), ProxyHTTPRequestHandler, max_workers=max_workers,
+                                        bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    return server
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="AI RPG 测试系统 - 带 OpenAI 代理的本地服务器")
+    parser.add_argument('--port', type=int, default=None,
+                        help=f"监听端口（默认自动从 {PORTS_TO_TRY} 中选择）")
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"最大并发连接数（默认 {DEFAULT_MAX_WORKERS}，多进程模式下为每个工作进程的上限）")
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+                        help=f"浏览器持久连接空闲多久后关闭，秒（默认 {KEEPALIVE_TIMEOUT:g}）")
+    parser.add_argument('--keepalive-max-requests', type=int, default=KEEPALIVE_MAX_REQUESTS,
+                        help=f"每条浏览器连接最多处理的请求数，之后关闭连接（默认 {KEEPALIVE_MAX_REQUESTS}）")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="工作进程数（默认 1；大于 1 时为多进程模式，需要 Linux/macOS）")
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help="多进程模式停止时等待进行中请求处理完的最长时间，秒（默认 30）")
+    parser.add_argument('--serial', action='store_true',
+                        help="使用单线程模式逐个处理请求（旧行为，仅用于对比测试）")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="启动后不自动打开浏览器")
+    parser.add_argument('--upstream-base-url',
+                        default=os.environ.get('OPENAI_BASE_URL', DEFAULT_UPSTREAM_BASE_URL),
+                        help=f"上游接口地址（默认 {DEFAULT_UPSTREAM_BASE_URL}，"
+                             f"可指向 mock_openai_server.py 做离线测试）")
+    parser.add_argument('--upstreams', default=None,
+                        help="多上游配置文件（JSON 数组，每项 {\"name\", \"base_url\", \"api_key\" 或 \"api_key_env\"}），"
+                             "指定后忽略 --upstream-base-url")
+    parser.add_argument('--upstream-routing', choices=ROUTING_STRATEGIES, default='least-outstanding',
+                        help="多上游路由策略：进行中请求最少（least-outstanding，默认）或延迟加权（ewma）")
+    parser.add_argument('--upstream-eject-failures', type=int, default=3,
+                        help="上游连续失败多少次后暂时摘除（默认 3）")
+    parser.add_argument('--upstream-eject-seconds', type=float, default=10.0,
+                        help="上游摘除多久后开始探测，秒，探测失败时加倍（默认 10）")
+    parser.add_argument('--no-static-cache', action='store_true',
+                        help="不使用静态文件内存缓存（每次从磁盘读取，不压缩）")
+    parser.add_argument('--pool-size', type=int, default=16,
+                        help="每个上游主机保留的空闲连接数（默认 16）")
+    parser.add_argument('--pool-per-host', type=int, default=64,
+                        help="每个上游主机同时使用的连接上限（默认 64）")
+    parser.add_argument('--pool-idle-timeout', type=float, default=60.0,
+                        help="空闲连接保留时间，秒（默认 60）")
+    parser.add_argument('--upstream-timeout', type=float, default=60.0,
+                        help=f"上游读写超时，秒（默认 60；请求头 {DEADLINE_HEADER} 给出更短的截止时间时以它为准）")
+    parser.add_argument('--pool-warm', type=int, default=2,
+                        help="启动时预先建立的上游连接数（默认 2，0 表示不预热）")
+    parser.add_argument('--cache', action='store_true',
+                        help="启用响应缓存（仅缓存 temperature 为 0 的非流式请求）")
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help="内存缓存最多保存的响应数（默认 256）")
+    parser.add_argument('--cache-ttl', type=float, default=600.0,
+                        help="缓存有效期，秒（默认 600）")
+    parser.add_argument('--cache-db', default=None,
+                        help="SQLite 磁盘缓存文件路径（不指定则只用内存缓存）")
+    parser.add_argument('--cache-db-max-mb', type=float, default=64.0,
+                        help="磁盘缓存大小上限，MB（默认 64）")
+    parser.add_argument('--coalesce', action='store_true',
+                        help="合并同时进行中的相同请求（只调用一次上游，结果分发给所有请求）")
+    parser.add_argument('--session-ttl', type=float, default=3600.0,
+                        help="对话会话空闲多久后失效，秒（默认 3600）")
+    parser.add_argument('--session-history', type=int, default=20,
+                        help="每个对话会话保留的对话条数（默认 20，即 10 轮）")
+    parser.add_argument('--max-sessions', type=int, default=1024,
+                        help="最多保存的对话会话数（默认 1024）")
+    parser.add_argument('--memory-db', default=None,
+                        help="玩家记忆数据库路径（默认为用户数据目录下的 ai_rpg/player_memory.sqlite，"
+                             "Linux/macOS 为 ~/.local/state，Windows 为 %%LOCALAPPDATA%%）")
+    parser.add_argument('--memory-top-k', type=int, default=8,
+                        help="每轮对话最多放入上下文的相关记忆条数（默认 8）")
+    parser.add_argument('--memory-token-budget', type=int, default=300,
+                        help="每轮对话中相关记忆最多占用的 token 数（估计值，默认 300）")
+    parser.add_argument('--memory-flush-turns', type=int, default=4,
+                        help="会话对话缓冲多少轮后调用一次记忆模块（默认 4）")
+    parser.add_argument('--memory-idle-flush', type=float, default=20.0,
+                        help="会话最后一轮对话之后多久没有新对话就更新记忆，秒（默认 20）")
+    parser.add_argument('--summary-every', type=int, default=4,
+                        help="对话过程中每隔多少轮在后台更新一次滚动场景总结（默认 4）")
+    parser.add_argument('--summary-idle', type=float, default=15.0,
+                        help="会话最后一轮对话之后多久没有新对话就更新滚动总结，秒（默认 15）")
+    parser.add_argument('--prefetch-ttl', type=float, default=60.0,
+                        help="预取结果的有效期，秒，过期未取走的预取作废（默认 60）")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="上游返回 429/5xx 或连接出错时的最多重试次数（默认 2，0 表示不重试）")
+    parser.add_argument('--retry-base-delay', type=float, default=0.5,
+                        help="第一次重试前的最长等待，秒，之后每次翻倍并随机抖动（默认 0.5）")
+    parser.add_argument('--retry-max-delay', type=float, default=8.0,
+                        help="单次重试等待的上限，秒；上游的 Retry-After 更长时不再重试（默认 8）")
+    parser.add_argument('--hedge', action='store_true',
+                        help="启用对冲请求：非流式请求超过近期 p95 延迟仍未返回时再发一个相同的请求")
+    parser.add_argument('--hedge-budget', type=float, default=0.1,
+                        help="对冲请求占请求数的比例上限（默认 0.1）")
+    parser.add_argument('--model-routing', default=None,
+                        help="模型路由策略文件（JSON），按请求类别选择模型，p95 耗时超过 SLO 时改用更快的模型")
+    parser.add_argument('--model-routing-log', default=None,
+                        help="路由日志文件（JSON Lines），记录每次路由决定及请求结果，用于离线分析")
+    parser.add_argument('--upstream-concurrency', type=int, default=0,
+                        help="同时发往上游的请求数上限，超出的按优先级排队（默认 0，不限制）")
+    parser.add_argument('--queue-limit', type=int, default=64,
+                        help="每个优先级最多排队的请求数，超出返回 429（默认 64）")
+    parser.add_argument('--queue-timeout', type=float, default=30.0,
+                        help="排队等待的最长时间，秒，超时返回 429（默认 30）")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="每个 API Key 每秒允许的上游请求数（默认 0，不限流）")
+    parser.add_argument('--rate-burst', type=int, default=10,
+                        help="限流令牌桶容量，即允许的突发请求数（默认 10）")
+    parser.add_argument('--rate-max-wait', type=float, default=5.0,
+                        help="等待令牌的最长时间，秒，超过直接返回 429（默认 5）")
+    return parser.parse_args(argv)
+
+def warm_upstream_pool(count):
+    """后台预热上游连接，失败不影响启动"""
+    try:
+        for upstream in UPSTREAM_ROUTER.upstreams:
+            UPSTREAM_POOL.warm(upstream.chat_url, count)
+        print(f"[POOL] 已预热 {count} 条上游连接" + ("（每个上游）" if len(UPSTREAM_ROUTER.upstreams) > 1 else ""))
+    except Exception as e:
+        print(f"[WARN] 上游连接预热失败: {e}")
+
+
+def configure(args):
+    """按命令行参数创建各组件，返回预加载的静态文件数（不使用静态文件缓存时为 None）
+
+    多进程模式下在每个工作进程中调用，各进程有自己的连接池、缓存和会话；
+    上游并发和每个 API Key 的限流额度平均分给各工作进程。
+    """
+    global UPSTREAM_POOL, RESPONSE_CACHE, COALESCER, STATIC_CACHE, UPSTREAM_ROUTER, ADMISSION, SESSIONS
+    global MEMORY_STORE, MEMORY_RETRIEVER, MEMORY_SCHEDULER, SUMMARY_SCHEDULER, PREFETCH, RETRY_POLICY, HEDGER
+    global KEEPALIVE_TIMEOUT, KEEPALIVE_MAX_REQUESTS, MODEL_ROUTER, PRIVATE_FILES
+    workers = WORKERS.count if WORKERS is not None else 1
+    KEEPALIVE_TIMEOUT = args.keepalive_timeout
+    KEEPALIVE_MAX_REQUESTS = max(1, args.keepalive_max_requests)
+    upstreams = load_upstreams(args.upstreams) if args.upstreams else [Upstream('default', args.upstream_base_url)]
+    UPSTREAM_ROUTER = UpstreamRouter(upstreams, strategy=args.upstream_routing,
+                                     failure_threshold=args.upstream_eject_failures,
+                                     eject_seconds=args.upstream_eject_seconds, probe=probe_upstream)
+    UPSTREAM_ROUTER.start()
+    UPSTREAM_POOL = UpstreamPool(
+        max_idle_per_host=args.pool_size,
+        max_per_host=args.pool_per_host,
+        idle_timeout=args.pool_idle_timeout,
+        timeout=args.upstream_timeout,
+    )
+    if args.cache:
+        disk = None
+        if args.cache_db:
+            disk = SqliteCacheTier(args.cache_db, max_bytes=int(args.cache_db_max_mb * 1024 * 1024))
+        RESPONSE_CACHE = ResponseCache(max_entries=args.cache_size, ttl=args.cache_ttl, disk=disk)
+    if args.coalesce:
+        COALESCER = SingleFlight()
+    SESSIONS = SessionStore(max_sessions=args.max_sessions, ttl=args.session_ttl,
+                            history_limit=args.session_history,
+                            id_prefix=WORKERS.session_prefix if WORKERS is not None else '')
+    PREFETCH = PrefetchStore(ttl=args.prefetch_ttl)
+    RETRY_POLICY = RetryPolicy(max_retries=args.retries, base_delay=args.retry_base_delay,
+                               max_delay=args.retry_max_delay)
+    if args.hedge:
+        HEDGER = Hedger(budget=args.hedge_budget)
+    if args.model_routing:
+        MODEL_ROUTER = load_model_routing(args.model_routing, log_path=args.model_routing_log)
+    if args.upstream_concurrency > 0 or args.rate_limit > 0:
+        ADMISSION = AdmissionController(
+            max_concurrent=math.ceil(args.upstream_concurrency / workers),
+            queue_limit=args.queue_limit,
+            queue_timeout=args.queue_timeout,
+            rate=args.rate_limit / workers,
+            burst=max(1, math.ceil(args.rate_burst / workers)),
+            max_rate_wait=args.rate_max_wait,
+        )
+    PRIVATE_FILES = frozenset(os.path.realpath(path) for path in (args.memory_db, args.cache_db) if path)
+    MEMORY_STORE = MemoryStore(args.memory_db)
+    MEMORY_RETRIEVER = MemoryRetriever(MEMORY_STORE, top_k=args.memory_top_k, token_budget=args.memory_token_budget)
+    MEMORY_SCHEDULER = TurnBatchScheduler(run_memory_update, flush_turns=args.memory_flush_turns,
+                                          idle_timeout=args.memory_idle_flush, tag='MEMORY')
+    SUMMARY_SCHEDULER = TurnBatchScheduler(run_summary_update, flush_turns=args.summary_every,
+                                           idle_timeout=args.summary_idle, tag='SUMMARY')
+    if args.no_static_cache:
+        STATIC_CACHE = None
+        return None
+    return STATIC_CACHE.preload(os.getcwd())
+
+
+def print_banner(args, port, preloaded):
+    """打印启动信息（多进程模式下由主进程打印一次）"""
+    url = f"http://localhost:{port}"
     print("=" * 60)
     print("  AI RPG 测试系统 - 代理服务器")
     print("=" * 60)
     print()
-    
-    # 切换到脚本所在目录
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    
+    print(f"[OK] 服务器已启动")
+    print(f"[OK] 使用端口: {port}")
+    if args.workers > 1:
+        print(f"[OK] 运行模式: 多进程（{args.workers} 个工作进程，每个最多 {args.max_workers} 个并发连接）")
+    elif args.serial:
+        print("[OK] 运行模式: 单线程（逐个处理请求）")
+    else:
+        print(f"[OK] 运行模式: 并发（最多 {args.max_workers} 个并发连接）")
+    print(f"[OK] 服务器地址: {url}")
+    print(f"[OK] 浏览器持久连接: 空闲 {args.keepalive_timeout:g}s 后关闭，每条连接最多 {args.keepalive_max_requests} 个请求")
+    print()
+    print(f"请在浏览器中打开: {url}")
+    print()
+    print("[OK] OpenAI API 代理已启用（解决 CORS 问题）")
+    if args.upstreams:
+        upstreams = load_upstreams(args.upstreams)
+        print(f"[OK] 上游: {len(upstreams)} 个，路由策略 {args.upstream_routing}，"
+              f"连续失败 {args.upstream_eject_failures} 次摘除 {args.upstream_eject_seconds:g}s")
+        for upstream in upstreams:
+            print(f"     - {upstream.name}: {upstream.chat_url}（{'服务器端 Key' if upstream.api_key else '浏览器的 Key'}）")
+    else:
+        print(f"[OK] 上游地址: {args.upstream_base_url.rstrip('/')}/chat/completions")
+    print(f"[OK] 上游连接池: 每主机 {args.pool_size} 条空闲连接，"
+          f"上限 {args.pool_per_host}，空闲超时 {args.pool_idle_timeout:g}s")
+    if args.cache:
+        print(f"[OK] 响应缓存已启用: 最多 {args.cache_size} 条，有效期 {args.cache_ttl:g}s"
+              + (f"，磁盘缓存 {args.cache_db}" if args.cache_db else ""))
+    if args.coalesce:
+        print("[OK] 相同请求合并已启用")
+    print(f"[OK] 上游重试: 最多 {args.retries} 次，指数退避 {args.retry_base_delay:g}s 起，"
+          f"上限 {args.retry_max_delay:g}s")
+    if args.hedge:
+        print(f"[OK] 对冲请求已启用: 超过 p95 延迟时发出，预算 {args.hedge_budget:.0%}")
+    if args.model_routing:
+        router = load_model_routing(args.model_routing)
+        print(f"[OK] 模型路由已启用: {args.model_routing}"
+              + (f"，路由日志 {os.path.abspath(args.model_routing_log)}" if args.model_routing_log else ""))
+        for request_class, rule in router.routes.items():
+            slo = f"，p95 超过 {rule.slo_ms:g} ms 改用 {rule.fallback}" if rule.slo_ms is not None else ""
+            print(f"     - {request_class}: {rule.model or '请求中的模型'}{slo}")
+    print(f"[OK] 玩家记忆数据库: {os.path.abspath(args.memory_db)}")
+    print(f"[OK] 记忆更新: 每 {max(1, args.memory_flush_turns)} 轮或空闲 {args.memory_idle_flush:g}s 合并调用一次")
+    print(f"[OK] 滚动场景总结: 每 {max(1, args.summary_every)} 轮或空闲 {args.summary_idle:g}s 更新一次")
+    if args.upstream_concurrency > 0 or args.rate_limit > 0:
+        concurrency = args.upstream_concurrency or '不限'
+        rate = f"{args.rate_limit:g}/s" if args.rate_limit > 0 else '不限'
+        print(f"[OK] 准入控制已启用: 上游并发 {concurrency}，每个 API Key 限流 {rate}"
+              + ("（平均分给各工作进程）" if args.workers > 1 else ""))
+    if preloaded is not None:
+        print(f"[OK] 静态文件缓存: 已预加载并压缩 {preloaded} 个文件")
+    elif not args.no_static_cache:
+        print("[OK] 静态文件缓存: 各工作进程启动时预加载并压缩")
+    print()
+    print("按 Ctrl+C 可停止服务器")
+    print("=" * 60)
+    print()
+
+
+def open_browser(url):
+    """尝试自动打开浏览器"""
+    try:
+        webbrowser.open(url)
+        print("[OK] 已在浏览器中打开")
+    except:
+        print("[WARN] 无法自动打开浏览器，请手动访问上述地址")
+    print()
+
+
+def run_server(args, port):
+    """单进程模式"""
+    preloaded = configure(args)
     try:
-        with socketserver.TCPServer(("", PORT), ProxyHTTPRequestHandler) as httpd:
-            url = f"http://localhost:{PORT}"
-            print(f"[OK] 服务器已启动")
-            print(f"[OK] 使用端口: {PORT}")
-            print(f"[OK] 服务器地址: {url}")
-            print()
-            print(f"请在浏览器中打开: {url}")
-            print()
-            print("[OK] OpenAI API 代理已启用（解决 CORS 问题）")
-            print()
-            print("按 Ctrl+C 可停止服务器")
-            print("=" * 60)
-            print()
+        with create_server(port, serial=args.serial, max_workers=args.max_workers) as httpd:
+            print_banner(args, port, preloaded)
+            if not args.no_browser:
+                open_browser(f"http://localhost:{port}")
             
-            # 尝试自动打开浏览器
-            try:
-                webbrowser.open(url)
-                print("[OK] 已在浏览器中打开")
-            except:
-                print("[WARN] 无法自动打开浏览器，请手动访问上述地址")
+            if args.pool_warm > 0:
+                threading.Thread(target=warm_upstream_pool, args=(args.pool_warm,), daemon=True).start()
             
-            print()
             httpd.serve_forever()
             
     except KeyboardInterrupt:
         print("\n")
+        # 退出前把缓冲的对话写入记忆
+        MEMORY_SCHEDULER.close()
         print("=" * 60)
         print("服务器已停止")
         print("=" * 60)
         sys.exit(0)
 
+
+def run_workers(args, port):
+    """多进程模式：主进程只守护工作进程，请求都由工作进程处理"""
+    if not reuseport_supported():
+        print("错误：当前系统不支持多进程模式（需要 fork 和 SO_REUSEPORT，Windows 不支持），请去掉 --workers")
+        sys.exit(1)
+    if args.serial:
+        print("错误：--serial 不能与 --workers 同时使用")
+        sys.exit(1)
+    supervisor = WorkerSupervisor(args.workers, port, lambda context: run_worker(args, port, context),
+                                  graceful_timeout=args.graceful_timeout)
+    print_banner(args, port, None)
+    if not args.no_browser:
+        open_browser(f"http://localhost:{port}")
+    supervisor.run()
+    print("=" * 60)
+    print("服务器已停止")
+    print("=" * 60)
+
+
+def run_worker(args, port, context):
+    """工作进程：监听公共端口（SO_REUSEPORT）和自己的内部端口
+
+    收到 SIGTERM/SIGINT 后不再接受新连接，等进行中的请求处理完（最多 --graceful-timeout 秒）、
+    缓冲的对话写入记忆后退出。
+    """
+    global WORKERS
+    WORKERS = context
+    configure(args)
+    context.start_snapshots(metrics.REGISTRY)
+    httpd = create_server(port, max_workers=args.max_workers, reuse_port=True)
+    internal = create_internal_server(context.internal_socket, max_workers=args.max_workers)
+    stopping = threading.Event()
+
+    def request_stop(_signum, _frame):
+        if not stopping.is_set():
+            stopping.set()
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    threading.Thread(target=internal.serve_forever, daemon=True).start()
+    if args.pool_warm > 0:
+        threading.Thread(target=warm_upstream_pool, args=(args.pool_warm,), daemon=True).start()
+    print(f"[WORKER] 工作进程 {context.index} 开始处理请求（内部端口 {context.internal_ports[context.index]}）")
+    httpd.serve_forever()
+
+    # 先停止接受新连接，处理完进行中的请求（其中可能有转给其他进程的），再关闭内部端口
+    httpd.server_close()
+    drained = httpd.drain(args.graceful_timeout)
+    internal.shutdown()
+    internal.server_close()
+    drained = internal.drain(args.graceful_timeout) and drained
+    MEMORY_SCHEDULER.close()
+    context.write_snapshot()
+    print(f"[WORKER] 工作进程 {context.index} 已停止" + ("" if drained else "（有请求未在时限内处理完）"))
+
+
+def resolve_paths(args, script_dir):
+    """把命令行中的文件路径转换为绝对路径
+
+    main 会切换到脚本所在目录，命令行中的相对路径应按启动时的当前目录解析。
+    """
+    for name in ('upstreams', 'model_routing', 'model_routing_log', 'cache_db', 'memory_db'):
+        path = getattr(args, name)
+        if path:
+            setattr(args, name, os.path.abspath(path))
+    if not args.memory_db:
+        args.memory_db = default_memory_db(script_dir)
+
+
+def default_memory_db(script_dir):
+    """玩家记忆数据库的默认路径：用户数据目录，不放在作为网站根目录的脚本目录下
+
+    旧版本在脚本目录下创建的数据库仍继续使用（静态文件服务不会返回它），并提示迁移。
+    """
+    legacy = os.path.join(script_dir, 'player_memory.sqlite')
+    if os.path.exists(legacy):
+        print(f"[WARN] 玩家记忆数据库位于网站根目录 {legacy}，建议移到其他目录并用 --memory-db 指定")
+        return legacy
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    directory = os.path.join(base, 'ai_rpg')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, 'player_memory.sqlite')
+
+
+def main():
+    args = parse_args()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    resolve_paths(args, script_dir)
+    # 切换到脚本所在目录
+    os.chdir(script_dir)
+    if args.upstreams:
+        try:
+            load_upstreams(args.upstreams)
+        except (OSError, ValueError) as e:
+            print(f"错误：无法读取上游配置 {args.upstreams}: {e}")
+            sys.exit(1)
+    if args.model_routing:
+        try:
+            load_model_routing(args.model_routing)
+        except (OSError, ValueError) as e:
+            print(f"错误：无法读取模型路由策略 {args.model_routing}: {e}")
+            sys.exit(1)
+    port = args.port or find_free_port(PORTS_TO_TRY)
+    if port is None:
+        print("错误：所有常用端口都被占用")
+        print(f"尝试的端口: {PORTS_TO_TRY}")
+        sys.exit(1)
+    if args.workers > 1:
+        run_workers(args, port)
+    else:
+        run_server(args, port)
+
 if __name__ == "__main__":
     main()
-
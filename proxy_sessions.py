@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+服务器端对话会话
+
+浏览器创建会话时上传一次场景上下文和已有的对话记录，之后每轮只发送玩家的新台词。
+会话在服务器端用定长环形缓冲保存最近的对话，并自己组装发往上游的 messages 数组。
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 玩家台词在 messages 中的前缀（与 app.js 原来的格式一致）
+PLAYER_PREFIX = '玩家：'
+
+# 滚动场景总结的提示词：之前的总结 + 新的几轮对话 -> 更新后的总结
+ROLLING_SUMMARY_PROMPT = """{background}
+
+之前的场景总结：
+{summary}
+
+新的聊天记录：
+{conversation}
+
+请总结当前场景的故事发展：把新的聊天记录合并进之前的场景总结，输出更新后的完整总结。"""
+
+
+class DialogueSession:
+    """一个对话会话
+
+    Args:
+        api_key: 调用上游使用的 API Key
+        request_template: 每轮请求共用的字段（model、temperature、response_format 等）
+        system_prompt: 对话模块的 System Prompt
+        context: 场景信息、记忆上下文和指令，作为第一条用户消息
+        history_limit: 保留的对话条数（玩家和 NPC 各算一条）
+        player_id: 玩家 ID，设置后每轮从记忆中检索相关条目放入上下文
+        npc_text: 场景中的 NPC 列表，用于记忆检索
+    """
+
+    def __init__(self, session_id, api_key, request_template, system_prompt, context, history_limit,
+                 player_id=None, npc_text=''):
+        self.id = session_id
+        self.api_key = api_key
+        self.request_template = request_template
+        self.system_prompt = system_prompt
+        self.context = context
+        self.player_id = player_id
+        self.npc_text = npc_text
+        self.memory_update = None   # 记忆模块调用参数，设置后每轮对话交给记忆更新调度
+        self.summary_update = None  # 总结模块调用参数，设置后在对话过程中维护滚动场景总结
+        self.rolling_summary = ''   # 已合并进总结的对话的场景总结
+        self.summary_turns = 0      # 已合并进 rolling_summary 的轮数
+        self.turns = 0              # 交给滚动总结的总轮数（创建时上传的历史记录算一轮）
+        self.history = deque(maxlen=history_limit)   # (role, content)，role 为 player 或 npc
+        self.lock = threading.Lock()   # 同一会话的各轮依次执行，保证历史顺序
+        self.last_used = time.time()
+
+    def append(self, role, content):
+        self.history.append((role, content))
+
+    def build_request(self, player_line, memory_context=''):
+        """组装本轮发往上游的请求体，memory_context 放在场景上下文之前"""
+        messages = [
+            {'role': 'system', 'content': self.system_prompt},
+            {'role': 'user', 'content': memory_context + self.context if memory_context else self.context},
+        ]
+        for role, content in self.history:
+            if role == 'player':
+                messages.append({'role': 'user', 'content': PLAYER_PREFIX + content})
+            else:
+                messages.append({'role': 'assistant', 'content': content})
+        messages.append({'role': 'user', 'content': PLAYER_PREFIX + player_line})
+        request_data = dict(self.request_template)
+        request_data['messages'] = messages
+        return request_data
+
+    def record_turn(self, player_line, reply):
+        self.append('player', player_line)
+        self.append('npc', reply)
+
+
+class SessionStore:
+    """会话存储，按最近使用淘汰，超过 ttl 未使用的会话自动失效
+
+    会话按最近使用的顺序保存，过期的会话都在最前面：创建会话时顺带删除它们，
+    不再使用的会话不会一直占着内存直到被 max_sessions 挤掉。
+
+    Args:
+        max_sessions: 最多保存的会话数
+        ttl: 会话空闲多久后失效（秒）
+        history_limit: 每个会话保留的对话条数
+        id_prefix: 会话 ID 的前缀（多进程模式下标明会话所在的工作进程）
+    """
+
+    def __init__(self, max_sessions=1024, ttl=3600.0, history_limit=20, id_prefix=''):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.history_limit = history_limit
+        self.id_prefix = id_prefix
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def create(self, api_key, request_template, system_prompt, context, history=(), player_id=None, npc_text=''):
+        """创建会话，history 为已有的 [(role, content), ...]"""
+        session = DialogueSession(self.id_prefix + secrets.token_urlsafe(16), api_key, request_template,
+                                  system_prompt, context, self.history_limit, player_id, npc_text)
+        for role, content in history:
+            session.append(role, content)
+        with self._lock:
+            self._sweep(time.time())
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def _sweep(self, now):
+        """删除最前面的过期会话（调用方持有锁）"""
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id):
+        """返回未过期的会话，不存在时返回 None"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if now - session.last_used > self.ttl:
+                del self._sessions[session_id]
+                return None
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def remove(self, session_id):
+        """删除会话，返回被删除的会话（不存在时返回 None）"""
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+静态资源缓存
+
+把 index.html、app.js、style.css 等文件读入内存并预先压缩（gzip，安装了
+brotli 时还有 br），按浏览器的 Accept-Encoding 选择编码，并提供 ETag /
+Last-Modified 用于 304 条件请求。文件修改时间变化后自动重新加载。
+"""
+
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖
+    brotli = None
+
+# 值得压缩的内容类型
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+)
+
+# 预加载时处理的文件扩展名
+PRELOAD_EXTENSIONS = ('.html', '.js', '.css')
+
+
+class StaticAsset:
+    """一个静态文件的内存副本及其压缩版本"""
+
+    def __init__(self, path, stat, data, content_type):
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.content_type = content_type
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        digest = hashlib.sha1(data).hexdigest()[:16]
+        # encoding -> (内容, ETag)；不同编码的表示使用不同的 ETag
+        self.variants = {'identity': (data, f'"{digest}"')}
+
+    def add_variant(self, encoding, data):
+        tag = self.variants['identity'][1][:-1] + f'-{encoding}"'
+        self.variants[encoding] = (data, tag)
+
+    def etags(self):
+        return {tag for _data, tag in self.variants.values()}
+
+
+def _accepted_encodings(accept_encoding):
+    """解析 Accept-Encoding，返回 q 值大于 0 的编码集合"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name)
+    return accepted
+
+
+class StaticAssetCache:
+    """静态资源内存缓存
+
+    Args:
+        max_file_size: 超过该大小的文件不缓存（交给默认处理器）
+        min_compress_size: 小于该大小的文件不压缩
+    """
+
+    def __init__(self, max_file_size=2 * 1024 * 1024, min_compress_size=512):
+        self.max_file_size = max_file_size
+        self.min_compress_size = min_compress_size
+        self._lock = threading.Lock()
+        self._assets = {}
+
+    def get(self, path):
+        """返回 path 对应的 StaticAsset；不是普通文件或文件过大时返回 None"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path) or stat.st_size > self.max_file_size:
+            return None
+
+        with self._lock:
+            asset = self._assets.get(path)
+        if asset is not None and asset.mtime == stat.st_mtime and asset.size == stat.st_size:
+            return asset
+
+        asset = self._load(path, stat)
+        with self._lock:
+            self._assets[path] = asset
+        return asset
+
+    def _load(self, path, stat):
+        with open(path, 'rb') as f:
+            data = f.read()
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        asset = StaticAsset(path, stat, data, content_type)
+
+        if len(data) >= self.min_compress_size and content_type.startswith(COMPRESSIBLE_TYPES):
+            asset.add_variant('gzip', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                asset.add_variant('br', brotli.compress(data))
+        return asset
+
+    def preload(self, directory):
+        """预加载并压缩目录下的页面、脚本和样式文件，返回加载的文件数"""
+        count = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(PRELOAD_EXTENSIONS) and self.get(os.path.join(directory, name)):
+                count += 1
+        return count
+
+    @staticmethod
+    def choose_encoding(asset, accept_encoding):
+        """按 Accept-Encoding 选择最小的可用编码"""
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and encoding in accepted:
+                return encoding
+        return 'identity'
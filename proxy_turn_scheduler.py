@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+按会话合并对话的后台任务调度（记忆更新、滚动场景总结）
+
+对话每轮都调用一次记忆模块会让上游请求翻倍，连续几轮很快时多个更新还会并发写入同一份记忆。
+调度器按会话缓冲对话，满足以下任一条件时把缓冲的几轮合成一次调用：
+
+- 缓冲的轮数达到 flush_turns
+- 最后一轮之后 idle_timeout 秒没有新的对话
+- 场景结束（调用方显式 flush）
+
+同一会话的提交依次执行：上一次提交进行中时到达的对话继续缓冲，等它完成后再一起提交，
+不会有两个更新同时写入同一份记忆（或同一份总结）。
+"""
+
+import threading
+import time
+
+
+class _PendingUpdates:
+    """一个会话的缓冲状态"""
+
+    def __init__(self, job):
+        self.job = job                # 提交时使用的参数（最近一轮的）
+        self.conversation = []        # 缓冲的对话条目
+        self.turns = 0                # 缓冲的轮数
+        self.last_turn = time.monotonic()
+        self.running = False          # 是否有提交正在执行
+        self.requested = False        # 执行期间是否又请求了提交
+        self.submitted = 0            # 累计加入的轮数
+        self.completed = 0            # 累计处理完（成功或失败）的轮数
+        self.last_result = None
+
+
+class TurnBatchScheduler:
+    """按会话合并对话，批量提交给 flush 函数
+
+    Args:
+        flush: 提交函数 flush(job, conversation, turns)，返回值作为 flush() 的结果
+        flush_turns: 缓冲多少轮后立即提交
+        idle_timeout: 最后一轮之后多久没有新对话就提交（秒）
+        tag: 日志前缀
+    """
+
+    def __init__(self, flush, flush_turns=4, idle_timeout=20.0, tag='MEMORY'):
+        self._flush = flush
+        self.tag = tag
+        self.flush_turns = max(1, flush_turns)
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._timer = None
+        self._turns = 0
+        self._flushed_turns = 0
+        self._calls = 0
+        self._failures = 0
+
+    def add_turn(self, key, job, conversation):
+        """缓冲一轮对话；job 为提交时使用的参数，conversation 为这一轮的对话条目"""
+        with self._cond:
+            state = self._pending.get(key)
+            if state is None:
+                state = self._pending[key] = _PendingUpdates(job)
+            state.job = job
+            state.conversation.extend(conversation)
+            state.turns += 1
+            state.submitted += 1
+            state.last_turn = time.monotonic()
+            self._turns += 1
+            if state.turns >= self.flush_turns:
+                self._start(key, state, 'turns')
+            else:
+                self._ensure_timer()
+                self._cond.notify_all()
+
+    def flush(self, key, wait=True, timeout=None):
+        """立即提交该会话缓冲的对话
+
+        wait 为 True 时等待此前加入的对话全部处理完，返回最近一次提交的结果；
+        没有缓冲过对话的会话返回 None。
+        """
+        with self._cond:
+            state = self._pending.get(key)
+            if state is None:
+                return None
+            target = state.submitted
+            self._start(key, state, 'flush')
+            if wait:
+                self._cond.wait_for(lambda: state.completed >= target, timeout)
+            return state.last_result
+
+    def close(self, timeout=10.0):
+        """提交所有缓冲的对话并等待完成（服务器退出前调用）"""
+        with self._cond:
+            states = list(self._pending.items())
+            for key, state in states:
+                self._start(key, state, 'close')
+            deadline = time.monotonic() + timeout
+            for _key, state in states:
+                target = state.submitted
+                self._cond.wait_for(lambda: state.completed >= target, max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'turns': self._turns,
+                'calls': self._calls,
+                'failures': self._failures,
+                # 每次调用处理了多轮对话，相比每轮调用一次省下的上游请求数
+                'calls_saved': self._flushed_turns - self._calls,
+                'pending_turns': sum(state.turns for state in self._pending.values()),
+            }
+
+    def _start(self, key, state, reason):
+        """（持有锁）开始提交缓冲的对话；已有提交在执行时由它完成后接着提交"""
+        if state.running:
+            state.requested = True
+            return
+        if not state.turns:
+            return
+        state.running = True
+        threading.Thread(target=self._run, args=(key, state, reason), daemon=True).start()
+
+    def _run(self, key, state, reason):
+        with self._cond:
+            batch = self._take(state)
+        while batch is not None:
+            job, conversation, turns = batch
+            result = None
+            try:
+                result = self._flush(job, conversation, turns)
+                print(f"[{self.tag}] 合并提交 {turns} 轮对话（{reason}）")
+            except Exception as e:
+                print(f"[{self.tag}] 提交失败（{turns} 轮对话）: {e}")
+            with self._cond:
+                self._calls += 1
+                self._flushed_turns += turns
+                if result is None:
+                    self._failures += 1
+                state.last_result = result
+                state.completed += turns
+                # 执行期间到达的对话已经满足提交条件（或被显式提交）时，接着提交
+                if state.turns and (state.requested or state.turns >= self.flush_turns):
+                    state.requested = False
+                    batch = self._take(state)
+                    reason = 'queued'
+                else:
+                    state.requested = False
+                    batch = None
+                    state.running = False
+                    if not state.turns:
+                        self._pending.pop(key, None)
+                self._cond.notify_all()
+
+    @staticmethod
+    def _take(state):
+        """（持有锁）取出缓冲的对话"""
+        if not state.turns:
+            return None
+        batch = (state.job, state.conversation, state.turns)
+        state.conversation = []
+        state.turns = 0
+        return batch
+
+    def _ensure_timer(self):
+        """（持有锁）启动空闲检查线程"""
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._watch_idle, daemon=True)
+            self._timer.start()
+
+    def _watch_idle(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                next_deadline = None
+                for key, state in list(self._pending.items()):
+                    if state.running or not state.turns:
+                        continue
+                    deadline = state.last_turn + self.idle_timeout
+                    if deadline <= now:
+                        self._start(key, state, 'idle')
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                self._cond.wait(None if next_deadline is None else next_deadline - now)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+多上游、多 API Key 路由
+
+服务器端配置一组上游（接口地址 + 可选的 API Key，同一地址配多个 Key 就是多个上游），
+每个上游请求按路由策略选一个：
+- least-outstanding：进行中请求最少的上游（相同时随机选一个）
+- ewma：响应耗时（到收到响应头）的指数加权平均 ×（进行中请求数 + 1）最小的上游，慢的上游自动少分流量
+
+连续失败（连接错误、5xx，以及服务器端 Key 返回 401/403/429）达到阈值的上游被摘除，
+摘除期满后由后台线程探测，探测成功才重新加入，探测失败时摘除时间加倍。
+所有上游都被摘除时仍选择最早可以恢复的一个，不会因此拒绝请求。
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+ROUTING_STRATEGIES = ('least-outstanding', 'ewma')
+
+# 探测线程检查被摘除上游的间隔（秒）
+PROBE_CHECK_INTERVAL = 1.0
+
+
+class Upstream:
+    """一个上游
+
+    Attributes:
+        name: 名称（日志、指标和 /api/upstreams 中使用）
+        base_url: 接口地址，如 https://api.openai.com/v1
+        api_key: 服务器端的 API Key，None 表示使用浏览器提供的 Key
+        outstanding: 进行中的请求数
+        ewma: 响应耗时的指数加权平均（秒），还没有样本时为 None
+        healthy: 是否参与路由（False 表示已被摘除）
+    """
+
+    def __init__(self, name, base_url, api_key=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key or None
+        self.outstanding = 0
+        self.ewma = None
+        self.healthy = True
+        self.failures = 0           # 连续失败次数
+        self.ejected_until = 0.0    # 摘除到什么时候（time.monotonic()）
+        self.eject_seconds = 0.0    # 本次摘除的时长，探测失败时加倍
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    @property
+    def chat_url(self):
+        return self.base_url + '/chat/completions'
+
+    def is_failure(self, status):
+        """上游的响应状态码是否说明该上游（或它的 Key）出了问题
+
+        使用浏览器的 Key 时 401/403/429 是浏览器的 Key 无效或超出限额，不算上游的问题。
+        """
+        if status >= 500:
+            return True
+        return self.api_key is not None and status in (401, 403, 429)
+
+
+def load_upstreams(path):
+    """读取上游配置文件
+
+    JSON 数组，每项 {"name", "base_url", "api_key"} 或用 "api_key_env" 给出保存 Key 的环境变量名；
+    没有 Key 的上游使用浏览器提供的 Key。
+    """
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("上游配置必须是非空的 JSON 数组")
+    upstreams = []
+    for index, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not entry.get('base_url'):
+            raise ValueError(f"第 {index} 个上游缺少 base_url")
+        api_key = entry.get('api_key')
+        if entry.get('api_key_env'):
+            api_key = os.environ.get(entry['api_key_env'])
+            if not api_key:
+                raise ValueError(f"第 {index} 个上游的环境变量 {entry['api_key_env']} 未设置")
+        upstreams.append(Upstream(str(entry.get('name') or f'upstream-{index}'), entry['base_url'], api_key))
+    names = [upstream.name for upstream in upstreams]
+    if len(set(names)) != len(names):
+        raise ValueError("上游名称不能重复")
+    return upstreams
+
+
+class UpstreamRouter:
+    """在一组上游之间路由请求
+
+    Args:
+        upstreams: Upstream 列表
+        strategy: 路由策略，见 ROUTING_STRATEGIES
+        failure_threshold: 连续失败多少次后摘除
+        eject_seconds: 第一次摘除的时长（秒），探测失败时加倍，最长 max_eject_seconds
+        probe: probe(upstream) -> bool，摘除期满后探测上游是否恢复；为 None 时期满直接恢复
+        ewma_weight: 计算耗时的指数加权平均时新样本的权重
+    """
+
+    def __init__(self, upstreams, strategy='least-outstanding', failure_threshold=3, eject_seconds=10.0,
+                 max_eject_seconds=300.0, probe=None, ewma_weight=0.3):
+        if not upstreams:
+            raise ValueError("至少需要一个上游")
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"未知的路由策略: {strategy}")
+        self.upstreams = list(upstreams)
+        self.strategy = strategy
+        self.failure_threshold = max(1, failure_threshold)
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.probe = probe
+        self.ewma_weight = ewma_weight
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def server_keys(self):
+        """是否所有上游都配置了服务器端的 API Key（此时浏览器可以不提供 Key）"""
+        return all(upstream.api_key for upstream in self.upstreams)
+
+    def start(self):
+        """启动探测被摘除上游的后台线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._probe_loop, name='upstream-probe', daemon=True)
+            self._thread.start()
+
+    def acquire(self, exclude=()):
+        """选一个上游并把它的进行中请求数加一，用完后调用 release
+
+        exclude 为本次请求已经失败过的上游，有其他健康的上游时避开它们。
+        """
+        with self._lock:
+            candidates = ([u for u in self.upstreams if u.healthy and u not in exclude]
+                          or [u for u in self.upstreams if u.healthy]
+                          or [min(self.upstreams, key=lambda u: u.ejected_until)])
+            upstream = self._pick(candidates)
+            upstream.outstanding += 1
+            upstream.requests += 1
+        return upstream
+
+    def _pick(self, candidates):
+        """（持有锁）按路由策略从候选中选一个，得分相同时随机选"""
+        if self.strategy == 'ewma':
+            # 还没有样本的上游得分为 0，会先被试一次
+            def score(upstream):
+                return (upstream.ewma or 0.0) * (upstream.outstanding + 1)
+        else:
+            def score(upstream):
+                return upstream.outstanding
+        best = min(score(upstream) for upstream in candidates)
+        return random.choice([upstream for upstream in candidates if score(upstream) == best])
+
+    def available(self, exclude=()):
+        """除 exclude 之外是否还有健康的上游"""
+        with self._lock:
+            return any(upstream.healthy and upstream not in exclude for upstream in self.upstreams)
+
+    def release(self, upstream):
+        """请求结束（响应已读完或出错），进行中请求数减一"""
+        with self._lock:
+            upstream.outstanding -= 1
+
+    def record(self, upstream, status=None, elapsed=None):
+        """记录一次上游调用的结果：收到响应头时传入状态码和耗时，连接出错时 status 为 None"""
+        message = None
+        with self._lock:
+            if status is not None and not upstream.is_failure(status):
+                upstream.failures = 0
+                if elapsed is not None:
+                    upstream.ewma = elapsed if upstream.ewma is None else \
+                        upstream.ewma + self.ewma_weight * (elapsed - upstream.ewma)
+                return
+            upstream.errors += 1
+            upstream.failures += 1
+            if upstream.healthy and upstream.failures >= self.failure_threshold:
+                upstream.healthy = False
+                upstream.ejections += 1
+                self._schedule_probe(upstream)
+                message = (f"[UPSTREAM] {upstream.name} 连续失败 {upstream.failures} 次，"
+                           f"摘除 {upstream.eject_seconds:g}s 后探测")
+        if message:
+            print(message)
+
+    def _schedule_probe(self, upstream):
+        """（持有锁）第一次摘除 eject_seconds 秒，之后每次探测失败加倍"""
+        upstream.eject_seconds = min(self.max_eject_seconds,
+                                     upstream.eject_seconds * 2 if upstream.eject_seconds else self.eject_seconds)
+        upstream.ejected_until = time.monotonic() + upstream.eject_seconds
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(PROBE_CHECK_INTERVAL)
+            now = time.monotonic()
+            with self._lock:
+                due = [u for u in self.upstreams if not u.healthy and u.ejected_until <= now]
+            for upstream in due:
+                self._probe(upstream)
+
+    def _probe(self, upstream):
+        try:
+            recovered = self.probe(upstream) if self.probe is not None else True
+            detail = ''
+        except Exception as e:
+            recovered = False
+            detail = f"（{e.__class__.__name__}）"
+        with self._lock:
+            if recovered:
+                upstream.healthy = True
+                upstream.failures = 0
+                upstream.eject_seconds = 0.0
+                message = f"[UPSTREAM] {upstream.name} 探测成功，重新加入路由"
+            else:
+                self._schedule_probe(upstream)
+                message = f"[UPSTREAM] {upstream.name} 探测失败{detail}，{upstream.eject_seconds:g}s 后再试"
+        print(message)
+
+    def stats(self):
+        """各上游的状态（不含 API Key）"""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'name': upstream.name,
+                'base_url': upstream.base_url,
+                'server_key': upstream.api_key is not None,
+                'healthy': upstream.healthy,
+                'outstanding': upstream.outstanding,
+                'latency_ewma_ms': round(upstream.ewma * 1000, 1) if upstream.ewma is not None else None,
+                'requests': upstream.requests,
+                'errors': upstream.errors,
+                'consecutive_failures': upstream.failures,
+                'ejections': upstream.ejections,
+                'probe_in_seconds': None if upstream.healthy else round(max(0.0, upstream.ejected_until - now), 1),
+            } for upstream in self.upstreams]
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+多进程（prefork）模式
+
+一个 Python 进程受 GIL 限制，能同时处理的 TLS 会话和 JSON 编解码有限。--workers N 时由主进程
+（WorkerSupervisor）fork 出 N 个工作进程，每个工作进程用 SO_REUSEPORT 各自监听同一个端口，
+由内核把新连接分给各进程；工作进程异常退出时主进程自动重启它。
+
+对话会话、预取槽位和玩家记忆的检索索引只保存在一个进程的内存中，因此这些请求按会话 ID、
+玩家 ID 或预取 key 固定交给一个工作进程（owner）：落到其他进程上的请求通过 owner 的内部端口
+（只监听 127.0.0.1）转发过去。内部端口的监听套接字由主进程在 fork 之前创建，工作进程重启后不变。
+
+各工作进程每秒把自己的指标快照写到一个临时目录，/metrics 合并所有进程的快照后输出；
+重启的工作进程以上一次的快照作为计数器的基数，计数器不会因为重启而变小。
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import proxy_metrics as metrics
+
+# 转发给 owner 的请求带上这个请求头，owner 直接在本进程处理
+FORWARDED_HEADER = 'X-Proxy-Worker-Forwarded'
+
+# 工作进程写指标快照的间隔（秒）
+SNAPSHOT_INTERVAL = 1.0
+
+# 工作进程启动后这么久之内退出视为启动失败，重启前按指数退避等待
+MIN_UPTIME = 5.0
+MAX_RESTART_DELAY = 30.0
+
+_SESSION_OWNER = re.compile(r'^w(\d+)_')
+
+
+def reuseport_supported():
+    """当前系统是否支持 fork 和 SO_REUSEPORT（Windows 不支持）"""
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class WorkerContext:
+    """工作进程的序号、各进程的内部端口和指标快照目录
+
+    Attributes:
+        index: 本进程的序号（0 ~ count-1）
+        count: 工作进程数
+        internal_ports: 各工作进程内部端口的端口号
+        internal_socket: 本进程内部端口的监听套接字
+    """
+
+    def __init__(self, index, count, internal_sockets, snapshot_dir):
+        self.index = index
+        self.count = count
+        self.internal_ports = [sock.getsockname()[1] for sock in internal_sockets]
+        self.internal_socket = internal_sockets[index]
+        self.snapshot_dir = snapshot_dir
+        self._baseline = []
+        self._registry = None
+
+    @property
+    def session_prefix(self):
+        """本进程创建的会话 ID 的前缀，用于找到会话所在的进程"""
+        return f'w{self.index}_'
+
+    def session_owner(self, session_id):
+        """会话所在的工作进程序号，ID 不是工作进程创建的时返回 None"""
+        match = _SESSION_OWNER.match(session_id or '')
+        if match is None or int(match.group(1)) >= self.count:
+            return None
+        return int(match.group(1))
+
+    def owner_of(self, key):
+        """按 key（玩家 ID、预取槽位等）固定分配的工作进程序号"""
+        digest = hashlib.sha256(str(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') % self.count
+
+    # ---------- 指标快照 ----------
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, f'{name}.json')
+
+    def start_snapshots(self, registry):
+        """读取上一次运行留下的快照作为计数器基数，之后每 SNAPSHOT_INTERVAL 秒写一次快照"""
+        self._registry = registry
+        try:
+            with open(self._snapshot_path(f'worker-{self.index}'), encoding='utf-8') as f:
+                self._baseline = metrics.without_gauges(json.load(f))
+        except (OSError, ValueError):
+            self._baseline = []
+        threading.Thread(target=self._snapshot_loop, name='metrics-snapshot', daemon=True).start()
+
+    def snapshot(self):
+        """本进程的指标（加上重启前的计数）"""
+        current = self._registry.snapshot()
+        return metrics.merge_snapshots([self._baseline, current]) if self._baseline else current
+
+    def write_snapshot(self):
+        write_snapshot(self._snapshot_path(f'worker-{self.index}'), self.snapshot())
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"[WORKER] 写指标快照失败: {e}")
+
+    def render_metrics(self):
+        """合并所有进程的指标：本进程用最新的值，其他进程用最近一次快照"""
+        own = self._snapshot_path(f'worker-{self.index}')
+        snapshots = [self.snapshot()]
+        for path in sorted(glob.glob(os.path.join(self.snapshot_dir, '*.json'))):
+            if path == own:
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return metrics.render_snapshot(metrics.merge_snapshots(snapshots))
+
+
+def write_snapshot(path, families):
+    """原子地写入一份指标快照（先写临时文件再改名，读取方不会读到一半的文件）"""
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(families, f)
+    os.replace(temp_path, path)
+
+
+class WorkerSupervisor:
+    """fork 并守护工作进程
+
+    Args:
+        count: 工作进程数
+        port: 公共端口，主进程用 SO_REUSEPORT 绑定（不监听）来占住它
+        target: 工作进程的入口 target(WorkerContext)，返回时工作进程退出
+        graceful_timeout: 停止时等待工作进程处理完进行中请求的最长时间（秒），超时后强制结束
+    """
+
+    def __init__(self, count, port, target, graceful_timeout=30.0):
+        self.count = count
+        self.port = port
+        self.target = target
+        self.graceful_timeout = graceful_timeout
+        self.restarts = 0
+        self._pids = {}             # pid -> 序号
+        self._started = {}          # 序号 -> 启动时间
+        self._failures = [0] * count
+        self._next_start = [0.0] * count
+        self._stopping = False
+        self._sockets = []
+        self._snapshot_dir = None
+
+    def run(self):
+        """启动所有工作进程并守护它们，收到 SIGINT/SIGTERM 后优雅停止，返回时所有工作进程都已退出"""
+        reserve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        reserve.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reserve.bind(('', self.port))
+        self._sockets = [reserve]
+        internal_sockets = []
+        for _ in range(self.count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(128)
+            internal_sockets.append(sock)
+        self._sockets += internal_sockets
+        self._snapshot_dir = tempfile.mkdtemp(prefix='proxy-metrics-')
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        try:
+            for index in range(self.count):
+                self._spawn(index, internal_sockets)
+            self._write_snapshot()
+            while not self._stopping:
+                self._reap()
+                now = time.monotonic()
+                for index in range(self.count):
+                    if index not in self._pids.values() and now >= self._next_start[index]:
+                        self.restarts += 1
+                        self._spawn(index, internal_sockets)
+                        self._write_snapshot()
+                time.sleep(0.2)
+            self._shutdown()
+        finally:
+            for sock in self._sockets:
+                sock.close()
+            for path in glob.glob(os.path.join(self._snapshot_dir, '*')):
+                os.remove(path)
+            os.rmdir(self._snapshot_dir)
+
+    def _spawn(self, index, internal_sockets):
+        sys.stdout.flush()   # 否则缓冲区中未输出的日志会在子进程中再输出一遍
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                context = WorkerContext(index, self.count, internal_sockets, self._snapshot_dir)
+                # 其他进程的内部端口和占位套接字在工作进程中用不到
+                self._sockets[0].close()
+                for i, sock in enumerate(internal_sockets):
+                    if i != index:
+                        sock.close()
+                self.target(context)
+                code = 0
+            except BaseException as e:
+                print(f"[WORKER] 工作进程 {index} 异常退出: {e!r}")
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        self._pids[pid] = index
+        self._started[index] = time.monotonic()
+        print(f"[WORKER] 工作进程 {index} 已启动（pid {pid}）")
+
+    def _reap(self):
+        """回收退出的工作进程，安排重启（启动后很快就退出的按指数退避）"""
+        while self._pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self._pids.pop(pid, None)
+            if index is None:
+                continue
+            if self._stopping:
+                continue
+            uptime = time.monotonic() - self._started[index]
+            self._failures[index] = self._failures[index] + 1 if uptime < MIN_UPTIME else 0
+            delay = min(MAX_RESTART_DELAY, 2 ** self._failures[index] - 1) if self._failures[index] else 0
+            self._next_start[index] = time.monotonic() + delay
+            print(f"[WORKER] 工作进程 {index}（pid {pid}）退出，状态 {_describe_status(status)}，"
+                  f"{f'{delay:g}s 后' if delay else '立即'}重启")
+
+    def _request_stop(self, signum, _frame):
+        if not self._stopping:
+            print(f"[WORKER] 收到信号 {signal.Signals(signum).name}，通知工作进程处理完进行中的请求后退出")
+        self._stopping = True
+
+    def _shutdown(self):
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._pids and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid, index in list(self._pids.items()):
+            print(f"[WORKER] 工作进程 {index}（pid {pid}）未在 {self.graceful_timeout:g}s 内退出，强制结束")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self._pids.clear()
+
+    def _write_snapshot(self):
+        """主进程自己的指标：工作进程数和重启次数"""
+        write_snapshot(os.path.join(self._snapshot_dir, 'supervisor.json'), [
+            {'name': 'proxy_workers', 'type': 'gauge', 'help': '工作进程数', 'labels': [],
+             'samples': [[[], self.count]]},
+            {'name': 'proxy_worker_restarts_total', 'type': 'counter', 'help': '异常退出后被重启的工作进程次数',
+             'labels': [], 'samples': [[[], self.restarts]]},
+        ])
+
+
+def _describe_status(status):
+    if os.WIFSIGNALED(status):
+        return f'信号 {signal.Signals(os.WTERMSIG(status)).name}'
+    return f'退出码 {os.WEXITSTATUS(status)}'
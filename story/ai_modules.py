@@ -2,15 +2,28 @@
 AI模块核心类
 """
 import json
+import os
 import re
+import sys
+import time
 from typing import Dict, Optional, Any, List
 from openai import OpenAI
-from config import OPENAI_API_KEY, OPENAI_MODEL, DEFAULT_PROMPTS
+from config import OPENAI_API_KEY, OPENAI_MODEL, DEFAULT_PROMPTS, MODEL_ROUTING_FILE, MODEL_ROUTING_LOG
+
+# 模型路由与代理服务器共用仓库根目录下的 proxy_model_routing.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from proxy_model_routing import load_model_routing
+
+# 所有模块共用一个路由器（耗时统计按请求类别区分），未配置路由策略时为 None
+MODEL_ROUTER = load_model_routing(MODEL_ROUTING_FILE, log_path=MODEL_ROUTING_LOG) if MODEL_ROUTING_FILE else None
 
 
 class AIModule:
     """AI模块基类"""
     
+    # 请求类别，模型路由策略按它选择模型（策略中没有的类别使用 default 的规则）
+    request_class = "default"
+    
     def __init__(self, api_key: Optional[str] = None, model: str = OPENAI_MODEL):
         """
         初始化AI模块
@@ -59,18 +72,30 @@ class AIModule:
         if not self.client:
             raise ValueError("API密钥未设置，请先设置API密钥")
         
+        model = self.model
+        decision = None
+        if MODEL_ROUTER is not None:
+            decision = MODEL_ROUTER.route(self.request_class, self.model)
+            model = decision.model
+        status = None
+        started = time.perf_counter()
         try:
             response = self.client.chat.completions.create(
-                model=self.model,
+                model=model,
                 messages=[
                     {"role": "system", "content": "你是一个专业的游戏故事创作助手。"},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=temperature
             )
+            status = 200
             return response.choices[0].message.content
         except Exception as e:
+            status = getattr(e, "status_code", None)
             raise Exception(f"调用OpenAI API失败: {str(e)}")
+        finally:
+            if decision is not None:
+                MODEL_ROUTER.finish(decision, status, time.perf_counter() - started)
     
     def _parse_json_response(self, response: str) -> Dict[str, Any]:
         """
@@ -97,6 +122,8 @@ class AIModule:
 class NPCModule(AIModule):
     """NPC生成模块"""
     
+    request_class = "npc"
+    
     def generate_npc_all(self, gender: str = "不限", profession: str = "不限") -> Dict[str, Any]:
         """
         生成完整的NPC信息
@@ -146,6 +173,8 @@ class NPCModule(AIModule):
 class LocationModule(AIModule):
     """地点生成模块"""
     
+    request_class = "location"
+    
     def generate_location(self, name: str) -> str:
         """
         生成地点描述
@@ -163,6 +192,8 @@ class LocationModule(AIModule):
 class StoryModule(AIModule):
     """故事生成模块"""
     
+    request_class = "story"
+    
     def generate_story(self, npcs: list, locations: list, style: str = "奇幻冒险") -> str:
         """
         生成故事
@@ -221,6 +252,8 @@ class StoryModule(AIModule):
 class ChapterModule(AIModule):
     """章节生成模块"""
     
+    request_class = "chapter"
+    
     def generate_chapters(self, story: str, selected_npcs: list = None, selected_locations: list = None) -> List[Dict[str, str]]:
         """
         生成三个章节
@@ -8,6 +8,11 @@ from typing import Optional
 OPENAI_API_KEY: Optional[str] = None
 OPENAI_MODEL: str = "gpt-4"  # 使用gpt-4，如果4.1可用则改为gpt-4.1
 
+# 模型路由策略文件（与代理服务器的 --model-routing 格式相同），不设置时所有模块都使用 OPENAI_MODEL
+MODEL_ROUTING_FILE: Optional[str] = os.environ.get("MODEL_ROUTING_FILE")
+# 路由日志文件（JSON Lines），不设置时不写日志
+MODEL_ROUTING_LOG: Optional[str] = os.environ.get("MODEL_ROUTING_LOG")
+
 # 默认Prompt模板
 DEFAULT_PROMPTS = {
     "npc_generate_all": """请为一个游戏NPC生成完整信息：
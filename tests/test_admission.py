@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""proxy_admission：优先级排队、队列上限、令牌桶和不等待的准入"""
+
+import threading
+import time
+import unittest
+
+from proxy_admission import (AdmissionController, AdmissionRejected, PRIORITY_LEVELS, PrioritySlots, TokenBucket,
+                             normalize_priority_class)
+
+
+class PrioritySlotsTest(unittest.TestCase):
+
+    def test_release_hands_slot_to_highest_priority_waiter(self):
+        slots = PrioritySlots(capacity=1, queue_limit=8)
+        slots.acquire(0, timeout=1)
+        order = []
+        threads = []
+        for name in ('prefetch', 'memory', 'story', 'dialogue'):
+            def wait(name=name):
+                slots.acquire(PRIORITY_LEVELS[name], timeout=5)
+                order.append(name)
+                slots.release()
+            thread = threading.Thread(target=wait)
+            thread.start()
+            threads.append(thread)
+            # 按固定顺序进入队列
+            while sum(slots.queued().values()) < len(threads):
+                time.sleep(0.001)
+        slots.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['dialogue', 'story', 'memory', 'prefetch'])
+
+    def test_full_queue_is_rejected(self):
+        slots = PrioritySlots(capacity=1, queue_limit=1)
+        slots.acquire(0, timeout=1)
+        errors = []
+
+        def wait():
+            try:
+                slots.acquire(1, timeout=0.2)
+            except AdmissionRejected as e:
+                errors.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        while not slots.queued().get(1):
+            time.sleep(0.001)
+        with self.assertRaises(AdmissionRejected):
+            slots.acquire(1, timeout=1)
+        # 其他优先级的队列不受影响，排队超时同样被拒绝
+        with self.assertRaises(AdmissionRejected):
+            slots.acquire(2, timeout=0.05)
+        waiter.join(5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(slots.queued(), {1: 0, 2: 0})
+
+    def test_try_acquire_does_not_jump_the_queue(self):
+        slots = PrioritySlots(capacity=1, queue_limit=8)
+        self.assertTrue(slots.try_acquire())
+        self.assertFalse(slots.try_acquire())
+        slots.release()
+        self.assertTrue(slots.try_acquire())
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.02)
+
+    def test_cancel_returns_reservation(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        bucket.reserve()
+        self.assertGreater(bucket.reserve(), 0)
+        bucket.cancel()
+        bucket.cancel()
+        self.assertEqual(bucket.reserve(), 0.0)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_rate_limit_rejects_beyond_max_wait(self):
+        admission = AdmissionController(rate=1, burst=1, max_rate_wait=0.5)
+        with admission.admit('key-a', 'dialogue'):
+            pass
+        with self.assertRaises(AdmissionRejected) as caught:
+            admission.admit('key-a', 'dialogue')
+        self.assertGreaterEqual(caught.exception.retry_after, 1)
+        # 每个 API Key 有自己的令牌桶
+        with admission.admit('key-b', 'dialogue'):
+            pass
+
+    def test_try_admit_takes_slot_and_token_or_nothing(self):
+        admission = AdmissionController(max_concurrent=1, rate=100, burst=2)
+        ticket = admission.admit('key', 'dialogue')
+        self.assertIsNone(admission.try_admit('key'))
+        ticket.release()
+        hedge = admission.try_admit('key')
+        self.assertIsNotNone(hedge)
+        hedge.release()
+        hedge.release()   # 重复归还不会多出槽位
+        self.assertTrue(admission.slots.try_acquire())
+        self.assertFalse(admission.slots.try_acquire())
+
+    def test_try_admit_returns_token_when_no_slot(self):
+        admission = AdmissionController(max_concurrent=1, rate=0.001, burst=1)
+        admission.slots.try_acquire()
+        self.assertIsNone(admission.try_admit('key'))
+        admission.slots.release()
+        self.assertIsNotNone(admission.try_admit('key'))
+        self.assertIsNone(admission.try_admit('key'))
+
+    def test_unknown_class_is_default(self):
+        self.assertEqual(normalize_priority_class(' Dialogue '), 'dialogue')
+        self.assertEqual(normalize_priority_class('nonsense'), 'default')
+        self.assertEqual(normalize_priority_class(None), 'default')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""proxy_cache：请求指纹、内存 LRU + TTL 缓存、SQLite 磁盘层和相同请求合并"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from proxy_cache import ResponseCache, SingleFlight, SqliteCacheTier, request_fingerprint
+
+
+class RequestFingerprintTest(unittest.TestCase):
+
+    def test_ignores_key_order_and_api_key(self):
+        a = request_fingerprint({'model': 'm', 'temperature': 0, 'api_key': 'sk-1'})
+        b = request_fingerprint({'temperature': 0, 'model': 'm'})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, request_fingerprint({'model': 'm', 'temperature': 0.5}))
+
+    def test_api_key_argument_separates_keys(self):
+        request = {'model': 'm'}
+        self.assertNotEqual(request_fingerprint(request, 'sk-1'), request_fingerprint(request, 'sk-2'))
+        self.assertNotEqual(request_fingerprint(request, 'sk-1'), request_fingerprint(request))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('a', 'application/json', b'1')
+        cache.put('b', 'application/json', b'2')
+        cache.get('a')
+        cache.put('c', 'application/json', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').body, b'1')
+        self.assertEqual(cache.get('c').body, b'3')
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'disk_hits': 0, 'entries': 2})
+
+    def test_expired_entry_is_a_miss(self):
+        cache = ResponseCache(ttl=10)
+        cache.put('a', 'application/json', b'1')
+        with mock.patch('proxy_cache.time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class SqliteCacheTierTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'cache.sqlite')
+
+    def test_survives_restart(self):
+        disk = SqliteCacheTier(self.path)
+        ResponseCache(disk=disk).put('a', 'application/json', b'{"ok": 1}')
+        disk.close()
+        disk = SqliteCacheTier(self.path)
+        self.addCleanup(disk.close)
+        cache = ResponseCache(disk=disk)
+        self.assertEqual(cache.get('a').body, b'{"ok": 1}')
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        # 之后从内存层命中
+        cache.get('a')
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+    def test_evicts_least_recently_used_beyond_max_bytes(self):
+        disk = SqliteCacheTier(self.path, max_bytes=10)
+        self.addCleanup(disk.close)
+        cache = ResponseCache(max_entries=1, disk=disk)
+        cache.put('a', 'text/plain', b'aaaa')
+        cache.put('b', 'text/plain', b'bbbb')
+        self.assertIsNotNone(disk.get('a', ttl=60))
+        cache.put('c', 'text/plain', b'cccc')
+        self.assertIsNone(disk.get('b', ttl=60))
+        self.assertIsNotNone(disk.get('a', ttl=60))
+        self.assertIsNotNone(disk.get('c', ttl=60))
+        # 超过上限的单个响应不写入磁盘
+        cache.put('d', 'text/plain', b'x' * 11)
+        self.assertIsNone(disk.get('d', ttl=60))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_concurrently(self, flight, fn, count=5):
+        """count 个线程同时以相同的键调用 flight.do，返回各自的 (结果, 是否共享) 或异常"""
+        outcomes = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                outcome = flight.do('key', fn)
+            except Exception as e:
+                outcome = e
+            with lock:
+                outcomes.append(outcome)
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, outcomes
+
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+        threads, outcomes = self.run_concurrently(flight, fn)
+        started.wait(5)
+        while flight.stats()['followers'] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(outcomes), [('result', False)] + [('result', True)] * 4)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+        self.assertAlmostEqual(flight.stats()['ratio'], 0.8)
+
+    def test_error_is_shared_and_not_remembered(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("upstream failed")
+        threads, outcomes = self.run_concurrently(flight, fail, count=3)
+        while flight.stats()['followers'] < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+        self.assertEqual(flight.do('key', lambda: 'ok'), ('ok', False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""proxy_model_routing：按请求类别选模型，p95 超过 SLO 时改用 fallback"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from proxy_model_routing import (REASON_POLICY, REASON_REQUESTED, REASON_SLO_FALLBACK, ModelRoute, ModelRouter,
+                                 load_model_routing)
+
+
+class ModelRouterTest(unittest.TestCase):
+
+    def router(self, **kwargs):
+        routes = {
+            'dialogue': ModelRoute('big', slo_ms=100, fallback='small'),
+            'memory': ModelRoute('small'),
+        }
+        return ModelRouter(routes, window=10, min_samples=3, cooldown=kwargs.pop('cooldown', 60), **kwargs)
+
+    def test_policy_and_requested_models(self):
+        router = self.router()
+        self.assertEqual(router.route('memory', 'big')[3:], ('small', REASON_POLICY))
+        self.assertEqual(router.route('memory', 'small')[3:], ('small', REASON_REQUESTED))
+        # 没有规则、也没有 default 的类别保持请求中的模型
+        self.assertEqual(router.route('letter', 'big')[3:], ('big', REASON_REQUESTED))
+
+    def test_default_rule(self):
+        router = ModelRouter({'default': ModelRoute('cheap')})
+        self.assertEqual(router.route('letter', 'big').model, 'cheap')
+
+    def test_fallback_after_slo_breach_and_restore_after_cooldown(self):
+        router = self.router(cooldown=10)
+        for _ in range(3):
+            router.finish(router.route('dialogue', None), 200, 0.5)
+        decision = router.route('dialogue', None)
+        self.assertEqual((decision.primary, decision.model, decision.reason), ('big', 'small', REASON_SLO_FALLBACK))
+        # fallback 的耗时不计入主模型的统计
+        router.finish(decision, 200, 5.0)
+        self.assertTrue(router.stats()['windows'][0]['fallback_active'])
+        with mock.patch('proxy_model_routing.time.monotonic', return_value=1e12):
+            self.assertEqual(router.route('dialogue', None).model, 'big')
+        self.assertEqual(router.stats()['windows'][0]['samples'], 0)
+
+    def test_failures_and_fast_requests_do_not_trigger_fallback(self):
+        router = self.router()
+        for _ in range(5):
+            router.finish(router.route('dialogue', None), 500, 5.0)
+            router.finish(router.route('dialogue', None), None, None)
+            router.finish(router.route('dialogue', None), 200, 0.05)
+        self.assertEqual(router.route('dialogue', None).model, 'big')
+
+    def test_route_requires_slo_and_fallback_together(self):
+        with self.assertRaises(ValueError):
+            ModelRoute('big', slo_ms=100)
+        with self.assertRaises(ValueError):
+            ModelRoute('big', slo_ms=0, fallback='small')
+
+    def test_decision_log(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        log_path = os.path.join(directory, 'routing.jsonl')
+        router = self.router(log_path=log_path)
+        router.finish(router.route('memory', 'big'), 200, 0.25)
+        with open(log_path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]['class'], records[0]['model'], records[0]['latency_ms']), ('memory', 'small', 250.0))
+
+
+class LoadModelRoutingTest(unittest.TestCase):
+
+    def write(self, config):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load(self):
+        router = load_model_routing(self.write({
+            'classes': {'dialogue': {'model': 'big', 'slo_p95_ms': 800, 'fallback': 'small'}},
+            'min_samples': 5, 'cooldown_seconds': 30,
+        }))
+        self.assertEqual((router.min_samples, router.cooldown), (5, 30.0))
+        self.assertEqual(router.rule('dialogue').fallback, 'small')
+
+    def test_invalid(self):
+        for config in ([], {'classes': []}, {'classes': {'dialogue': 'big'}},
+                       {'classes': {'dialogue': {'slo_p95_ms': 'fast', 'fallback': 'small'}}}):
+            with self.assertRaises(ValueError):
+                load_model_routing(self.write(config))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""静态文件服务不返回数据库文件；数据库默认不放在网站根目录"""
+
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import proxy_server
+
+
+class PrivateFilesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.root = tempfile.mkdtemp()
+        for name in ('index.html', 'notes.txt', 'old.SQLITE-wal'):
+            with open(os.path.join(cls.root, name), 'w', encoding='utf-8') as f:
+                f.write(name)
+        os.chdir(cls.root)
+        args = proxy_server.parse_args([
+            '--no-browser', '--pool-warm', '0', '--cache',
+            '--cache-db', os.path.join(cls.root, 'cache.db'),
+            '--memory-db', os.path.join(cls.root, 'player_memory.sqlite'),
+        ])
+        proxy_server.configure(args)
+        # 数据库打开之后再放一个同名的 -journal 文件，避免 SQLite 把它当作需要回滚的日志
+        open(os.path.join(cls.root, 'cache.db-journal'), 'w').close()
+        cls.proxy = proxy_server.create_server(0)
+        threading.Thread(target=cls.proxy.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.shutdown()
+        cls.proxy.server_close()
+        proxy_server.MEMORY_SCHEDULER.close()
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.root, ignore_errors=True)
+
+    def status(self, method, path):
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy.server_address[1], timeout=10)
+        conn.request(method, path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+
+    def test_database_files_are_not_served(self):
+        for path in ('/player_memory.sqlite', '/old.SQLITE-wal', '/cache.db', '/cache.db-journal',
+                     '/./player_memory.sqlite', '/%70layer_memory.sqlite', '/player_memory.sqlite?x=1'):
+            for method in ('GET', 'HEAD'):
+                self.assertEqual(self.status(method, path), 404, (method, path))
+
+    def test_other_files_are_served(self):
+        self.assertEqual(self.status('GET', '/index.html'), 200)
+        self.assertEqual(self.status('GET', '/notes.txt'), 200)
+        self.assertEqual(self.status('HEAD', '/'), 200)
+
+
+class DefaultMemoryDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.script_dir = tempfile.mkdtemp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.script_dir, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, self.state_dir, ignore_errors=True)
+
+    def test_default_is_outside_script_dir(self):
+        with mock.patch.dict(os.environ, {'XDG_STATE_HOME': self.state_dir, 'LOCALAPPDATA': self.state_dir}):
+            path = proxy_server.default_memory_db(self.script_dir)
+        self.assertEqual(os.path.dirname(path), os.path.join(self.state_dir, 'ai_rpg'))
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+
+    def test_existing_database_in_script_dir_is_kept(self):
+        legacy = os.path.join(self.script_dir, 'player_memory.sqlite')
+        open(legacy, 'w').close()
+        self.assertEqual(proxy_server.default_memory_db(self.script_dir), legacy)
+
+    def test_relative_paths_resolve_against_launch_directory(self):
+        args = proxy_server.parse_args(['--upstreams', 'ups.json', '--cache-db', 'cache.sqlite'])
+        with mock.patch.dict(os.environ, {'XDG_STATE_HOME': self.state_dir, 'LOCALAPPDATA': self.state_dir}):
+            proxy_server.resolve_paths(args, self.script_dir)
+        self.assertEqual(args.upstreams, os.path.abspath('ups.json'))
+        self.assertEqual(args.cache_db, os.path.abspath('cache.sqlite'))
+        self.assertIsNone(args.model_routing)
+        self.assertTrue(args.memory_db.startswith(self.state_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
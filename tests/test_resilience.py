@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""proxy_resilience：重试退避和对冲请求"""
+
+import threading
+import time
+import unittest
+
+from proxy_cancellation import CancelScope
+from proxy_resilience import Hedger, RetryPolicy, parse_retry_after
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_backoff_is_bounded_and_limited(self):
+        policy = RetryPolicy(max_retries=3, base_delay=0.5, max_delay=1.0)
+        for attempt, bound in ((0, 0.5), (1, 1.0), (2, 1.0)):
+            delay = policy.next_delay(attempt, 503)
+            self.assertTrue(0 <= delay <= bound, (attempt, delay))
+        self.assertIsNone(policy.next_delay(3, 503))
+
+    def test_only_retryable_statuses(self):
+        policy = RetryPolicy()
+        self.assertIsNotNone(policy.next_delay(0, None))   # 连接错误
+        self.assertIsNotNone(policy.next_delay(0, 429))
+        self.assertIsNone(policy.next_delay(0, 400))
+        self.assertIsNone(policy.next_delay(0, 401))
+
+    def test_retry_after_and_deadline(self):
+        policy = RetryPolicy(base_delay=0.01, max_delay=5)
+        self.assertEqual(policy.next_delay(0, 429, retry_after='2'), 2.0)
+        self.assertIsNone(policy.next_delay(0, 429, retry_after='60'))
+        self.assertIsNone(policy.next_delay(0, 429, retry_after='2', remaining=1.0))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+
+class HedgerTest(unittest.TestCase):
+
+    def hedger(self, **kwargs):
+        hedger = Hedger(budget=kwargs.pop('budget', 1.0), min_samples=1, min_delay=0.01, **kwargs)
+        hedger.observe('key', 0.02)
+        return hedger
+
+    def test_no_hedge_without_samples(self):
+        hedger = Hedger(min_samples=5)
+        self.assertEqual(hedger.run('key', lambda scope: 'value'), 'value')
+        self.assertEqual(hedger.stats()['hedged'], 0)
+
+    def test_hedge_wins_and_primary_is_aborted(self):
+        hedger = self.hedger()
+        scopes = []
+
+        def call(scope):
+            scopes.append(scope)
+            if len(scopes) == 1:
+                deadline = time.monotonic() + 5
+                while scope.reason is None and time.monotonic() < deadline:
+                    time.sleep(0.005)
+                return 'slow'
+            return 'fast'
+        self.assertEqual(hedger.run('key', call), 'fast')
+        self.assertEqual(hedger.stats()['hedge_wins'], 1)
+        self.assertIsNotNone(scopes[0].reason)
+
+    def test_primary_error_is_raised_when_both_fail(self):
+        hedger = self.hedger()
+        attempts = []
+
+        def call(scope):
+            index = len(attempts)
+            attempts.append(index)
+            time.sleep(0.1 if index == 0 else 0)
+            raise RuntimeError(f"attempt {index}")
+        with self.assertRaisesRegex(RuntimeError, 'attempt 0'):
+            hedger.run('key', call)
+        self.assertEqual(len(attempts), 2)
+
+    def test_hedge_skipped_without_admission(self):
+        hedger = self.hedger()
+        calls = []
+
+        def call(scope):
+            calls.append(scope)
+            time.sleep(0.1)
+            return 'value'
+        self.assertEqual(hedger.run('key', call, admit=lambda: None), 'value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(hedger.stats()['no_slot'], 1)
+        self.assertEqual(hedger.stats()['hedged'], 0)
+
+    def test_hedge_releases_its_admission(self):
+        hedger = self.hedger()
+        released = threading.Event()
+
+        def call(scope):
+            time.sleep(0.1)
+            return 'value'
+        self.assertEqual(hedger.run('key', call, admit=lambda: released.set), 'value')
+        self.assertTrue(released.wait(5))
+        self.assertEqual(hedger.stats()['hedged'], 1)
+
+    def test_budget_limits_hedges(self):
+        hedger = self.hedger(budget=0.0)
+        hedger._tokens = 0.0
+
+        def call(scope):
+            time.sleep(0.05)
+            return 'value'
+        hedger.run('key', call)
+        self.assertEqual(hedger.stats()['over_budget'], 1)
+        self.assertEqual(hedger.stats()['hedged'], 0)
+
+    def test_parent_abort_reaches_attempts(self):
+        hedger = Hedger(min_samples=5)
+        parent = CancelScope(None)
+        parent.abort('disconnected')
+        self.assertEqual(hedger.run('key', lambda scope: scope.reason, parent), 'disconnected')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""proxy_retrieval：中文 n-gram 切分和 BM25 打分"""
+
+import unittest
+
+from proxy_retrieval import BM25Index, estimate_tokens, tokenize, weighted_query
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_cjk_unigrams_and_bigrams(self):
+        self.assertEqual(tokenize('老王'), ['老', '王', '老王'])
+
+    def test_words_are_lowercased(self):
+        self.assertEqual(tokenize('Hello, NPC 42!'), ['hello', 'npc', '42'])
+
+    def test_mixed_text(self):
+        self.assertEqual(tokenize('买了Sword'), ['买', '了', '买了', 'sword'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens('长剑'), 2)
+        self.assertEqual(estimate_tokens('abcdefgh'), 2)
+
+
+class BM25IndexTest(unittest.TestCase):
+
+    def test_relevant_document_ranks_first(self):
+        documents = ['玩家向铁匠老王买了一把长剑', '玩家在酒馆听说了北方的传闻', '玩家帮药师采了草药']
+        index = BM25Index(documents)
+        scores = index.scores(weighted_query(('那把剑还好用吗？老王问', 1.0)))
+        self.assertEqual(max(range(len(documents)), key=scores.__getitem__), 0)
+
+    def test_bigram_outranks_scattered_characters(self):
+        index = BM25Index(['老张和小王', '老王'])
+        scores = index.scores(weighted_query(('老王', 1.0)))
+        self.assertGreater(scores[1], scores[0])
+
+    def test_query_weights(self):
+        index = BM25Index(['铁匠', '药师'])
+        scores = index.scores(weighted_query(('铁匠', 1.0), ('药师', 0.5)))
+        self.assertGreater(scores[1], 0)
+        self.assertGreater(scores[0], scores[1])
+
+    def test_unknown_terms_and_empty_index(self):
+        self.assertEqual(BM25Index(['铁匠']).scores({'dragon': 1.0}), [0.0])
+        self.assertEqual(BM25Index([]).scores(weighted_query(('铁匠', 1.0))), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
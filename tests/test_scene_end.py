@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""POST /api/scene/end：各段都会返回带 status 的事件，流水线出错或某段卡住时请求也会结束"""
+
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import proxy_server
+from mock_openai_server import create_mock_server
+
+SCENE_REQUEST = {
+    'api_key': 'sk-test',
+    'model': 'mock-model',
+    'summary': {'system_prompt': '总结', 'prompt': '玩家与 NPC 的对话'},
+    'story': {'system_prompt': '故事', 'prompt': '上一幕总结：{{summary}}'},
+    'letter': {'system_prompt': '信件', 'prompt': '写一封信'},
+}
+
+
+class SceneEndTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        cls.mock = create_mock_server()
+        threading.Thread(target=cls.mock.serve_forever, daemon=True).start()
+        args = proxy_server.parse_args([
+            '--no-browser', '--pool-warm', '0', '--no-static-cache',
+            '--upstream-base-url', f'http://127.0.0.1:{cls.mock.server_address[1]}/v1',
+            '--memory-db', os.path.join(cls.data_dir, 'memory.sqlite'),
+        ])
+        proxy_server.configure(args)
+        cls.proxy = proxy_server.create_server(0)
+        threading.Thread(target=cls.proxy.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.shutdown()
+        cls.proxy.server_close()
+        cls.mock.shutdown()
+        cls.mock.server_close()
+        proxy_server.MEMORY_SCHEDULER.close()
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def end_scene(self, body=None, headers=None):
+        """返回 (耗时, {段名: 结果事件})"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.proxy.server_address[1], timeout=30)
+        started = time.monotonic()
+        conn.request('POST', '/api/scene/end', json.dumps(body or SCENE_REQUEST),
+                     dict({'Content-Type': 'application/json'}, **(headers or {})))
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        events = [json.loads(line) for line in response.read().splitlines()]
+        conn.close()
+        results = {event['section']: event for event in events if 'status' in event}
+        self.assertEqual(len(results), len([event for event in events if 'status' in event]), "每段只有一个结果事件")
+        return time.monotonic() - started, results
+
+    def test_all_sections_succeed(self):
+        _elapsed, results = self.end_scene()
+        self.assertEqual({name: event['status'] for name, event in results.items()},
+                         {'summary': 200, 'story': 200, 'letter': 200})
+        self.assertTrue(results['story']['content'])
+
+    def test_section_setup_error_is_reported(self):
+        route_model = proxy_server.route_model
+
+        def failing_route(request_data, request_class):
+            if request_class == 'story':
+                raise RuntimeError("routing failed")
+            return route_model(request_data, request_class)
+        with mock.patch.object(proxy_server, 'route_model', failing_route):
+            _elapsed, results = self.end_scene()
+        self.assertEqual(results['story']['status'], 502)
+        self.assertEqual(results['summary']['status'], 200)
+        self.assertEqual(results['letter']['status'], 200)
+
+    def test_rolling_summary_error_reports_every_section(self):
+        session = proxy_server.SESSIONS.create('sk-test', {'model': 'mock-model'}, '', '')
+        session.summary_update = {}
+        with mock.patch.object(proxy_server.SUMMARY_SCHEDULER, 'flush', side_effect=RuntimeError("flush failed")):
+            _elapsed, results = self.end_scene(dict(SCENE_REQUEST, session_id=session.id))
+        for name in ('summary', 'story', 'letter'):
+            self.assertEqual(results[name]['status'], 500, name)
+            self.assertEqual(results[name]['error']['type'], 'proxy_error')
+        self.assertEqual(results['memory']['status'], 200)
+
+    def test_stuck_section_is_aborted_after_deadline(self):
+        run_scene_section = proxy_server.ProxyHTTPRequestHandler.run_scene_section
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stuck(handler, name, *args, **kwargs):
+            if name == 'letter':
+                release.wait(30)
+                return None
+            return run_scene_section(handler, name, *args, **kwargs)
+        with mock.patch.object(proxy_server, 'SCENE_ABORT_GRACE', 0.2), \
+                mock.patch.object(proxy_server.ProxyHTTPRequestHandler, 'run_scene_section', stuck):
+            elapsed, results = self.end_scene(headers={'X-Request-Deadline-Ms': '500'})
+        self.assertLess(elapsed, 5)
+        self.assertEqual(results['story']['status'], 200)
+        self.assertEqual(results['letter']['status'], 504)
+        self.assertEqual(results['letter']['error']['code'], 'deadline_exceeded')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""proxy_sessions：会话的创建、过期和淘汰"""
+
+import time
+import unittest
+from unittest import mock
+
+from proxy_sessions import SessionStore
+
+
+class SessionStoreTest(unittest.TestCase):
+
+    def create(self, store, **kwargs):
+        return store.create('sk-test', {'model': 'm'}, '系统提示', '场景', **kwargs)
+
+    def test_create_and_get(self):
+        store = SessionStore(id_prefix='w1-')
+        session = self.create(store, history=[('player', '你好'), ('npc', '欢迎')])
+        self.assertTrue(session.id.startswith('w1-'))
+        self.assertIs(store.get(session.id), session)
+        messages = session.build_request('再见')['messages']
+        self.assertEqual([message['role'] for message in messages], ['system', 'user', 'user', 'assistant', 'user'])
+        self.assertIsNone(store.get('missing'))
+
+    def test_history_limit(self):
+        session = self.create(SessionStore(history_limit=2))
+        for turn in range(3):
+            session.record_turn(f'问{turn}', f'答{turn}')
+        self.assertEqual(list(session.history), [('player', '问2'), ('npc', '答2')])
+
+    def test_least_recently_used_eviction(self):
+        store = SessionStore(max_sessions=2)
+        a = self.create(store)
+        b = self.create(store)
+        store.get(a.id)
+        self.create(store)
+        self.assertIsNone(store.get(b.id))
+        self.assertIsNotNone(store.get(a.id))
+
+    def test_expired_sessions_are_swept_on_create(self):
+        store = SessionStore(ttl=60)
+        stale = [self.create(store) for _ in range(3)]
+        with mock.patch('proxy_sessions.time.time', return_value=time.time() + 61):
+            fresh = self.create(store)
+        self.assertEqual(len(store), 1)
+        self.assertIs(store.get(fresh.id), fresh)
+        self.assertIsNone(store.get(stale[0].id))
+
+    def test_remove(self):
+        store = SessionStore()
+        session = self.create(store)
+        self.assertIs(store.remove(session.id), session)
+        self.assertIsNone(store.remove(session.id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""proxy_turn_scheduler：按会话合并对话、依次提交"""
+
+import threading
+import time
+import unittest
+
+from proxy_turn_scheduler import TurnBatchScheduler
+
+
+class RecordingFlush:
+    """记录每次提交的 flush 函数，block 被设置前提交一直阻塞"""
+
+    def __init__(self):
+        self.calls = []
+        self.block = threading.Event()
+        self.block.set()
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, job, conversation, turns):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.block.wait(5)
+        with self._lock:
+            self.active -= 1
+            self.calls.append((job, list(conversation), turns))
+        return {'turns': turns}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+class TurnBatchSchedulerTest(unittest.TestCase):
+
+    def test_flushes_after_flush_turns(self):
+        flush = RecordingFlush()
+        scheduler = TurnBatchScheduler(flush, flush_turns=3, idle_timeout=60)
+        for turn in range(3):
+            scheduler.add_turn('s1', {'job': turn}, [f'turn {turn}'])
+        wait_for(lambda: scheduler.stats()['calls'])
+        self.assertEqual(flush.calls, [({'job': 2}, ['turn 0', 'turn 1', 'turn 2'], 3)])
+        self.assertEqual(scheduler.stats()['calls_saved'], 2)
+
+    def test_explicit_flush_submits_partial_batch(self):
+        flush = RecordingFlush()
+        scheduler = TurnBatchScheduler(flush, flush_turns=10, idle_timeout=60)
+        scheduler.add_turn('s1', 'job', ['a'])
+        self.assertEqual(scheduler.flush('s1'), {'turns': 1})
+        self.assertIsNone(scheduler.flush('unknown'))
+
+    def test_idle_timeout(self):
+        flush = RecordingFlush()
+        scheduler = TurnBatchScheduler(flush, flush_turns=10, idle_timeout=0.05)
+        scheduler.add_turn('s1', 'job', ['a'])
+        wait_for(lambda: flush.calls)
+        self.assertEqual(flush.calls, [('job', ['a'], 1)])
+
+    def test_turns_during_a_running_flush_are_queued_not_concurrent(self):
+        flush = RecordingFlush()
+        flush.block.clear()
+        scheduler = TurnBatchScheduler(flush, flush_turns=1, idle_timeout=60)
+        scheduler.add_turn('s1', 'job', ['a'])
+        wait_for(lambda: flush.active)
+        scheduler.add_turn('s1', 'job', ['b'])
+        scheduler.add_turn('s1', 'job', ['c'])
+        flush.block.set()
+        self.assertEqual(scheduler.flush('s1', timeout=5), {'turns': 2})
+        self.assertEqual(flush.max_active, 1)
+        self.assertEqual([call[1] for call in flush.calls], [['a'], ['b', 'c']])
+
+    def test_failed_flush_still_completes(self):
+        def fail(job, conversation, turns):
+            raise RuntimeError("upstream failed")
+        scheduler = TurnBatchScheduler(fail, flush_turns=10, idle_timeout=60)
+        scheduler.add_turn('s1', 'job', ['a'])
+        self.assertIsNone(scheduler.flush('s1', timeout=5))
+        self.assertEqual(scheduler.stats()['failures'], 1)
+
+    def test_close_submits_every_session(self):
+        flush = RecordingFlush()
+        scheduler = TurnBatchScheduler(flush, flush_turns=10, idle_timeout=60)
+        scheduler.add_turn('s1', 'job1', ['a'])
+        scheduler.add_turn('s2', 'job2', ['b'])
+        scheduler.close(timeout=5)
+        self.assertEqual(sorted(call[0] for call in flush.calls), ['job1', 'job2'])
+        self.assertEqual(scheduler.stats()['pending_turns'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""proxy_upstreams：路由策略、连续失败摘除和探测恢复"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from proxy_upstreams import Upstream, UpstreamRouter, load_upstreams
+
+
+def eject(router, upstream, status=None):
+    for _ in range(router.failure_threshold):
+        router.record(upstream, status)
+
+
+class UpstreamFailureTest(unittest.TestCase):
+
+    def test_browser_key_errors_do_not_count(self):
+        shared = Upstream('shared', 'http://a/v1')
+        for status in (401, 403, 429, 400, 200):
+            self.assertFalse(shared.is_failure(status), status)
+        self.assertTrue(shared.is_failure(502))
+
+    def test_server_key_errors_count(self):
+        keyed = Upstream('keyed', 'http://a/v1', 'sk-server')
+        for status in (401, 403, 429, 500, 503):
+            self.assertTrue(keyed.is_failure(status), status)
+        self.assertFalse(keyed.is_failure(400))
+
+
+class UpstreamRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Upstream('a', 'http://a/v1', 'key-a')
+        self.b = Upstream('b', 'http://b/v1', 'key-b')
+        self.router = UpstreamRouter([self.a, self.b], failure_threshold=2, eject_seconds=10)
+
+    def test_least_outstanding(self):
+        first = self.router.acquire()
+        second = self.router.acquire()
+        self.assertNotEqual(first, second)
+        self.router.release(first)
+        self.assertIs(self.router.acquire(), first)
+
+    def test_exclude_prefers_other_healthy_upstream(self):
+        for _ in range(10):
+            upstream = self.router.acquire(exclude=(self.a,))
+            self.router.release(upstream)
+            self.assertIs(upstream, self.b)
+
+    def test_ejection_after_consecutive_failures(self):
+        self.router.record(self.a, 503)
+        self.router.record(self.a, 200)   # 成功后重新计数
+        self.router.record(self.a, 503)
+        self.assertTrue(self.a.healthy)
+        self.router.record(self.a, None)  # 连接错误
+        self.assertFalse(self.a.healthy)
+        self.assertEqual(self.a.ejections, 1)
+        self.assertFalse(self.router.available(exclude=(self.b,)))
+        for _ in range(10):
+            upstream = self.router.acquire()
+            self.router.release(upstream)
+            self.assertIs(upstream, self.b)
+
+    def test_browser_key_429_does_not_eject(self):
+        shared = Upstream('shared', 'http://a/v1')
+        router = UpstreamRouter([shared], failure_threshold=1)
+        router.record(shared, 429)
+        self.assertTrue(shared.healthy)
+        self.assertEqual(shared.errors, 0)
+
+    def test_all_ejected_still_routes_to_earliest_recovery(self):
+        eject(self.router, self.a)
+        eject(self.router, self.b)
+        self.b.ejected_until = self.a.ejected_until - 1
+        self.assertIs(self.router.acquire(), self.b)
+
+    def test_probe_failure_doubles_ejection(self):
+        results = [False, True]
+        router = UpstreamRouter([self.a], failure_threshold=1, eject_seconds=1, probe=lambda u: results.pop(0))
+        eject(router, self.a)
+        self.assertEqual(self.a.eject_seconds, 1)
+        router._probe(self.a)
+        self.assertFalse(self.a.healthy)
+        self.assertEqual(self.a.eject_seconds, 2)
+        router._probe(self.a)
+        self.assertTrue(self.a.healthy)
+        self.assertEqual(self.a.failures, 0)
+
+    def test_probe_exception_counts_as_failure(self):
+        def probe(upstream):
+            raise OSError("connection refused")
+        router = UpstreamRouter([self.a], failure_threshold=1, eject_seconds=1, probe=probe)
+        eject(router, self.a)
+        router._probe(self.a)
+        self.assertFalse(self.a.healthy)
+
+    def test_ewma_prefers_faster_upstream(self):
+        router = UpstreamRouter([self.a, self.b], strategy='ewma')
+        router.record(self.a, 200, 1.0)
+        router.record(self.b, 200, 0.1)
+        self.assertIs(router.acquire(), self.b)
+
+
+class LoadUpstreamsTest(unittest.TestCase):
+
+    def write(self, entries):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_key_from_environment(self):
+        os.environ['TEST_UPSTREAM_KEY'] = 'sk-env'
+        self.addCleanup(os.environ.pop, 'TEST_UPSTREAM_KEY')
+        upstreams = load_upstreams(self.write([{'name': 'x', 'base_url': 'http://x/v1/', 'api_key_env': 'TEST_UPSTREAM_KEY'},
+                                               {'base_url': 'http://y/v1'}]))
+        self.assertEqual([u.name for u in upstreams], ['x', 'upstream-2'])
+        self.assertEqual(upstreams[0].api_key, 'sk-env')
+        self.assertEqual(upstreams[0].chat_url, 'http://x/v1/chat/completions')
+        self.assertIsNone(upstreams[1].api_key)
+
+    def test_invalid_configs(self):
+        for entries in ([], [{'name': 'x'}], [{'name': 'x', 'base_url': 'u'}, {'name': 'x', 'base_url': 'v'}],
+                        [{'base_url': 'u', 'api_key_env': 'TEST_UPSTREAM_UNSET'}]):
+            with self.assertRaises(ValueError):
+                load_upstreams(self.write(entries))
+
+
+if __name__ == '__main__':
+    unittest.main()